@@ -21,7 +21,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'test_project.sqlite3'),
-    }
+    },
+    # Separate database standing in for a read replica (READ_DATABASE).
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'test_project_replica.sqlite3'),
+    },
 }
 
 TIME_ZONE = 'America/New_York'
@@ -51,6 +56,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'crum.CurrentRequestUserMiddleware',
+    'trails.middleware.TrailsMiddleware',
 ]
 
 TEMPLATES = [
@@ -106,6 +112,8 @@ try:
     DEBUG_TOOLBAR_CONFIG = {
         'INTERCEPT_REDIRECTS': False,
     }
+    from debug_toolbar.settings import PANELS_DEFAULTS
+    DEBUG_TOOLBAR_PANELS = list(PANELS_DEFAULTS) + ['trails.panels.TrailsPanel']
 except ImportError:
     pass
 
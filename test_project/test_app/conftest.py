@@ -145,3 +145,14 @@ def signal_catcher_class():
 @pytest.fixture
 def signal_catcher(signal_catcher_class):
     return signal_catcher_class()
+
+
+def pytest_terminal_summary(terminalreporter, exitstatus, config):
+    results = getattr(config, '_trails_benchmark_results', None)
+    if not results:
+        return
+    terminalreporter.write_sep('-', 'trails overhead per operation (tracking off -> on)')
+    for result in results:
+        terminalreporter.write_line('{:<36} {:>8.3f}ms -> {:>8.3f}ms  {:>5.1f} -> {:>5.1f} queries'.format(
+            result.name, result.off_time * 1000, result.on_time * 1000, result.off_queries, result.on_queries,
+        ))
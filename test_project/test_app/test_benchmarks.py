@@ -0,0 +1,264 @@
+# Python
+import collections
+import itertools
+import time
+
+# py.test
+import pytest
+
+# Django
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+# Number of times each operation is repeated when measuring.
+REPEAT = 20
+
+# Maximum number of queries trails may add to a single operation.
+MAX_SAVE_QUERIES = 3
+MAX_CHANGE_QUERIES = 5
+MAX_DELETE_QUERIES = 3
+MAX_M2M_QUERIES = 4
+MAX_LOGIN_QUERIES = 3
+
+
+# Counter used to generate unique values across repeated runs.
+_counter = itertools.count()
+
+
+BenchmarkResult = collections.namedtuple('BenchmarkResult', [
+    'name', 'off_time', 'on_time', 'off_queries', 'on_queries',
+])
+
+
+def _added_queries(result):
+    return result.on_queries - result.off_queries
+
+
+BenchmarkResult.added_queries = property(_added_queries)
+
+
+def _measure(operation, setup=None, repeat=REPEAT):
+    '''
+    Run an operation repeatedly, returning the average wall time and number of
+    queries per run. Any setup for each run is done before measuring, and the
+    operation is run once beforehand to warm up any caches.
+    '''
+    states = [setup(n) if setup else n for n in range(repeat + 1)]
+    operation(states.pop(0))
+    with CaptureQueriesContext(connection) as context:
+        start = time.perf_counter()
+        for state in states:
+            operation(state)
+        elapsed = time.perf_counter() - start
+    return elapsed / repeat, len(context.captured_queries) / float(repeat)
+
+
+@pytest.fixture(scope='session')
+def benchmark_results(request):
+    '''
+    Return the list of benchmark results reported at the end of the test run.
+    '''
+    if not hasattr(request.config, '_trails_benchmark_results'):
+        request.config._trails_benchmark_results = []
+    return request.config._trails_benchmark_results
+
+
+@pytest.fixture
+def benchmark(settings, default_trails_settings, minimal_trails_settings, benchmark_results, db):
+    '''
+    Return a function to measure an operation with tracking off and then on.
+    '''
+    def _benchmark(name, operation, setup=None, include_models=(), **trails_settings):
+        settings.TRAILS = minimal_trails_settings
+        off_time, off_queries = _measure(operation, setup)
+        on_settings = dict(default_trails_settings, INCLUDE_MODELS=include_models, TRACK_NO_USER=True)
+        on_settings.update(trails_settings)
+        settings.TRAILS = on_settings
+        on_time, on_queries = _measure(operation, setup)
+        result = BenchmarkResult(name, off_time, on_time, off_queries, on_queries)
+        benchmark_results.append(result)
+        return result
+    return _benchmark
+
+
+def test_benchmark_allthefields(benchmark, allthefields_model):
+    include_models = ('test_app.AllTheFields',)
+
+    def create(n):
+        allthefields_model.objects.create(int_val=n)
+
+    def change(instance):
+        instance.char_val = 'changed'
+        instance.int_val += 1
+        instance.save()
+
+    def delete(instance):
+        instance.delete()
+
+    def setup(n):
+        return allthefields_model.objects.create(int_val=n)
+
+    result = benchmark('AllTheFields create', create, include_models=include_models)
+    assert result.added_queries <= MAX_SAVE_QUERIES
+    result = benchmark('AllTheFields change', change, setup, include_models=include_models)
+    assert result.added_queries <= MAX_CHANGE_QUERIES
+    result = benchmark('AllTheFields delete', delete, setup, include_models=include_models)
+    assert result.added_queries <= MAX_DELETE_QUERIES
+
+
+def test_benchmark_useremail(benchmark, useremail_model, user_instance):
+    include_models = ('test_app.UserEmail',)
+
+    def create(n):
+        useremail_model.objects.create(user=user_instance, email='create{}@example.com'.format(next(_counter)))
+
+    def change(instance):
+        instance.email = 'changed-{}'.format(instance.email)
+        instance.user = None
+        instance.save()
+
+    def delete(instance):
+        instance.delete()
+
+    def setup(n):
+        return useremail_model.objects.create(user=user_instance, email='setup{}@example.com'.format(next(_counter)))
+
+    result = benchmark('UserEmail create', create, include_models=include_models)
+    assert result.added_queries <= MAX_SAVE_QUERIES
+    result = benchmark('UserEmail change', change, setup, include_models=include_models)
+    assert result.added_queries <= MAX_CHANGE_QUERIES
+    result = benchmark('UserEmail delete', delete, setup, include_models=include_models)
+    assert result.added_queries <= MAX_DELETE_QUERIES
+
+
+def test_benchmark_team_association(benchmark, apps, django_user_model):
+    team_model = apps.get_model('test_app', 'Team')
+    association_model = apps.get_model('test_app', 'UserTeamAssociation')
+    include_models = ('test_app.Team', 'test_app.UserTeamAssociation')
+    team = team_model.objects.create(name='team')
+
+    def setup(n):
+        return django_user_model.objects.create(username='team-user-{}'.format(next(_counter)))
+
+    def associate(user):
+        association_model.objects.create(user=user, team=team)
+
+    def disassociate(user):
+        association_model.objects.filter(user=user, team=team).delete()
+
+    result = benchmark('UserTeamAssociation create', associate, setup, include_models=include_models)
+    assert result.added_queries <= MAX_SAVE_QUERIES
+    result = benchmark('UserTeamAssociation delete', disassociate, lambda n: associate(setup(n)) or team.users.order_by('-pk').first(), include_models=include_models)
+    assert result.added_queries <= MAX_DELETE_QUERIES
+
+
+def test_benchmark_node_siblings(benchmark, apps):
+    node_model = apps.get_model('test_app', 'Node')
+    include_models = ('test_app.Node',)
+    node = node_model.objects.create()
+
+    def setup(n):
+        return node_model.objects.create()
+
+    def add_sibling(other):
+        node.siblings.add(other)
+
+    def remove_sibling(other):
+        node.siblings.remove(other)
+
+    def setup_sibling(n):
+        other = setup(n)
+        node.siblings.add(other)
+        return other
+
+    result = benchmark('Node siblings add', add_sibling, setup, include_models=include_models)
+    assert result.added_queries <= MAX_M2M_QUERIES
+    result = benchmark('Node siblings remove', remove_sibling, setup_sibling, include_models=include_models)
+    assert result.added_queries <= MAX_M2M_QUERIES
+
+
+def test_benchmark_polymorphic_fruit(benchmark, apps):
+    apple_model = apps.get_model('test_app', 'Apple')
+    banana_model = apps.get_model('test_app', 'Banana')
+    cherry_model = apps.get_model('test_app', 'Cherry')
+    include_models = ('test_app.Fruit', 'test_app.Apple', 'test_app.Banana', 'test_app.Cherry')
+    apple = apple_model.objects.create(name='apple')
+    cherry = cherry_model.objects.create(name='cherry')
+
+    def create(n):
+        banana_model.objects.create(name='banana {}'.format(n), the_apple=apple)
+
+    def change(banana):
+        banana.name = 'changed {}'.format(banana.name)
+        banana.the_apple = None
+        banana.save()
+
+    def add_banana(banana):
+        cherry.bananas.add(banana)
+
+    def setup(n):
+        return banana_model.objects.create(name='banana {}'.format(n), the_apple=apple)
+
+    result = benchmark('Banana create', create, include_models=include_models)
+    assert result.added_queries <= MAX_SAVE_QUERIES
+    result = benchmark('Banana change', change, setup, include_models=include_models)
+    assert result.added_queries <= MAX_CHANGE_QUERIES
+    result = benchmark('Cherry bananas add', add_banana, setup, include_models=include_models)
+    assert result.added_queries <= MAX_M2M_QUERIES
+
+
+def test_benchmark_login(benchmark, client, django_user_model):
+    django_user_model.objects.create_user(username='benchmark', password='benchmark')
+
+    def login(n):
+        assert client.login(username='benchmark', password='benchmark')
+
+    result = benchmark('User login', login)
+    assert result.added_queries <= MAX_LOGIN_QUERIES
+
+
+def test_benchmark_save_queries_independent_of_fk_count(benchmark, allthefields_model, useremail_model, user_instance, apps):
+    '''
+    Test that the number of queries added by trails when saving doesn't depend
+    on the number of foreign keys on the model being saved.
+    '''
+    team = apps.get_model('test_app', 'Team').objects.create(name='team')
+    association_model = apps.get_model('test_app', 'UserTeamAssociation')
+    user_model = user_instance._meta.model
+
+    def create_no_fk(n):
+        return allthefields_model.objects.create(int_val=n)
+
+    def create_one_fk(n):
+        return useremail_model.objects.create(user=user_instance, email='fk{}@example.com'.format(next(_counter)))
+
+    def create_two_fks(n):
+        user = user_model.objects.create(username='fk-user-{}'.format(next(_counter)))
+        return association_model.objects.create(user=user, team=team)
+
+    def change(instance):
+        if isinstance(instance, useremail_model):
+            instance.email = 'changed{}@example.com'.format(next(_counter))
+        elif isinstance(instance, association_model):
+            instance.manager = not instance.manager
+        else:
+            instance.char_val = 'changed{}'.format(next(_counter))
+        instance.save()
+
+    results = []
+    for name, create, include_models in [
+        ('no foreign keys', create_no_fk, ('test_app.AllTheFields',)),
+        ('one foreign key', create_one_fk, ('test_app.UserEmail',)),
+        ('two foreign keys', create_two_fks, ('test_app.UserTeamAssociation',)),
+    ]:
+        results.append(benchmark('create ({})'.format(name), create, include_models=include_models))
+        results.append(benchmark('change ({})'.format(name), change, create, include_models=include_models))
+    no_fk_create, no_fk_change, one_fk_create, one_fk_change, two_fks_create, two_fks_change = results
+    for result in (no_fk_create, one_fk_create, two_fks_create):
+        assert result.added_queries <= MAX_SAVE_QUERIES
+    for result in (no_fk_change, one_fk_change, two_fks_change):
+        assert result.added_queries <= MAX_CHANGE_QUERIES
+    # Related instances are all recorded together, so a second foreign key
+    # adds no queries over the first.
+    assert one_fk_create.added_queries == two_fks_create.added_queries
+    assert no_fk_change.added_queries == one_fk_change.added_queries == two_fks_change.added_queries
@@ -3,6 +3,7 @@ from __future__ import with_statement
 # Python
 from copy import copy
 import datetime
+import json
 import os
 from urllib.parse import urlparse
 
@@ -21,7 +22,9 @@ from django.contrib.auth.models import User, Group
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.core.files.base import ContentFile
-from django.db.models.signals import pre_save, post_save
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, pre_migrate, post_migrate
 from django.utils.encoding import force_text, smart_text
 from django.utils import timezone
 
@@ -276,6 +279,45 @@ def test_change_model_with_update_fields(settings, minimal_trails_settings, mock
     assert mock_record_trail.call_args[1]['instance_data']['modified_dt'][1] > mock_record_trail.call_args[1]['instance_data']['modified_dt'][0]
 
 
+@pytest.mark.parametrize('before,after', [
+    ('x' * 5000 + 'a' + 'y' * 5000, 'x' * 5000 + 'b' + 'y' * 5000),
+    ('\n'.join(['line {}'.format(n) for n in range(1000)]), '\n'.join(['line {}'.format(n * (n % 100 != 7)) for n in range(1000)])),
+    ({'a': 1, 'b': {'c': 'x' * 1000, 'd': [1, 2, 3]}, 'e': 'gone'}, {'a': 1, 'b': {'c': 'x' * 1000, 'd': [1, 5, 3]}, 'f': 'new'}),
+])
+def test_encode_decode_change(settings, default_trails_settings, before, after):
+    '''
+    Test that large text and JSON values are encoded as a diff smaller than the full values, and that the diff can
+    be decoded back to the full before and after values.
+    '''
+    from trails.diff import encode_change, decode_change, is_diff
+    default_trails_settings.update({'DIFF_THRESHOLD': 1000})
+    settings.TRAILS = default_trails_settings
+    encoded = encode_change(before, after)
+    assert is_diff(encoded)
+    assert len(json.dumps(encoded)) < len(json.dumps([before, after]))
+    assert decode_change(json.loads(json.dumps(encoded))) == (before, after)
+
+
+def test_change_model_with_diff(settings, minimal_trails_settings, mock_record_trail, allthefields_model):
+    '''
+    Test that changing a large text value records a diff when DIFF_THRESHOLD is set, while small values are still
+    recorded as (before, after) tuples.
+    '''
+    from trails.diff import decode_change, is_diff
+    minimal_trails_settings.update({'INCLUDE_MODELS': ('test_app.AllTheFields',), 'DIFF_THRESHOLD': 1000})
+    settings.TRAILS = minimal_trails_settings
+    instance = allthefields_model.objects.create(char_val='z' * 2000)
+    mock_record_trail.reset_mock()
+    instance.char_val = 'z' * 1000 + '!' + 'z' * 999
+    instance.int_val = 7
+    instance.save()
+    assert mock_record_trail.call_count == 1
+    instance_data = mock_record_trail.call_args[1]['instance_data']
+    assert instance_data['int_val'] == (0, 7)
+    assert is_diff(instance_data['char_val'])
+    assert decode_change(instance_data['char_val']) == ('z' * 2000, instance.char_val)
+
+
 def test_change_model_file_field(settings, minimal_trails_settings, mock_record_trail, allthefields_model, media_root):
     '''
     Test that changing a file field on an instance records a change to the file path relative to the media root.
@@ -639,6 +681,113 @@ def test_change_model_with_excluded_fields(settings, minimal_trails_settings, mo
     assert mock_record_trail.call_args[1]['instance_data']['modified_dt'][1] > mock_record_trail.call_args[1]['instance_data']['modified_dt'][0]
 
 
+def test_change_model_with_ignore_only_fields(settings, minimal_trails_settings, mock_record_trail, allthefields_model):
+    '''
+    Test that changes to ignore-only fields are recorded along with other changes, but never result in
+    a call to record_trail by themselves.
+    '''
+    minimal_trails_settings.update({'INCLUDE_MODELS': ('test_app.AllTheFields',), 'IGNORE_ONLY_FIELDS': ('test_app.*.modified_dt',)})
+    settings.TRAILS = minimal_trails_settings
+    instance = allthefields_model.objects.create()
+    assert mock_record_trail.call_count == 1
+    assert 'modified_dt' in mock_record_trail.call_args[1]['instance_data']
+    mock_record_trail.reset_mock()
+    instance.save()
+    assert mock_record_trail.call_count == 0
+    instance.char_val = 'changed'
+    instance.save()
+    assert mock_record_trail.call_count == 1
+    assert mock_record_trail.call_args[0] == ('change',)
+    assert set(mock_record_trail.call_args[1]['instance_data'].keys()) == {'char_val', 'modified_dt'}
+
+
+def test_registry_only_builds_fields_for_included_models(settings, minimal_trails_settings, mocker, apps):
+    '''
+    Test that updating the registry only builds full field maps for included models, and only
+    builds field maps once for each installed model.
+    '''
+    from trails.registry import registry
+    minimal_trails_settings.update({'INCLUDE_MODELS': ('test_app.AllTheFields', 'test_app.UserEmail')})
+    settings.TRAILS = minimal_trails_settings
+    spy = mocker.spy(registry, 'get_model_fields')
+    registry.update_from_settings()
+    full_models = [c[0][0] for c in spy.call_args_list if not c[1].get('m2m_only')]
+    assert sorted([m._meta.label for m in full_models]) == ['test_app.AllTheFields', 'test_app.UserEmail']
+    assert spy.call_count == len(apps.get_models())
+    assert set(registry.model_trackers.keys()) == set(full_models)
+
+
+def test_registry_warns_for_unmatched_field_patterns(settings, minimal_trails_settings, mocker, capsys):
+    '''
+    Test that field patterns for fields of models that aren't included don't warn, without building field maps for
+    those models, while patterns that don't match any field of any model do.
+    '''
+    from trails.registry import registry
+    minimal_trails_settings.update({
+        'INCLUDE_MODELS': ('test_app.UserEmail',),
+        'EXCLUDE_FIELDS': ('auth.user.last_login', 'test_app.useremail.missing'),
+        'SENSITIVE_FIELDS': ('auth.user.password', 'test_app.allthefields.char_val'),
+    })
+    settings.TRAILS = minimal_trails_settings
+    capsys.readouterr()
+    spy = mocker.spy(registry, 'get_model_fields')
+    registry.update_from_settings()
+    assert [c[0][0]._meta.label for c in spy.call_args_list if not c[1].get('m2m_only')] == ['test_app.UserEmail']
+    assert capsys.readouterr().out == 'warning: exclude pattern does not match any known fields test_app.useremail.missing\n'
+
+
+def test_signal_dispatcher(settings, minimal_trails_settings, mock_record_trail, allthefields_model, useremail_model):
+    '''
+    Test that with the signal dispatcher enabled, a single receiver is connected for each model signal and
+    signals are still routed to the tracker for each model.
+    '''
+    minimal_trails_settings.update({
+        'INCLUDE_MODELS': ('test_app.AllTheFields', 'test_app.UserEmail'),
+        'SIGNAL_DISPATCHER': True,
+    })
+    settings.TRAILS = minimal_trails_settings
+    trails_receivers = [r for r in pre_save.receivers if force_text(r[0][0]).startswith('trails-') and r[1]() is not None]
+    assert len(trails_receivers) == 1
+    mock_record_trail.reset_mock()
+    instance = allthefields_model.objects.create()
+    assert mock_record_trail.call_count == 1
+    assert mock_record_trail.call_args[0] == ('add',)
+    instance.char_val = 'dispatched'
+    instance.save()
+    assert mock_record_trail.call_count == 2
+    assert mock_record_trail.call_args[0] == ('change',)
+    assert mock_record_trail.call_args[1]['instance_data']['char_val'] == ('', 'dispatched')
+    useremail_model.objects.create(email='test@trails.com')
+    assert mock_record_trail.call_count == 3
+    instance.delete()
+    assert mock_record_trail.call_count == 4
+    assert mock_record_trail.call_args[0] == ('delete',)
+
+
+def test_signal_dispatcher_migrating(settings, minimal_trails_settings, mock_record_trail, allthefields_model):
+    '''
+    Test that with the signal dispatcher enabled, a single global flag skips recording during migrations.
+    '''
+    from trails.tracker import dispatcher
+    minimal_trails_settings.update({
+        'INCLUDE_MODELS': ('test_app.AllTheFields',),
+        'SIGNAL_DISPATCHER': True,
+    })
+    settings.TRAILS = minimal_trails_settings
+    app_config = allthefields_model._meta.app_config
+    mock_record_trail.reset_mock()
+    pre_migrate.send(sender=app_config, app_config=app_config)
+    try:
+        assert dispatcher.migrating
+        allthefields_model.objects.create()
+        assert mock_record_trail.call_count == 0
+    finally:
+        post_migrate.send(sender=app_config, app_config=app_config)
+    assert not dispatcher.migrating
+    allthefields_model.objects.create()
+    assert mock_record_trail.call_count == 1
+
+
 def test_add_o2o_model(settings, minimal_trails_settings, mock_record_trail, user_instance, userprofile_model):
     '''
     Test that adding an instance with a one-to-one field results in a call to record_trail with 'add' action,
@@ -721,6 +870,79 @@ def test_delete_o2o_related_model_cascade(settings, minimal_trails_settings, moc
     assert mock_record_trail.call_args_list[1][1]['instance_text'] == user_instance_text
 
 
+def test_delete_cascade_aggregated(settings, minimal_trails_settings, mock_record_trail, user_instance, userprofile_model, apps):
+    '''
+    Test that with AGGREGATE_DELETES enabled, deleting an instance results in a single call to record_trail with
+    'delete' action for the root instance, and all cascaded deletions as related instances.
+    '''
+    team_model = apps.get_model('test_app', 'Team')
+    association_model = apps.get_model('test_app', 'UserTeamAssociation')
+    minimal_trails_settings.update({
+        'INCLUDE_MODELS': ('auth.User', 'test_app.UserProfile', 'test_app.UserTeamAssociation'),
+        'AGGREGATE_DELETES': True,
+    })
+    settings.TRAILS = minimal_trails_settings
+    user_instance_text = force_text(user_instance)
+    userprofile = userprofile_model.objects.create(user=user_instance, nickname='uno')
+    association = association_model.objects.create(user=user_instance, team=team_model.objects.create(name='team'))
+    mock_record_trail.reset_mock()
+    user_instance.delete()
+    assert mock_record_trail.call_count == 1
+    assert mock_record_trail.call_args[0] == ('delete',)
+    assert set(mock_record_trail.call_args[1].keys()) == {'instance', 'instance_text', 'related_instances'}
+    assert mock_record_trail.call_args[1]['instance'] is user_instance
+    assert mock_record_trail.call_args[1]['instance_text'] == user_instance_text
+    related_instances = mock_record_trail.call_args[1]['related_instances']
+    assert sorted([(r['instance'].__class__.__name__, r['text'], r['rel']) for r in related_instances]) == [
+        ('UserProfile', force_text(userprofile), 'cascade'),
+        ('UserTeamAssociation', force_text(association), 'cascade'),
+    ]
+
+
+def test_delete_cascade_aggregated_database(settings, default_trails_settings, django_user_model, userprofile_model):
+    '''
+    Test that aggregated deletions are recorded as one trail with a marker for each deleted object, for both a
+    single instance and a queryset, and that a failed delete doesn't affect the next one.
+    '''
+    default_trails_settings.update({
+        'INCLUDE_MODELS': ('auth.User', 'test_app.UserProfile'),
+        'TRACK_NO_USER': True,
+        'AGGREGATE_DELETES': True,
+    })
+    settings.TRAILS = default_trails_settings
+    users = [django_user_model.objects.create(username='cascade{}'.format(n)) for n in range(3)]
+    for user in users:
+        userprofile_model.objects.create(user=user, nickname=user.username)
+
+    def fail(sender, **kwargs):
+        raise RuntimeError('failed')
+
+    pre_delete.connect(fail, sender=userprofile_model)
+    try:
+        with pytest.raises(RuntimeError), transaction.atomic():
+            users[0].delete()
+    finally:
+        pre_delete.disconnect(fail, sender=userprofile_model)
+    Trail.objects.all().delete()
+    users[0].delete()
+    trail = Trail.objects.get(action='delete')
+    assert sorted(trail.markers.values_list('rel', 'obj_text')) == [('', 'cascade0'), ('cascade', 'UserProfile object ({})'.format(trail.markers.get(rel='cascade').obj_pk))]
+    Trail.objects.all().delete()
+    django_user_model.objects.filter(username__startswith='cascade').delete()
+    trail = Trail.objects.get(action='delete')
+    assert trail.markers.filter(rel='').count() == 2
+    assert trail.markers.filter(rel='cascade').count() == 2
+    # Django's Collector is only wrapped while AGGREGATE_DELETES is enabled.
+    from django.db.models.deletion import Collector
+    from trails.deletion import get_delete_group
+    assert hasattr(Collector.delete, '__wrapped__')
+    assert get_delete_group() is None
+    default_trails_settings.update({'AGGREGATE_DELETES': False})
+    settings.TRAILS = default_trails_settings
+    assert not hasattr(Collector.delete, '__wrapped__')
+    assert not hasattr(Collector.collect, '__wrapped__')
+
+
 def test_add_fk_model(settings, minimal_trails_settings, mock_record_trail, user_instance, useremail_model):
     '''
     Test that adding an instance with a foreign key field that can be null results in a call to
@@ -802,6 +1024,36 @@ def test_change_fk_model_from_null(settings, minimal_trails_settings, mock_recor
     assert mock_record_trail.call_args[1]['related_instances'] == [{'rel': '+user', 'instance': user_instance}]
 
 
+def test_fk_related_instances_loaded_in_bulk(settings, default_trails_settings, user_instance, another_user_instance, useremail_model):
+    '''
+    Test that related instances for foreign keys are taken from the instance cache when already loaded, otherwise
+    fetched with one query per related model, and that related trail markers are inserted with a single query.
+    '''
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.UserEmail',), 'TRACK_NO_USER': True})
+    settings.TRAILS = default_trails_settings
+    user_table = connection.ops.quote_name(User._meta.db_table)
+    marker_table = connection.ops.quote_name(TrailMarker._meta.db_table)
+
+    def count_queries(queries, prefix, table):
+        return len([q for q in queries if q['sql'].startswith(prefix) and table in q['sql']])
+
+    with CaptureQueriesContext(connection) as ctx:
+        useremail = useremail_model.objects.create(user=user_instance, email='test@trails.com')
+    assert count_queries(ctx.captured_queries, 'SELECT', user_table) == 0
+    useremail = useremail_model.objects.get(pk=useremail.pk)
+    useremail.user_id = another_user_instance.pk
+    with CaptureQueriesContext(connection) as ctx:
+        useremail.save()
+    assert count_queries(ctx.captured_queries, 'SELECT', user_table) == 1
+    assert count_queries(ctx.captured_queries, 'INSERT', marker_table) == 2
+    trail = Trail.objects.get(action='change')
+    assert sorted(trail.markers.values_list('rel', 'obj_pk')) == [
+        ('', str(useremail.pk)), ('+user', str(another_user_instance.pk)), ('-user', str(user_instance.pk)),
+    ]
+
+
 @pytest.mark.xfail
 def test_delete_fk_related_model_set_null(settings, minimal_trails_settings, mock_record_trail, user_instance, useremail_model):
     '''
@@ -833,6 +1085,1044 @@ def test_delete_fk_related_model_set_null(settings, minimal_trails_settings, moc
 
 
 
+@pytest.mark.parametrize('codec', ['zlib', 'lzma'])
+def test_compressed_trail_data(settings, default_trails_settings, trails_model, codec):
+    '''
+    Test that trail data larger than COMPRESS_THRESHOLD is stored compressed with a marker for the codec, and is only
+    decoded when the data attribute is accessed.
+    '''
+    from trails.fields import RawPayload
+    default_trails_settings.update({'COMPRESS_THRESHOLD': 100, 'COMPRESS_CODEC': codec})
+    settings.TRAILS = default_trails_settings
+    data = {'text': 'compress me ' * 100, 'small': 1}
+    trail = trails_model.objects.create(action='snapshot', data=data)
+    small_trail = trails_model.objects.create(action='snapshot', data={'small': 1})
+    raw_data = trails_model.objects.filter(pk=trail.pk).values_list('data', flat=True)[0]
+    assert raw_data.startswith('!{}'.format({'zlib': 'z', 'lzma': 'x'}[codec]))
+    assert len(raw_data) < len(json.dumps(data))
+    assert trails_model.objects.filter(pk=small_trail.pk).values_list('data', flat=True)[0] == '{"small":1}'
+    trail = trails_model.objects.get(pk=trail.pk)
+    assert isinstance(trail.__dict__['data'], RawPayload)
+    assert trail.data == data
+    assert trails_model.objects.get(pk=small_trail.pk).data == {'small': 1}
+
+
+def test_trails_compress_command(settings, default_trails_settings, trails_model):
+    '''
+    Test that the trails_compress command recompresses existing rows using the current settings.
+    '''
+    data = {'text': 'compress me later ' * 100}
+    trail = trails_model.objects.create(action='snapshot', data=data)
+    assert not trails_model.objects.filter(pk=trail.pk).values_list('data', flat=True)[0].startswith('!')
+    default_trails_settings.update({'COMPRESS_THRESHOLD': 100})
+    settings.TRAILS = default_trails_settings
+    call_command('trails_compress', batch_size=1, verbosity=0)
+    assert trails_model.objects.filter(pk=trail.pk).values_list('data', flat=True)[0].startswith('!z')
+    assert trails_model.objects.get(pk=trail.pk).data == data
+
+
+def test_normalize_text(settings, default_trails_settings, allthefields_model, trails_model):
+    '''
+    Test that with NORMALIZE_TEXT enabled, user and object text is stored once in the text lookup table and
+    referenced by id from each trail and marker.
+    '''
+    from trails.models import TrailText
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.AllTheFields',), 'TRACK_NO_USER': True, 'NORMALIZE_TEXT': True})
+    settings.TRAILS = default_trails_settings
+    instance = allthefields_model.objects.create()
+    instance.char_val = 'normalized'
+    instance.save()
+    trails = list(trails_model.objects.order_by('pk'))
+    assert [t.action for t in trails] == ['add', 'change']
+    for trail in trails:
+        assert trail.user_text == ''
+        assert trail.user_display == '(none)'
+        marker = trail.markers.get()
+        assert marker.obj_text == ''
+        assert marker.obj_display == force_text(instance)
+    assert trails[0].user_text_ref_id == trails[1].user_text_ref_id
+    assert trails[0].markers.get().obj_text_ref_id == trails[1].markers.get().obj_text_ref_id
+    assert TrailText.objects.count() == 2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_normalize_text_cache(django_assert_num_queries):
+    '''
+    Test that interned text ids and values are cached once committed, so repeated lookups don't query the database.
+    '''
+    from trails.models import TrailText
+    try:
+        text_id = TrailText.objects.get_id('[uuid] GET /some/path/')
+        with django_assert_num_queries(0):
+            assert TrailText.objects.get_id('[uuid] GET /some/path/') == text_id
+            assert TrailText.objects.get_text(text_id) == '[uuid] GET /some/path/'
+    finally:
+        TrailText.objects.clear_cache()
+
+
+def test_pending_state_memory(settings, default_trails_settings, allthefields_model):
+    '''
+    Test that state kept between pre and post signals is removed after each save and delete, so memory allocated by
+    the tracker stays flat when saving many instances.
+    '''
+    import gc
+    import tracemalloc
+    import trails.tracker
+    from trails.registry import registry
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.AllTheFields',), 'TRACK_NO_USER': True})
+    settings.TRAILS = default_trails_settings
+    allthefields_model.objects.bulk_create([allthefields_model(int_val=n) for n in range(1100)])
+    instances = list(allthefields_model.objects.all())
+    tracker = registry.model_trackers[allthefields_model]
+    for instance in instances[:100]:
+        instance.int_val += 1
+        instance.save()
+    tracemalloc.start()
+    try:
+        gc.collect()
+        before = tracemalloc.take_snapshot()
+        for instance in instances[100:]:
+            instance.int_val += 1
+            instance.save()
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    filters = [tracemalloc.Filter(True, trails.tracker.__file__)]
+    growth = sum([stat.size_diff for stat in after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')])
+    assert growth < 10000
+    assert len(tracker.pending) == 0
+    assert not any([hasattr(instance, '_trails_tls') for instance in instances])
+    for instance in instances[:10]:
+        instance.delete()
+    assert len(tracker.pending) == 0
+    # State for an instance whose save was interrupted is discarded once the instance is garbage collected.
+    tracker.pending.set(instances[10], 'pre_save', {'int_val': 0})
+    assert len(tracker.pending) == 1
+    del instances
+    gc.collect()
+    assert len(tracker.pending) == 0
+
+
+def test_trails_middleware(settings, default_trails_settings, allthefields_model, user_instance, rf, mocker):
+    '''
+    Test that the middleware makes the request available to trails and computes request, session and user text once
+    for all trails recorded while handling the request.
+    '''
+    from django.contrib.sessions.backends.db import SessionStore
+    from trails.middleware import TrailsMiddleware
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.AllTheFields',)})
+    settings.TRAILS = default_trails_settings
+    request = rf.get('/test_app/?page=1')
+    request.session = SessionStore()
+    request.session.create()
+    get_full_path = mocker.spy(request, 'get_full_path')
+    user_str = mocker.spy(user_instance._meta.model, '__str__')
+
+    def get_response(request):
+        with impersonate(user_instance):
+            for n in range(5):
+                allthefields_model.objects.create(int_val=n)
+        return None
+
+    TrailsMiddleware(get_response)(request)
+    trails = list(Trail.objects.filter(action='add'))
+    assert len(trails) == 5
+    assert set([(t.request, t.session, t.user_text) for t in trails]) == set([
+        ('[{}] GET /test_app/?page=1'.format(request.trails_uuid), request.session.session_key, 'user1'),
+    ])
+    assert get_full_path.call_count == 1
+    assert user_str.call_count == 1
+    # The user text is recomputed for a different user.
+    request = rf.get('/test_app/')
+
+    def get_response(request):
+        for user in (user_instance, user_instance._meta.model.objects.create(username='user3')):
+            with impersonate(user):
+                allthefields_model.objects.create()
+        return None
+
+    TrailsMiddleware(get_response)(request)
+    assert list(Trail.objects.order_by('-pk').values_list('user_text', flat=True)[:2]) == ['user3', 'user1']
+
+
+def test_trails_for_models(settings, default_trails_settings, allthefields_model):
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.AllTheFields',), 'TRACK_NO_USER': True})
+    settings.TRAILS = default_trails_settings
+    instance = allthefields_model.objects.create()
+    instance.int_val = 1
+    instance.save()
+    another_instance = allthefields_model.objects.create()
+    assert Trail.objects.for_models(instance).count() == 2
+    assert Trail.objects.for_models(instance, another_instance).count() == 3
+    assert Trail.objects.for_models(allthefields_model.objects.all()).count() == 3
+    assert Trail.objects.for_models(None).count() == 0
+
+
+def test_recent_for(settings, default_trails_settings, allthefields_model, django_assert_num_queries):
+    '''
+    Test that recent trails for an object are cached, when enabled, until a new marker is recorded for the object.
+    '''
+    from trails.api import record_trail
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.AllTheFields',), 'TRACK_NO_USER': True})
+    settings.TRAILS = default_trails_settings
+    instance = allthefields_model.objects.create()
+    another_instance = allthefields_model.objects.create()
+    for n in range(1, 5):
+        instance.int_val = n
+        instance.save()
+    # Caching is disabled by default.
+    with django_assert_num_queries(2):
+        Trail.objects.recent_for(instance, 3)
+        Trail.objects.recent_for(instance, 3)
+    default_trails_settings.update({'RECENT_CACHE_TIMEOUT': 300})
+    settings.TRAILS = default_trails_settings
+    trails = Trail.objects.recent_for(instance, 3)
+    assert [t.action for t in trails] == ['change', 'change', 'change']
+    assert trails == list(Trail.objects.for_models(instance).order_by('-created', '-pk')[:3])
+    with django_assert_num_queries(0):
+        assert Trail.objects.recent_for(instance, 3) == trails
+        assert Trail.objects.recent_for(instance, 2) == trails[:2]
+    # Requesting more trails than were cached queries again.
+    with django_assert_num_queries(1):
+        assert len(Trail.objects.recent_for(instance, 10)) == 5
+    with django_assert_num_queries(0):
+        assert len(Trail.objects.recent_for(instance, 20)) == 5
+    # Changes to another object don't invalidate the cache.
+    another_instance.int_val = 1
+    another_instance.save()
+    with django_assert_num_queries(0):
+        Trail.objects.recent_for(instance, 3)
+    instance.int_val = 5
+    instance.save()
+    trails = Trail.objects.recent_for(instance, 3)
+    assert trails[0].data == Trail.objects.for_models(instance).order_by('-created', '-pk')[0].data
+    assert len(Trail.objects.for_models(instance)) == 6
+    # Related markers recorded in bulk also invalidate the cache.
+    Trail.objects.recent_for(instance, 3)
+    record_trail('custom', instance=another_instance, related_instances=[instance])
+    assert Trail.objects.recent_for(instance, 3)[0].action == 'custom'
+    default_trails_settings.update({'RECENT_CACHE_TIMEOUT': 0})
+    settings.TRAILS = default_trails_settings
+    with django_assert_num_queries(2):
+        Trail.objects.recent_for(instance, 3)
+        Trail.objects.recent_for(instance, 3)
+
+
+def test_rollups(settings, default_trails_settings, allthefields_model, user_instance, django_assert_num_queries):
+    '''
+    Test that trail counts per day, model, action and user are updated as trails are recorded, and can be rebuilt or
+    caught up from existing trails with the trails_rollup command.
+    '''
+    from django.db import IntegrityError
+    from trails.api import record_trail
+    from trails.importer import RecordMapper, insert_batch
+    from trails.managers import get_rollup_day, get_rollup_key
+    from trails.models import TrailRollup
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.AllTheFields',), 'TRACK_NO_USER': True, 'ROLLUPS': True})
+    settings.TRAILS = default_trails_settings
+    today = timezone.localdate()
+    instances = [allthefields_model.objects.create(int_val=n) for n in range(3)]
+    with impersonate(user_instance):
+        for instance in instances[:2]:
+            instance.int_val += 10
+            instance.save()
+    instances[2].delete()
+    with django_assert_num_queries(1):
+        assert TrailRollup.objects.totals() == 6
+    assert TrailRollup.objects.counts_by_day() == [(today, 6)]
+    assert TrailRollup.objects.counts_by_action() == [('add', 3), ('change', 2), ('delete', 1)]
+    assert TrailRollup.objects.counts_by_model() == [('test_app.AllTheFields', 6)]
+    assert dict(TrailRollup.objects.counts_by_user()) == {None: 4, user_instance.pk: 2}
+    assert TrailRollup.objects.totals(action='change', user=user_instance, model='test_app.AllTheFields') == 2
+    assert TrailRollup.objects.totals(start=today + datetime.timedelta(days=1)) == 0
+    assert list(TrailRollup.objects.totals('action', 'user', action='change')) == [
+        {'action': 'change', 'user': user_instance.pk, 'count': 2},
+    ]
+    assert TrailRollup.objects.get_watermark() == Trail.objects.order_by('-pk')[0].pk
+    # Rebuilding recomputes the same counts from the trails.
+    expected = list(TrailRollup.objects.totals('day', 'ctype', 'action', 'user'))
+    call_command('trails_rollup', rebuild=True, batch_size=2, verbosity=0)
+    assert list(TrailRollup.objects.totals('day', 'ctype', 'action', 'user')) == expected
+    # Without ROLLUPS, the command counts only trails recorded since the last update.
+    default_trails_settings.update({'ROLLUPS': False})
+    settings.TRAILS = default_trails_settings
+    allthefields_model.objects.create()
+    record_trail('custom')
+    assert TrailRollup.objects.totals() == 6
+    call_command('trails_rollup', verbosity=0)
+    assert TrailRollup.objects.totals() == 8
+    assert TrailRollup.objects.totals(action='custom') == 1
+    assert ('', 1) in TrailRollup.objects.counts_by_model()
+    call_command('trails_rollup', verbosity=0)
+    assert TrailRollup.objects.totals() == 8
+    # Counting stops at a gap before a recent trail, whose missing trail may
+    # still be committed, until ROLLUP_COMMIT_LAG has passed.
+    record_trail('custom')
+    late_pk = Trail.objects.order_by('-pk')[0].pk
+    Trail.objects.filter(pk=late_pk).delete()
+    record_trail('custom')
+    assert TrailRollup.objects.update_from_trails() == 0
+    Trail.objects.bulk_create([Trail(pk=late_pk, action='custom')])
+    assert TrailRollup.objects.update_from_trails() == 2
+    default_trails_settings.update({'ROLLUP_COMMIT_LAG': 0})
+    settings.TRAILS = default_trails_settings
+    record_trail('custom')
+    Trail.objects.order_by('-pk')[0].delete()
+    record_trail('custom')
+    assert TrailRollup.objects.update_from_trails() == 1
+    assert TrailRollup.objects.totals() == 11
+    # Rollups without a content type or user are still unique.
+    with pytest.raises(IntegrityError), transaction.atomic():
+        TrailRollup.objects.create(key=get_rollup_key(today, None, 'custom', None), day=today, action='custom')
+    # Trails are counted by day in the default time zone.
+    with timezone.override('Asia/Tokyo'):
+        assert get_rollup_day(datetime.datetime(2020, 1, 1, 2, tzinfo=timezone.utc)) == datetime.date(2019, 12, 31)
+    # Trails inserted in bulk are counted as they are inserted with ROLLUPS.
+    default_trails_settings.update({'ROLLUPS': True})
+    settings.TRAILS = default_trails_settings
+    insert_batch([RecordMapper('test', uid_prefix='test').map(1, {'action': 'import', 'created': '2015-03-01T12:00:00Z'})])
+    assert TrailRollup.objects.counts_by_day(action='import') == [(datetime.date(2015, 3, 1), 1)]
+    call_command('trails_rollup', verbosity=0)
+    assert TrailRollup.objects.totals() == 12
+
+
+@pytest.mark.parametrize('search_index', [True, False])
+def test_search(settings, default_trails_settings, useremail_model, user_instance, admin_client, search_index):
+    '''
+    Test searching trails by user and object text and by values in the trail data, using the search index on SQLite
+    or falling back to matching text without the index.
+    '''
+    from trails.search import SEARCH_TABLE, create_search_index
+    from django.db import connection
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.UserEmail',), 'SEARCH_INDEX': search_index})
+    settings.TRAILS = default_trails_settings
+    # The index table is created after migrating only when SEARCH_INDEX is
+    # enabled.
+    create_search_index(None, using='default')
+    assert (SEARCH_TABLE in connection.introspection.table_names()) == search_index
+    with impersonate(user_instance):
+        email = useremail_model.objects.create(user=user_instance, email='customer@example.com')
+        email.email = 'order-12345@example.com'
+        email.save()
+    from trails.api import record_trail
+    record_trail('custom', user=user_instance, data={'order': {'number': 'ABC-98765'}})
+    assert Trail.objects.search('user1').count() == 3
+    assert Trail.objects.search('USER1 useremail').count() == 2
+    assert list(Trail.objects.search('nobody@example.com')) == []
+    if search_index:
+        # Values in the trail and marker data are only searchable using the index.
+        assert set(Trail.objects.search('customer@example.com').values_list('action', flat=True)) == set(['add', 'change'])
+        assert list(Trail.objects.search('ABC-98765').values_list('action', flat=True)) == ['custom']
+        assert list(Trail.objects.search('order 12345').values_list('action', flat=True)) == ['change']
+        assert list(Trail.objects.search('"quoted" (syntax) OR*')) == []
+        Trail.objects.filter(action='custom').delete()
+        assert list(Trail.objects.search('ABC-98765')) == []
+    else:
+        assert list(Trail.objects.search('customer@example.com')) == []
+    response = admin_client.get(reverse('admin:trails_trail_changelist'), {'q': 'user1 useremail'})
+    assert response.status_code == 200
+    assert set([t.action for t in response.context['cl'].result_list]) == set(['add', 'change'])
+
+
+def test_field_changes(settings, default_trails_settings, useremail_model, user_instance, another_user_instance, django_assert_num_queries):
+    '''
+    Test finding trails that changed a given field, using the field change index recorded with change trails.
+    '''
+    default_trails_settings.update({
+        'INCLUDE_MODELS': ('test_app.UserEmail',), 'TRACK_NO_USER': True,
+        'FIELD_CHANGE_INDEX': True, 'FIELD_CHANGE_HASH_VALUES': True,
+    })
+    settings.TRAILS = default_trails_settings
+    email = useremail_model.objects.create(user=user_instance, email='first@example.com')
+    another_email = useremail_model.objects.create(user=user_instance, email='another@example.com')
+    email.email = 'second@example.com'
+    email.save()
+    email.user = another_user_instance
+    email.save()
+    another_email.email = 'changed@example.com'
+    another_email.save()
+    change_trails = list(Trail.objects.filter(action='change').order_by('pk'))
+    assert set(Trail.objects.field_changes(useremail_model, 'email')) == set([change_trails[0], change_trails[2]])
+    with django_assert_num_queries(1):
+        assert list(Trail.objects.field_changes('test_app.UserEmail', 'user')) == [change_trails[1]]
+    assert list(Trail.objects.field_changes(useremail_model, 'email', instance=email)) == [change_trails[0]]
+    assert list(Trail.objects.field_changes(useremail_model, 'email', before='first@example.com')) == [change_trails[0]]
+    assert list(Trail.objects.field_changes(useremail_model, 'user', after=another_user_instance.pk)) == [change_trails[1]]
+    assert list(Trail.objects.field_changes(useremail_model, 'email', after='first@example.com')) == []
+    assert list(Trail.objects.field_changes(useremail_model, 'email', start=change_trails[2].created)) == [change_trails[2]]
+    assert list(Trail.objects.field_changes(useremail_model, 'email', end=change_trails[0].created)) == []
+    # Nothing is indexed when disabled.
+    default_trails_settings.update({'FIELD_CHANGE_INDEX': False})
+    settings.TRAILS = default_trails_settings
+    email.email = 'third@example.com'
+    email.save()
+    assert Trail.objects.field_changes(useremail_model, 'email').count() == 2
+
+
+def test_revert_request(settings, default_trails_settings, useremail_model, user_instance, another_user_instance, rf):
+    '''
+    Test planning and applying a revert of all changes made during a request, including conflicts with later changes.
+    '''
+    import uuid
+    from io import StringIO
+    from trails.context import trails_context
+    from trails.api import record_trail
+    from trails.revert import RevertConflictError, plan_revert, revert_trails
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.UserEmail',), 'TRACK_NO_USER': True})
+    settings.TRAILS = default_trails_settings
+    email = useremail_model.objects.create(user=user_instance, email='first@example.com')
+    other_email = useremail_model.objects.create(user=user_instance, email='other@example.com')
+    request_uuid = uuid.uuid4()
+    with trails_context(request=rf.get('/bulk-edit/'), request_uuid=request_uuid):
+        email.email = 'second@example.com'
+        email.save()
+        email.email = 'third@example.com'
+        email.user = another_user_instance
+        email.save()
+        other_email.email = 'other-changed@example.com'
+        other_email.save()
+        added_email = useremail_model.objects.create(email='added@example.com')
+        record_trail('custom', instance=email)
+    trails = Trail.objects.for_request(request_uuid)
+    assert trails.count() == 5
+    plan = plan_revert(trails)
+    assert plan.conflicts == []
+    assert [(op.action, op.pk) for op in plan.operations.values()] == [
+        ('update', email.pk), ('update', other_email.pk), ('delete', added_email.pk),
+    ]
+    report = plan.report()
+    assert "update test_app.UserEmail {} (email: 'third@example.com' -> 'first@example.com', user_id: {} -> {})".format(
+        email.pk, another_user_instance.pk, user_instance.pk) in report
+    assert report[-1].endswith('(custom): action can not be reverted')
+    # A later change to one of the objects conflicts.
+    other_email.email = 'later@example.com'
+    other_email.save()
+    out = StringIO()
+    call_command('trails_revert', request=str(request_uuid), dry_run=True, stdout=out)
+    assert 'CONFLICT: change by trail' in out.getvalue()
+    plan = plan_revert(trails)
+    assert [op.pk for op in plan.conflicts] == [other_email.pk]
+    with pytest.raises(RevertConflictError):
+        with transaction.atomic():
+            plan.apply()
+    assert useremail_model.objects.get(pk=email.pk).email == 'third@example.com'
+    plan = revert_trails(trails, force=True)
+    email.refresh_from_db()
+    other_email.refresh_from_db()
+    assert (email.email, email.user) == ('first@example.com', user_instance)
+    assert other_email.email == 'later@example.com'
+    assert not useremail_model.objects.filter(pk=added_email.pk).exists()
+    revert_trail = Trail.objects.get(action='revert')
+    assert revert_trail.data == {'updated': 1, 'deleted': 1, 'created': 0, 'trails': sorted(plan.trail_ids)}
+
+
+def test_revert_apply_rechecks_conflicts(settings, default_trails_settings, useremail_model, rf):
+    '''
+    Test that applying a revert plan checks for conflicts again, so objects changed or deleted after planning aren't
+    overwritten or looked up.
+    '''
+    import uuid
+    from trails.context import trails_context
+    from trails.revert import RevertConflictError, plan_revert
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.UserEmail',), 'TRACK_NO_USER': True})
+    settings.TRAILS = default_trails_settings
+    emails = [useremail_model.objects.create(email='{}@example.com'.format(n)) for n in range(2)]
+    request_uuid = uuid.uuid4()
+    with trails_context(request=rf.get('/bulk-edit/'), request_uuid=request_uuid):
+        for email in emails:
+            email.email = 'changed-{}'.format(email.email)
+            email.save()
+    plan = plan_revert(Trail.objects.for_request(request_uuid))
+    assert plan.conflicts == []
+    useremail_model.objects.filter(pk=emails[0].pk).update(email='later@example.com')
+    with pytest.raises(RevertConflictError):
+        with transaction.atomic():
+            plan.apply()
+    assert [op.pk for op in plan.conflicts] == [emails[0].pk]
+    emails[1].delete()
+    assert plan.apply(force=True) == {'updated': 0, 'deleted': 0, 'created': 0}
+    assert [op.conflicts for op in plan.conflicts] == [
+        ["email is now 'later@example.com', expected 'changed-0@example.com'"],
+        ['delete by trail {} at {}'.format(Trail.objects.get(action='delete').pk, Trail.objects.get(action='delete').created),
+         'object no longer exists'],
+    ]
+
+
+def test_revert_cascade_conflict(settings, default_trails_settings, userprofile_model, rf):
+    '''
+    Test that reverting the addition of an object conflicts when deleting it would delete other objects.
+    '''
+    import uuid
+    from trails.context import trails_context
+    from trails.revert import plan_revert
+    default_trails_settings.update({'INCLUDE_MODELS': ('auth.User',), 'TRACK_NO_USER': True})
+    settings.TRAILS = default_trails_settings
+    request_uuid = uuid.uuid4()
+    with trails_context(request=rf.get('/signup/'), request_uuid=request_uuid):
+        user = User.objects.create(username='cascade')
+    plan = plan_revert(Trail.objects.for_request(request_uuid))
+    assert [(op.action, op.pk) for op in plan.operations.values()] == [('delete', user.pk)]
+    assert plan.conflicts == []
+    userprofile_model.objects.create(user=user)
+    plan = plan_revert(Trail.objects.for_request(request_uuid))
+    assert plan.conflicts[0].conflicts == ['deleting would also delete 1 test_app.UserProfile object(s)']
+
+
+def test_trails_import(settings, default_trails_settings, user_instance, group_instance, tmpdir, mocker):
+    '''
+    Test importing trails from NDJSON and CSV files, including resuming and re-running an import.
+    '''
+    from io import StringIO
+    from django.core.management.base import CommandError
+    settings.TRAILS = default_trails_settings
+    ndjson_path = tmpdir.join('audit.ndjson')
+    ndjson_path.write('\n'.join([
+        json.dumps({'action': 'add', 'created': '2015-03-01T12:00:00Z', 'user': user_instance.pk, 'data': {'source': 'legacy'},
+                    'markers': [{'model': 'auth.Group', 'pk': group_instance.pk, 'text': 'legacy group'}]}),
+        '',
+        json.dumps({'uid': 'legacy-2', 'action': 'change', 'created': '2015-03-02T12:00:00',
+                    'markers': [{'model': 'auth.Group', 'pk': group_instance.pk, 'data': {'name': ['old', 'new']}},
+                                {'model': 'auth.User', 'pk': user_instance.pk, 'rel': 'user_set'}]}),
+        json.dumps({'action': 'delete', 'created': '2015-03-03T12:00:00Z'}),
+    ]))
+    csv_path = tmpdir.join('audit.csv')
+    csv_path.write('action,created,user_text,model,pk,text,marker_data\n'
+                   'login,2016-01-01T08:00:00Z,legacy user,auth.User,{},legacy user,\n'
+                   'change,2016-01-02T08:00:00Z,,auth.Group,{},,"{{""name"": [""a"", ""b""]}}"\n'.format(user_instance.pk, group_instance.pk))
+    state_path = tmpdir.join('state.json')
+    out = StringIO()
+    call_command('trails_import', str(ndjson_path), str(csv_path), batch_size=2, state=str(state_path), stdout=out)
+    assert 'Imported 5 of 5 records' in out.getvalue()
+    assert json.loads(state_path.read()) == {str(ndjson_path): 3, str(csv_path): 2}
+    assert Trail.objects.count() == 5
+    trail = Trail.objects.get(uid='{}:1'.format(ndjson_path))
+    assert trail.created == datetime.datetime(2015, 3, 1, 12, tzinfo=timezone.utc)
+    assert (trail.action, trail.user, trail.data) == ('add', user_instance, {'source': 'legacy'})
+    marker = trail.markers.get()
+    assert (marker.obj, marker.obj_text, marker.rel) == (group_instance, 'legacy group', '')
+    trail = Trail.objects.get(uid='legacy-2')
+    assert trail.created == datetime.datetime(2015, 3, 2, 12, tzinfo=timezone.utc)
+    assert trail.markers.get(rel='user_set').obj == user_instance
+    assert Trail.objects.get(uid='{}:4'.format(ndjson_path)).markers.count() == 0
+    trail = Trail.objects.get(uid='{}:3'.format(csv_path))
+    assert trail.markers.get().data == {'name': ['a', 'b']}
+    # Resuming skips records already imported.
+    out = StringIO()
+    call_command('trails_import', str(ndjson_path), str(csv_path), state=str(state_path), stdout=out)
+    assert 'Imported 0 of 0 records' in out.getvalue()
+    # Re-running without the state skips trails that already exist.
+    out = StringIO()
+    call_command('trails_import', str(ndjson_path), str(csv_path), stdout=out)
+    assert 'Imported 0 of 5 records' in out.getvalue()
+    assert Trail.objects.count() == 5
+    assert TrailMarker.objects.count() == 5
+    bad_path = tmpdir.join('bad.ndjson')
+    bad_path.write(json.dumps({'action': 'add', 'created': 'yesterday'}))
+    with pytest.raises(CommandError) as excinfo:
+        call_command('trails_import', str(bad_path), stdout=StringIO())
+    assert str(excinfo.value) == 'bad.ndjson:1: invalid created "yesterday"'
+    # Files with the same name in another directory aren't skipped as already imported.
+    tmpdir.mkdir('other').join('audit.ndjson').write(ndjson_path.read())
+    out = StringIO()
+    call_command('trails_import', str(tmpdir.join('other', 'audit.ndjson')), stdout=out)
+    assert 'Imported 2 of 3 records' in out.getvalue()
+    # Records from stdin need a uid.
+    mocker.patch('sys.stdin', StringIO(json.dumps({'action': 'add', 'created': '2015-03-01T12:00:00Z'})))
+    with pytest.raises(CommandError) as excinfo:
+        call_command('trails_import', '-', stdout=StringIO())
+    assert str(excinfo.value) == 'stdin:1: uid is required'
+
+
+def test_registry_reload_only_replaces_changed_trackers(settings, minimal_trails_settings, allthefields_model, useremail_model):
+    '''
+    Test that reloading the registry swaps in a new snapshot, keeping trackers for unchanged models and
+    disconnecting trackers that were replaced or removed, including the user tracker.
+    '''
+    from django.contrib.auth import user_logged_in
+    from trails.registry import registry
+    minimal_trails_settings.update({
+        'INCLUDE_MODELS': ('test_app.AllTheFields', 'test_app.UserEmail', 'auth.Group'),
+        'TRACK_LOGIN': True,
+    })
+    settings.TRAILS = minimal_trails_settings
+    snapshot = registry.snapshot
+    with pytest.raises(AttributeError):
+        snapshot.user_tracker = None
+    with pytest.raises(TypeError):
+        snapshot.model_trackers[User] = None
+    user_tracker = registry.user_tracker
+    assert user_tracker.dispatch_uid_map
+    receivers = len(user_logged_in.receivers)
+    assert registry.update_from_settings() == ([], [], [])
+    assert registry.snapshot is not snapshot
+    assert dict(registry.model_trackers) == dict(snapshot.model_trackers)
+    assert registry.user_tracker is user_tracker
+    minimal_trails_settings.update({
+        'INCLUDE_MODELS': ('test_app.AllTheFields', 'test_app.UserEmail', 'auth.User'),
+        'EXCLUDE_FIELDS': ('test_app.UserEmail.email',),
+        'TRACK_LOGIN': False,
+    })
+    settings.TRAILS = minimal_trails_settings
+    assert registry.model_trackers[allthefields_model] is snapshot.model_trackers[allthefields_model]
+    assert registry.model_trackers[useremail_model] is not snapshot.model_trackers[useremail_model]
+    assert User in registry.model_trackers and Group not in registry.model_trackers
+    assert registry.user_tracker is not user_tracker
+    assert user_tracker.dispatch_uid_map == {}
+    assert len(user_logged_in.receivers) == receivers - 1
+    assert registry.update_from_settings() == ([], [], [])
+
+
+def test_spool_and_worker(settings, default_trails_settings, useremail_model, user_instance, tmpdir, mocker):
+    '''
+    Test that trails are appended to the spool instead of the database, and inserted once by the
+    trails_worker command even when records are delivered more than once, or set aside when they can't be inserted.
+    '''
+    from io import StringIO
+    from django.core.management.base import CommandError
+    from django.db import IntegrityError, connection
+    from trails import importer
+    from trails.importer import insert_batch
+    from trails.search import create_search_index
+    from trails.spool import get_spool
+    spool_path = str(tmpdir.join('spool.db'))
+    default_trails_settings.update({
+        'INCLUDE_MODELS': ('test_app.UserEmail',), 'TRACK_NO_USER': True, 'SPOOL_PATH': spool_path,
+        'FIELD_CHANGE_INDEX': True, 'SEARCH_INDEX': True,
+    })
+    settings.TRAILS = default_trails_settings
+    create_search_index(None, using='default')
+    email = useremail_model.objects.create(user=user_instance, email='first@example.com')
+    email.email = 'second@example.com'
+    email.save()
+    with pytest.raises(ValueError), transaction.atomic():
+        useremail_model.objects.create(email='rolled-back@example.com')
+        raise ValueError
+    assert Trail.objects.count() == 0
+    # Trails are only appended once the transaction is committed.
+    spool = get_spool()
+    assert spool.backlog()['records'] == 0
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for sids, func in callbacks:
+        func()
+    assert spool.backlog()['records'] == 2
+    out = StringIO()
+    call_command('trails_worker', stats=True, stdout=out)
+    assert 'trails_spool_backlog_records 2\n' in out.getvalue()
+    # A record delivered again after being inserted is skipped.
+    spool.append(spool.read(1)[0][1])
+    out = StringIO()
+    call_command('trails_worker', once=True, stdout=out)
+    assert out.getvalue() == 'Drained 3 trails from the spool.\n'
+    assert spool.backlog()['records'] == 0
+    assert list(Trail.objects.order_by('pk').values_list('action', flat=True)) == ['add', 'change']
+    trail = Trail.objects.get(action='change')
+    assert trail.data is None
+    assert trail.markers.get(rel='').obj == email
+    assert trail.markers.get(rel='').data == {'email': ['first@example.com', 'second@example.com']}
+    assert Trail.objects.get(action='add').markers.get(rel='user').obj == user_instance
+    # Spooled trails are indexed like trails recorded in the database.
+    assert trail.user_is_anonymous is False
+    assert list(Trail.objects.field_changes(useremail_model, 'email')) == [trail]
+    assert list(Trail.objects.search('second@example.com')) == [trail]
+    # A user deleted before the trail is inserted is removed from it, and records that can't be inserted are set
+    # aside instead of blocking the spool.
+    real_insert_batch = importer.insert_batch
+
+    def insert_batch_checking_users(batch, using=None):
+        if any([t['user_id'] == 999999 for t, markers in batch]):
+            raise IntegrityError('FOREIGN KEY constraint failed')
+        return real_insert_batch(batch, using=using)
+
+    mocker.patch('trails.spool.insert_batch', side_effect=insert_batch_checking_users)
+    spool.append(dict(uid='deleted-user', action='custom', created=timezone.now(), user=999999, user_text='gone'))
+    spool.append(dict(uid='unknown-model', action='custom', created=timezone.now(), markers=[dict(model='x.y', pk=1)]))
+    spool.append(dict(uid='valid', action='custom', created=timezone.now()))
+    call_command('trails_worker', once=True, stdout=StringIO())
+    assert spool.backlog()['records'] == 0
+    assert spool.backlog()['failed'] == 1
+    assert spool.read_failed(10)[0][1]['uid'] == 'unknown-model'
+    assert 'unknown model "x.y"' in spool.read_failed(10)[0][2]
+    assert set(Trail.objects.filter(action='custom').values_list('uid', 'user_id', 'user_text')) == set([
+        ('deleted-user', None, 'gone'), ('valid', None, ''),
+    ])
+    # Trails inserted by another worker after checking for existing uids are skipped.
+    mocker.patch('trails.importer._get_uid_map', side_effect=[{}, {trail.uid: trail.pk}, {trail.uid: trail.pk}])
+    record = (dict(uid=trail.uid, action='change', created=trail.created, user_id=None, data=None), [])
+    assert insert_batch([record]) == 0
+    default_trails_settings.pop('SPOOL_PATH')
+    settings.TRAILS = default_trails_settings
+    with pytest.raises(CommandError):
+        call_command('trails_worker', once=True, stdout=StringIO())
+
+
+@pytest.mark.django_db(databases=['default', 'replica'])
+def test_read_database_router(settings, default_trails_settings, useremail_model, user_instance, rf):
+    '''
+    Test that trail reads are routed to READ_DATABASE, except within read_from_primary(), after recording a
+    trail during a request, and for reads that must not be stale (rollup updates, revert plans and recent trails).
+    The replica is a separate, empty database, so trails read from it are never found.
+    '''
+    import uuid
+    from django.db import router
+    from trails.api import plan_revert, read_from_primary, trails_context
+    from trails.models import TrailRollup
+    settings.DATABASE_ROUTERS = ['trails.routers.TrailsRouter']
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.UserEmail',), 'TRACK_NO_USER': True, 'ROLLUPS': True})
+    settings.TRAILS = default_trails_settings
+    email = useremail_model.objects.create(email='first@example.com')
+    assert Trail.objects.count() == 1
+    default_trails_settings.update({'READ_DATABASE': 'replica'})
+    settings.TRAILS = default_trails_settings
+    assert Trail.objects.count() == 0
+    assert TrailMarker.objects.count() == 0
+    assert TrailRollup.objects.totals() == 0
+    assert useremail_model.objects.count() == 1
+    assert router.db_for_write(Trail) == 'default'
+    with read_from_primary():
+        assert Trail.objects.count() == 1
+    assert Trail.objects.count() == 0
+
+    @read_from_primary()
+    def count_trails():
+        return Trail.objects.count()
+
+    assert count_trails() == 1
+    request = rf.get('/')
+    request_uuid = uuid.uuid4()
+    with trails_context(request=request, request_uuid=request_uuid):
+        assert Trail.objects.count() == 0
+        email.email = 'second@example.com'
+        email.save()
+        assert Trail.objects.count() == 2
+    assert Trail.objects.count() == 0
+    # Rollups are updated from counts and trails on the primary.
+    TrailRollup.objects.increment(timezone.localdate(), None, 'custom', None)
+    assert TrailRollup.objects.update_from_trails() == 0
+    assert TrailRollup.objects.update_from_trails(rebuild=True) == 2
+    with read_from_primary():
+        assert TrailRollup.objects.totals() == 2
+    # Recent trails and revert plans read trails from the primary.
+    assert [t.action for t in Trail.objects.recent_for(email)] == ['change', 'add']
+    email.email = 'third@example.com'
+    email.save()
+    plan = plan_revert(Trail.objects.for_request(request_uuid))
+    assert [op.pk for op in plan.conflicts] == [email.pk]
+    trail = Trail.objects.using('default').get(action='add')
+    trail._state.db = 'replica'
+    assert router.db_for_write(Trail, instance=trail) == 'default'
+    assert router.allow_relation(trail, user_instance)
+    # Trails tables aren't migrated on the replica.
+    assert not router.allow_migrate_model('replica', Trail)
+    assert router.allow_migrate_model('default', Trail)
+    assert router.allow_migrate_model('replica', useremail_model)
+
+    # The primary is the database trails are written to by the other routers.
+    class PrimaryRouter(object):
+        def db_for_write(self, model, **hints):
+            return 'primary' if model._meta.app_label == 'trails' else None
+
+    settings.DATABASE_ROUTERS = ['trails.routers.TrailsRouter', PrimaryRouter()]
+    assert router.db_for_write(Trail, instance=trail) == 'primary'
+    with read_from_primary():
+        assert router.db_for_read(Trail) == 'primary'
+
+
+def test_trails_archive(settings, default_trails_settings, useremail_model, user_instance, another_user_instance, tmpdir, mocker):
+    '''
+    Test moving old trails to archive files and querying them by time range, object, action and user.
+    '''
+    from io import StringIO
+    from django.core.management.base import CommandError
+    from trails import archive
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.UserEmail',), 'TRACK_NO_USER': True, 'ARCHIVE_DIR': str(tmpdir)})
+    settings.TRAILS = default_trails_settings
+    now = timezone.now()
+    email = useremail_model.objects.create(user=user_instance, email='first@example.com')
+    email.email = 'second@example.com'
+    email.save()
+    other_email = useremail_model.objects.create(user=another_user_instance, email='other@example.com')
+    Trail.objects.update(created=now - datetime.timedelta(days=200))
+    Trail.objects.filter(action='change').update(created=now - datetime.timedelta(days=100))
+    email_pk = email.pk
+    email.delete()
+    assert Trail.objects.count() == 4
+    out = StringIO()
+    call_command('trails_archive', dry_run=True, stdout=out)
+    assert out.getvalue().startswith('Would archive 3 trails')
+    fsync_dir = mocker.spy(archive, '_fsync_dir')
+    call_command('trails_archive', batch_size=2, stdout=StringIO())
+    assert list(Trail.objects.values_list('action', flat=True)) == ['delete']
+    assert len(Trail.archive.files()) == 2
+    # The directory is synced after each file is renamed into place.
+    assert [c[0][0] for c in fsync_dir.call_args_list] == [str(tmpdir)] * 2
+    archived = list(Trail.archive.query())
+    assert [t.action for t in archived] == ['add', 'add', 'change']
+    trail = archived[2]
+    assert trail.created.replace(microsecond=0) == (now - datetime.timedelta(days=100)).replace(microsecond=0)
+    assert (trail.ctype, trail.user_id, trail.request) == ('test_app.useremail', None, '')
+    assert [(m.ctype, m.obj_pk, m.rel) for m in trail.markers] == [('test_app.useremail', str(email_pk), '')]
+    assert trail.markers[0].obj_text == 'UserEmail object ({})'.format(email_pk)
+    assert trail.markers[0].data == {'email': ['first@example.com', 'second@example.com']}
+    assert [(m.ctype, m.obj_pk, m.rel) for m in archived[0].markers] == [
+        ('test_app.useremail', str(email_pk), ''), ('auth.user', str(user_instance.pk), 'user'),
+    ]
+    start = now - datetime.timedelta(days=150)
+    assert [t.action for t in Trail.archive.query(start=start)] == ['change']
+    assert [t.action for t in Trail.archive.query(end=start)] == ['add', 'add']
+    assert [t.id for t in Trail.archive.query(obj=other_email)] == [archived[1].id]
+    assert [t.id for t in Trail.archive.query(model=User, pk=user_instance.pk)] == [archived[0].id]
+    assert [t.id for t in Trail.archive.query(model=useremail_model, pk=email_pk, end=start)] == [archived[0].id]
+    assert list(Trail.archive.query(model=useremail_model, pk=email_pk, action='delete')) == []
+    assert list(Trail.archive.query(user=user_instance)) == []
+    assert len(list(Trail.archive.query(user=None, action='add'))) == 2
+    default_trails_settings.pop('ARCHIVE_DIR')
+    settings.TRAILS = default_trails_settings
+    assert list(Trail.archive.query()) == []
+    with pytest.raises(CommandError):
+        call_command('trails_archive', stdout=StringIO())
+
+
+def test_collect_stats(settings, default_trails_settings, allthefields_model):
+    '''
+    Test that stats collected for a block of code include trails recorded, and queries and time spent in trackers,
+    pipeline functions and serialization.
+    '''
+    from trails.stats import collect_stats, get_stats
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.AllTheFields',), 'TRACK_NO_USER': True})
+    settings.TRAILS = default_trails_settings
+    assert get_stats() is None
+    with collect_stats() as stats:
+        instance = allthefields_model.objects.create()
+        instance.char_val = 'stats'
+        instance.save()
+    assert get_stats() is None
+    assert stats.trails == [('add', 'test_app.AllTheFields'), ('change', 'test_app.AllTheFields')]
+    timings = dict([((t['category'], t['name']), t) for t in stats.get_timings()])
+    assert timings[('tracker', 'on_post_save')]['calls'] == 2
+    assert timings[('tracker', 'on_pre_save')]['calls'] == 2
+    assert timings[('pipeline', 'create_database_trail')]['queries'] == 2
+    assert timings[('pipeline', 'create_primary_database_trail_marker')]['queries'] >= 2
+    assert timings[('serialize', 'serialize_instance')]['calls'] == 4
+    assert timings[('serialize', 'serialize_instance')]['queries'] == 1
+    assert stats.query_count == sum([t['queries'] for t in timings.values()])
+    assert stats.total_time > 0
+    data = stats.as_dict()
+    assert data['trail_count'] == 2
+    assert data['query_count'] == stats.query_count
+
+
+def test_trails_panel(rf):
+    pytest.importorskip('debug_toolbar')
+    from debug_toolbar.toolbar import DebugToolbar
+    from trails.panels import TrailsPanel
+    request = rf.get('/')
+    panel = TrailsPanel(DebugToolbar(request, lambda r: None), lambda r: None)
+    panel.enable_instrumentation()
+    panel.disable_instrumentation()
+    panel.generate_stats(request, None)
+    assert panel.get_stats()['trail_count'] == 0
+    assert panel.nav_subtitle
+
+
+def test_pipeline_metrics(settings, default_trails_settings, allthefields_model, user_instance, rf):
+    '''
+    Test counters and latency histograms kept for the pipeline, and exporting them in the Prometheus text format.
+    '''
+    from io import StringIO
+    from trails.metrics import collect_metrics
+    from trails.views import metrics
+    default_trails_settings.update({'INCLUDE_MODELS': ('test_app.AllTheFields',), 'METRICS': True})
+    settings.TRAILS = default_trails_settings
+    allthefields_model.objects.create()
+    with impersonate(user_instance):
+        allthefields_model.objects.create()
+    totals = collect_metrics()
+    assert totals[('trails_dropped_total', (('stage', 'check_no_user'),))] == 1
+    assert totals[('trails_recorded_total', (('action', 'add'), ('model', 'test_app.AllTheFields')))] == 1
+    assert totals[('trails_pipeline_stage_seconds_count', (('stage', 'check_no_user'),))] == 2
+    assert totals[('trails_pipeline_stage_seconds_count', (('stage', 'create_database_trail'),))] == 1
+    response = metrics(rf.get('/metrics/'))
+    assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+    content = force_text(response.content)
+    assert '# TYPE trails_pipeline_stage_seconds histogram' in content
+    assert 'trails_pipeline_stage_seconds_bucket{stage="create_database_trail",le="+Inf"} 1' in content
+    assert 'trails_pipeline_stage_seconds_count{stage="check_no_user"} 2' in content
+    assert 'trails_dropped_total{stage="check_no_user"} 1' in content
+    assert 'trails_recorded_total{action="add",model="test_app.AllTheFields"} 1' in content
+    out = StringIO()
+    call_command('trails_metrics', stdout=out)
+    assert out.getvalue() == content
+
+
+def test_pipeline_metrics_across_processes(settings, default_trails_settings, tmpdir):
+    '''
+    Test that metrics written by each process to a shared directory are aggregated.
+    '''
+    from io import StringIO
+    from trails.metrics import collect_metrics, get_metrics
+    default_trails_settings.update({'METRICS': True, 'METRICS_DIR': str(tmpdir)})
+    settings.TRAILS = default_trails_settings
+    get_metrics().inc_recorded('add', 'test_app.AllTheFields')
+    # Write enough distinct keys to grow the file past its initial size.
+    for n in range(2000):
+        get_metrics().inc_dropped('stage{}'.format(n))
+    pids = []
+    for n in range(3):
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                for x in range(1000):
+                    get_metrics().inc_recorded('add', 'test_app.AllTheFields{}'.format(x % 2 or ''))
+                get_metrics().observe_stage('create_database_trail', 0.002)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    assert len(tmpdir.listdir()) == 4
+    totals = collect_metrics()
+    assert totals[('trails_recorded_total', (('action', 'add'), ('model', 'test_app.AllTheFields')))] == 1501
+    assert totals[('trails_recorded_total', (('action', 'add'), ('model', 'test_app.AllTheFields1')))] == 1500
+    assert totals[('trails_pipeline_stage_seconds_bucket', (('stage', 'create_database_trail'), ('le', '0.0025')))] == 3
+    assert totals[('trails_dropped_total', (('stage', 'stage1999'),))] == 1
+    call_command('trails_metrics', '--clear', stdout=StringIO())
+    assert tmpdir.listdir() == []
+
+
+def test_m2m_add_bulk(settings, default_trails_settings, group_instance, django_user_model, django_assert_max_num_queries):
+    '''
+    Test that adding many objects to a many to many relation loads only display text in chunks and bulk inserts markers.
+    '''
+    default_trails_settings.update({'TRACK_NO_USER': True, 'BULK_BATCH_SIZE': 1000})
+    settings.TRAILS = default_trails_settings
+    django_user_model.objects.bulk_create([django_user_model(username='bulk{}'.format(n)) for n in range(2500)])
+    users = list(django_user_model.objects.filter(username__startswith='bulk'))
+    Trail.objects.all().delete()
+    # SQLite limits the number of rows in each insert, but queries should still be far fewer than one per object.
+    with django_assert_max_num_queries(50):
+        group_instance.user_set.add(*users)
+    trail = Trail.objects.get(action='associate')
+    assert trail.data is None
+    markers = trail.markers.all()
+    assert markers.count() == 2501
+    assert markers.filter(rel='groups').count() == 2500
+    assert set(markers.filter(rel='groups').values_list('obj_text', flat=True)) == set([u.username for u in users])
+    assert markers.get(rel='user_set').obj_pk == str(group_instance.pk)
+    with django_assert_max_num_queries(50):
+        group_instance.user_set.remove(*users)
+    assert Trail.objects.get(action='disassociate').markers.count() == 2501
+
+
+def test_m2m_add_summary(settings, default_trails_settings, group_instance, django_user_model):
+    '''
+    Test that adding more objects than M2M_SUMMARY_THRESHOLD records a summary with the count and sampled pks.
+    '''
+    default_trails_settings.update({'TRACK_NO_USER': True, 'M2M_SUMMARY_THRESHOLD': 5, 'M2M_SUMMARY_SAMPLE_SIZE': 3})
+    settings.TRAILS = default_trails_settings
+    users = [django_user_model.objects.create(username='summary{}'.format(n)) for n in range(20)]
+    group_instance.user_set.add(*users)
+    trail = Trail.objects.get(action='associate')
+    pks = sorted([u.pk for u in users])
+    assert trail.data == {'rel': 'groups', 'model': 'auth.User', 'count': 20, 'sample_pks': [pks[0], pks[7], pks[14]]}
+    assert sorted(map(int, trail.markers.filter(rel='groups').values_list('obj_pk', flat=True))) == trail.data['sample_pks']
+    Trail.objects.all().delete()
+    group_instance.user_set.remove(*users[:5])
+    trail = Trail.objects.get(action='disassociate')
+    assert trail.data is None
+    assert trail.markers.filter(rel='groups').count() == 5
+
+
+def test_m2m_clear_streamed(settings, default_trails_settings, group_instance, django_user_model, django_assert_max_num_queries):
+    '''
+    Test that clearing a large many to many relation records markers for every related object, streamed in chunks.
+    '''
+    default_trails_settings.update({'TRACK_NO_USER': True, 'BULK_BATCH_SIZE': 500})
+    settings.TRAILS = default_trails_settings
+    django_user_model.objects.bulk_create([django_user_model(username='clear{}'.format(n)) for n in range(1200)])
+    users = list(django_user_model.objects.filter(username__startswith='clear'))
+    group_instance.user_set.add(*users)
+    Trail.objects.all().delete()
+    with django_assert_max_num_queries(50):
+        group_instance.user_set.clear()
+    assert group_instance.user_set.count() == 0
+    trail = Trail.objects.get(action='disassociate')
+    assert trail.markers.count() == 1201
+    assert set(trail.markers.filter(rel='groups').values_list('obj_text', flat=True)) == set([u.username for u in users])
+    Trail.objects.all().delete()
+    group_instance.user_set.clear()
+    assert Trail.objects.get(action='disassociate').markers.count() == 1
+    # Clearing a relation with more objects than M2M_SUMMARY_THRESHOLD records a summary.
+    default_trails_settings.update({'M2M_SUMMARY_THRESHOLD': 100, 'M2M_SUMMARY_SAMPLE_SIZE': 4})
+    settings.TRAILS = default_trails_settings
+    group_instance.user_set.add(*users)
+    Trail.objects.all().delete()
+    group_instance.user_set.clear()
+    trail = Trail.objects.get(action='disassociate')
+    pks = sorted([u.pk for u in users])
+    assert trail.data == {'rel': 'groups', 'model': 'auth.User', 'count': 1200, 'sample_pks': pks[::300]}
+    assert trail.markers.count() == 5
+
+
+def test_local_context_var():
+    '''
+    Test the thread-local substitute for context variables used without contextvars (Python < 3.7).
+    '''
+    import threading
+    from trails.context import LocalContextVar
+    var = LocalContextVar('test', default=None)
+    token = var.set('outer')
+    inner_token = var.set('inner')
+    values = []
+    thread = threading.Thread(target=lambda: values.append(var.get()))
+    thread.start()
+    thread.join()
+    assert (var.get(), values) == ('inner', [None])
+    var.reset(inner_token)
+    assert var.get() == 'outer'
+    var.reset(token)
+    assert var.get() is None
+
+
+async def async_pipeline_stage(**kwargs):
+    return dict(data=dict(kwargs.get('data') or {}, async_stage=True))
+
+
+def test_arecord_trail(settings, default_trails_settings, allthefields_model, user_instance, rf):
+    '''
+    Test recording a trail from async code, with the request, user and request UUID from the current context and async pipeline
+    stages awaited between the sync ones.
+    '''
+    import uuid
+    async_to_sync = pytest.importorskip('asgiref.sync').async_to_sync
+    from trails.aio import arecord_trail
+    from trails.api import trails_context
+    from trails.stats import collect_stats
+    pipeline = list(default_trails_settings['PIPELINE'])
+    pipeline.insert(pipeline.index('trails.pipeline.create_database_trail'), 'test_project.test_app.tests.async_pipeline_stage')
+    default_trails_settings.update({'PIPELINE': pipeline})
+    settings.TRAILS = default_trails_settings
+    instance = allthefields_model.objects.create()
+    request = rf.get('/async/')
+    request_uuid = uuid.uuid4()
+
+    async def view():
+        with trails_context(request=request, user=user_instance, request_uuid=request_uuid):
+            await arecord_trail('custom', instance=instance, data={'async': True})
+
+    with collect_stats() as stats:
+        async_to_sync(view)()
+    trail = Trail.objects.get(action='custom')
+    assert trail.user == user_instance
+    assert trail.request == '[{}] GET /async/'.format(request_uuid)
+    assert trail.data == {'async': True, 'async_stage': True}
+    assert trail.markers.get(rel='').obj_pk == str(instance.pk)
+    assert stats.trails == [('custom', 'test_app.AllTheFields')]
+    # The context is only set within the block.
+    async_to_sync(arecord_trail)('custom', instance=instance)
+    assert Trail.objects.filter(action='custom').count() == 1
+
+
 def test_m2m(user_instance, group_instance, another_user_instance, another_group_instance):
     user_instance.groups.remove(group_instance)
     another_group_instance.user_set.remove(another_user_instance)
@@ -1007,8 +2297,7 @@ def test_trails_manager():
     trails = Trail.objects.for_models(*instances)
     self.assertTrue(trails.count())
     for trail in trails:
-        self.assertTrue(trail.content_object in instances[0] or
-                        trail.content_object in instances[1])
+        self.assertTrue(any([trail.content_object in queryset for queryset in instances]))
 
 
 @pytest.mark.xfail(raises=NotImplementedError)
@@ -1056,8 +2345,7 @@ def test_trails_render():
 def test_trails_admin():
     raise NotImplementedError
     app_label = Trail._meta.app_label
-    model_name = (getattr(Trail._meta, 'model_name', None) or
-                  getattr(Trail._meta, 'module_name', None))
+    model_name = getattr(Trail._meta, 'model_name', None) or getattr(Trail._meta, 'module_name', None)
     self.assertTrue(model_name)
     self.client.login(username=self.superuser.username,
                       password=self.superuser_password)
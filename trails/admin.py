@@ -8,6 +8,7 @@ from django.utils.translation import ugettext_lazy as _
 
 # Django-Trails
 from .models import Trail, TrailMarker
+from .search import search_trails
 from .settings import trails_settings
 
 
@@ -29,7 +30,7 @@ class TrailMarkerInline(admin.StackedInline):
     get_obj_display.short_description = _('Object')
 
     def get_data_display(self, obj):
-        json_data = json.dumps(obj.data, indent=4)
+        json_data = json.dumps(obj.data_display, indent=4)
         return format_html('<pre style="display: inline-block; margin: 0; padding: 0; font-size: 0.9em;">{}</pre>', json_data)
     get_data_display.short_description = _('Data')
     get_data_display.allow_tags = True
@@ -40,12 +41,13 @@ class TrailAdmin(admin.ModelAdmin):
     list_display = ('created', 'get_user_display', 'get_action_display',
                     'get_ctypes_display', 'get_markers_display')
     list_filter = ('user', 'action', 'markers__ctype')
-    fields = ('created', 'request', 'session', 'get_user_display',
+    fields = ('created', 'get_request_display', 'get_session_display', 'get_user_display',
               'get_action_display', 'get_ctypes_display', 'get_markers_display',
               'get_data_display')
     readonly_fields = fields
     inlines = [TrailMarkerInline]
     date_hierarchy = 'created'
+    search_fields = ('user_text', 'markers__obj_text')
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
@@ -53,9 +55,22 @@ class TrailAdmin(admin.ModelAdmin):
         qs = qs.prefetch_related('markers', 'markers__ctype')
         return qs
 
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+        return search_trails(queryset, search_term), False
+
     def has_add_permission(self, request):
         return False
 
+    def get_request_display(self, obj):
+        return obj.request_display
+    get_request_display.short_description = _('Request')
+
+    def get_session_display(self, obj):
+        return obj.session_display
+    get_session_display.short_description = _('Session')
+
     def get_user_display(self, obj):
         return obj.user_display
     get_user_display.short_description = _('User')
@@ -0,0 +1,69 @@
+# Python
+import asyncio
+import time
+
+# ASGI
+from asgiref.sync import sync_to_async
+
+# Django-Trails
+from .metrics import get_metrics
+from .pipeline import complete_pipeline, run_pipeline_functions, update_pipeline_kwargs
+from .settings import trails_settings
+from .utils import log_trace
+
+__all__ = ['arun_pipeline', 'arecord_trail']
+
+# Async helpers need asgiref (the "async" extra) and Python 3.5+, so they are
+# kept out of the pipeline, utils and api modules, which are imported on every
+# code path; import arecord_trail from trails.aio.
+
+
+async def arun_pipeline(**kwargs):
+    '''
+    Run pipeline functions in order from async code. Coroutine functions are
+    awaited directly; consecutive sync functions are run together in the
+    thread-sensitive executor, so database writes don't block the event loop.
+    '''
+    metrics = get_metrics()
+    sync_functions = []
+    for pipeline_function in list(trails_settings.PIPELINE) + [None]:
+        if pipeline_function is not None and not asyncio.iscoroutinefunction(pipeline_function):
+            sync_functions.append(pipeline_function)
+            continue
+        if sync_functions:
+            run_functions = sync_to_async(run_pipeline_functions, thread_sensitive=True)
+            if not await run_functions(sync_functions, kwargs):
+                return
+            sync_functions = []
+        if pipeline_function is None:
+            break
+        log_trace('running pipeline function: %r(**%r)', pipeline_function, kwargs)
+        start = time.perf_counter()
+        result = await pipeline_function(**kwargs)
+        if metrics is not None:
+            metrics.observe_stage(pipeline_function.__name__, time.perf_counter() - start)
+        if not update_pipeline_kwargs(pipeline_function, result, kwargs, metrics):
+            return
+    complete_pipeline(kwargs)
+
+
+async def arecord_trail(action, request=None, session=None, user=None, user_text=None,
+                        data=None, instance=None, instance_text=None,
+                        instance_data=None, related_instances=None, related_pks=None):
+    '''
+    Record an action taken against a model instance from async code, without
+    blocking the event loop.
+    '''
+    await arun_pipeline(
+        action=action,
+        request=request,
+        session=session,
+        user=user,
+        user_text=user_text,
+        data=data,
+        instance=instance,
+        instance_text=instance_text,
+        instance_data=instance_data,
+        related_instances=related_instances,
+        related_pks=related_pks,
+    )
@@ -1,4 +1,6 @@
 # Public API for trails.
 
 from .utils import record_trail  # noqa
+from .context import read_from_primary, trails_context  # noqa
 from .models import Trail  # noqa
+from .revert import plan_revert, revert_trails  # noqa
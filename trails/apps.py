@@ -1,5 +1,6 @@
 # Django
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -10,5 +11,7 @@ class TrailsConfig(AppConfig):
 
     def ready(self):
         from .registry import registry
+        from .search import create_search_index
         registry.update_from_settings()
+        post_migrate.connect(create_search_index, sender=self)
         # FIXME: Check that CRUM middleware is installed?
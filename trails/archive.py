@@ -0,0 +1,420 @@
+# Python
+import array
+import bisect
+import collections
+import datetime
+import glob
+import heapq
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+# Django
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.encoding import smart_text
+
+# Django-Trails
+from .settings import trails_settings
+from .utils import iter_queryset_chunks
+
+__all__ = ['ArchivedTrail', 'ArchivedMarker', 'ArchiveFile', 'TrailArchive', 'archive_trails']
+
+# Identifies an archive file and its format version.
+MAGIC = b'TRAILARC\x01\x00\x00\x00'
+
+# Length of the JSON header following the magic bytes.
+HEADER_LENGTH = struct.Struct('<I')
+
+# Code used in the content type column for trails without a marker.
+NO_CODE = 0xFFFFFFFF
+
+# Number of trails to look up markers and delete for in each query.
+ID_CHUNK_SIZE = 500
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _to_micros(dt):
+    if timezone.is_aware(dt):
+        dt = timezone.make_naive(dt, timezone.utc)
+    return (dt - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _from_micros(micros):
+    dt = EPOCH + datetime.timedelta(microseconds=micros)
+    if settings.USE_TZ:
+        dt = timezone.make_aware(dt, timezone.utc)
+    return dt
+
+
+class ArchivedMarker(object):
+    '''
+    Trail marker read from an archive file.
+    '''
+
+    __slots__ = ('ctype', 'obj_pk', 'rel', 'obj_text', 'data')
+
+    def __init__(self, ctype, obj_pk, rel, obj_text, data):
+        self.ctype = ctype
+        self.obj_pk = obj_pk
+        self.rel = rel
+        self.obj_text = obj_text
+        self.data = data
+
+    def __repr__(self):
+        return '<ArchivedMarker: {} {}>'.format(self.ctype, self.obj_pk)
+
+
+class ArchivedTrail(object):
+    '''
+    Trail read from an archive file, with the fields of the original trail and
+    its markers; ctype is the "app_label.model" label of the first marker.
+    '''
+
+    __slots__ = ('id', 'uid', 'created', 'action', 'user_id', 'user_text', 'user_is_anonymous',
+                 'request', 'session', 'data', 'ctype', 'markers')
+
+    def __init__(self, **kwargs):
+        for attr in self.__slots__:
+            setattr(self, attr, kwargs.get(attr))
+
+    def __repr__(self):
+        return '<ArchivedTrail: {} {} {}>'.format(self.id, self.action, self.created)
+
+
+class _ColumnWriter(object):
+
+    def __init__(self):
+        self.columns = []
+
+    def add(self, name, typecode, values):
+        data = array.array(typecode, values)
+        if sys.byteorder != 'little':
+            data.byteswap()
+        self.columns.append((name, typecode, data.tobytes()))
+
+    def add_bytes(self, name, chunks):
+        offsets = [0]
+        for chunk in chunks:
+            offsets.append(offsets[-1] + len(chunk))
+        self.add('{}_offsets'.format(name), 'Q', offsets)
+        self.columns.append((name, 'B', b''.join(chunks)))
+
+    def write(self, f, header):
+        # Column offsets are relative to the start of the data, which follows
+        # the header; columns are aligned to 8 bytes so they can be cast from
+        # the mmap.
+        layout = {}
+        offset = 0
+        for name, typecode, data in self.columns:
+            layout[name] = [offset, len(data), typecode]
+            offset += len(data) + (-len(data) % 8)
+        header_data = json.dumps(dict(header, columns=layout)).encode('utf-8')
+        f.write(MAGIC)
+        f.write(HEADER_LENGTH.pack(len(header_data)))
+        f.write(header_data)
+        f.write(b'\0' * (-(len(MAGIC) + HEADER_LENGTH.size + len(header_data)) % 8))
+        for name, typecode, data in self.columns:
+            f.write(data)
+            f.write(b'\0' * (-len(data) % 8))
+
+
+def _dictionary(values):
+    # Codes are assigned in order of first use, which the header lists follow.
+    codes = collections.OrderedDict()
+    for value in values:
+        codes.setdefault(value, len(codes))
+    return codes
+
+
+def _fsync_dir(path):
+    # Make a rename durable; directories can't be opened on Windows.
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_archive_file(path, trails, markers):
+    '''
+    Write trails (dictionaries sorted by created) and their markers (lists of
+    dictionaries for each trail id) to a columnar archive file.
+    '''
+    actions = _dictionary([t['action'] for t in trails])
+    users = _dictionary([(t['user_id'], t['user_text']) for t in trails])
+    ctypes = _dictionary([m['ctype'] for t in trails for m in markers.get(t['id'], [])])
+    writer = _ColumnWriter()
+    writer.add('id', 'q', [t['id'] for t in trails])
+    writer.add('created', 'q', [_to_micros(t['created']) for t in trails])
+    writer.add('action', 'I', [actions[t['action']] for t in trails])
+    writer.add('user', 'I', [users[(t['user_id'], t['user_text'])] for t in trails])
+    writer.add('ctype', 'I', [
+        ctypes[markers[t['id']][0]['ctype']] if markers.get(t['id']) else NO_CODE for t in trails
+    ])
+    marker_rows, marker_ctypes, marker_pks, payloads = [], [], [], []
+    for row, trail in enumerate(trails):
+        trail_markers = markers.get(trail['id'], [])
+        for marker in trail_markers:
+            marker_rows.append(row)
+            marker_ctypes.append(ctypes[marker['ctype']])
+            marker_pks.append(smart_text(marker['obj_pk']).encode('utf-8'))
+        payload = dict([(k, trail[k]) for k in ('uid', 'user_is_anonymous', 'request', 'session', 'data')])
+        payload['markers'] = [[m['rel'], m['obj_text'], m['data']] for m in trail_markers]
+        payloads.append(zlib.compress(json.dumps(payload, cls=trails_settings.JSON_ENCODER).encode('utf-8')))
+    writer.add('marker_row', 'I', marker_rows)
+    writer.add('marker_ctype', 'I', marker_ctypes)
+    writer.add_bytes('marker_pk', marker_pks)
+    writer.add_bytes('payload', payloads)
+    header = dict(
+        rows=len(trails),
+        min_created=_to_micros(trails[0]['created']),
+        max_created=_to_micros(trails[-1]['created']),
+        actions=list(actions.keys()),
+        users=[list(user) for user in users.keys()],
+        ctypes=list(ctypes.keys()),
+    )
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as f:
+        writer.write(f, header)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+class ArchiveFile(object):
+    '''
+    Memory-mapped archive file. Columns are read as views of the mapping, so
+    only the pages needed by a query are loaded.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise ValueError('{} is not a trails archive file'.format(path))
+        length = HEADER_LENGTH.unpack_from(self._mmap, len(MAGIC))[0]
+        start = len(MAGIC) + HEADER_LENGTH.size
+        self.header = json.loads(self._mmap[start:start + length].decode('utf-8'))
+        self._data_start = start + length + (-(start + length) % 8)
+        self._columns = {}
+        self._views = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._columns = {}
+        while self._views:
+            self._views.pop().release()
+        self._mmap.close()
+
+    def column(self, name):
+        if name in self._columns:
+            return self._columns[name]
+        offset, length, typecode = self.header['columns'][name]
+        offset += self._data_start
+        view = memoryview(self._mmap)[offset:offset + length]
+        self._views.append(view)
+        if typecode == 'B':
+            column = view
+        elif sys.byteorder != 'little':
+            column = array.array(typecode, view)
+            column.byteswap()
+        else:
+            column = view.cast(typecode)
+            self._views.append(column)
+        self._columns[name] = column
+        return column
+
+    def _get_bytes(self, name, offsets, n):
+        return self.column(name)[offsets[n]:offsets[n + 1]]
+
+    def query(self, start=None, end=None, ctype=None, obj_pk=None, action=None, user_id=None):
+        '''
+        Yield archived trails created in [start, end) matching the filters.
+        '''
+        header = self.header
+        if start is not None and _to_micros(start) > header['max_created']:
+            return
+        if end is not None and _to_micros(end) <= header['min_created']:
+            return
+        action_code = user_codes = ctype_code = None
+        if action is not None:
+            if action not in header['actions']:
+                return
+            action_code = header['actions'].index(action)
+        if user_id is not None:
+            user_codes = set([n for n, user in enumerate(header['users']) if user[0] == user_id])
+            if not user_codes:
+                return
+        if ctype is not None:
+            if ctype not in header['ctypes']:
+                return
+            ctype_code = header['ctypes'].index(ctype)
+        created = self.column('created')
+        lo = bisect.bisect_left(created, _to_micros(start)) if start is not None else 0
+        hi = bisect.bisect_left(created, _to_micros(end)) if end is not None else len(created)
+        marker_rows = self.column('marker_row')
+        rows = range(lo, hi)
+        if ctype_code is not None:
+            # Only scan markers for trails within the time range.
+            marker_ctypes = self.column('marker_ctype')
+            marker_pk_offsets = self.column('marker_pk_offsets')
+            pk_bytes = smart_text(obj_pk).encode('utf-8') if obj_pk is not None else None
+            matched = set()
+            for n in range(bisect.bisect_left(marker_rows, lo), bisect.bisect_left(marker_rows, hi)):
+                if marker_ctypes[n] != ctype_code:
+                    continue
+                if pk_bytes is None or self._get_bytes('marker_pk', marker_pk_offsets, n) == pk_bytes:
+                    matched.add(marker_rows[n])
+            rows = sorted(matched)
+        actions = self.column('action')
+        users = self.column('user')
+        for row in rows:
+            if action_code is not None and actions[row] != action_code:
+                continue
+            if user_codes is not None and users[row] not in user_codes:
+                continue
+            yield self.get_trail(row)
+
+    def get_trail(self, row):
+        header = self.header
+        payload_offsets = self.column('payload_offsets')
+        payload = json.loads(zlib.decompress(self._get_bytes('payload', payload_offsets, row)).decode('utf-8'))
+        marker_rows = self.column('marker_row')
+        marker_ctypes = self.column('marker_ctype')
+        marker_pk_offsets = self.column('marker_pk_offsets')
+        first = bisect.bisect_left(marker_rows, row)
+        markers = []
+        for n, (rel, obj_text, data) in enumerate(payload['markers'], first):
+            markers.append(ArchivedMarker(
+                ctype=header['ctypes'][marker_ctypes[n]],
+                obj_pk=bytes(self._get_bytes('marker_pk', marker_pk_offsets, n)).decode('utf-8'),
+                rel=rel,
+                obj_text=obj_text,
+                data=data,
+            ))
+        ctype_code = self.column('ctype')[row]
+        user_id, user_text = header['users'][self.column('user')[row]]
+        return ArchivedTrail(
+            id=self.column('id')[row],
+            uid=payload['uid'],
+            created=_from_micros(self.column('created')[row]),
+            action=header['actions'][self.column('action')[row]],
+            user_id=user_id,
+            user_text=user_text,
+            user_is_anonymous=payload['user_is_anonymous'],
+            request=payload['request'],
+            session=payload['session'],
+            data=payload['data'],
+            ctype=header['ctypes'][ctype_code] if ctype_code != NO_CODE else None,
+            markers=markers,
+        )
+
+
+class TrailArchive(object):
+    '''
+    Reader for trails moved to archive files in ARCHIVE_DIR, available as
+    Trail.archive.
+    '''
+
+    def __init__(self, path=None):
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path or trails_settings.ARCHIVE_DIR
+
+    def files(self):
+        if not self.path:
+            return []
+        return sorted(glob.glob(os.path.join(self.path, 'trails-*.arc')))
+
+    def query(self, start=None, end=None, obj=None, model=None, pk=None, action=None, user=None):
+        '''
+        Yield archived trails created in [start, end) ordered by time,
+        optionally only those with a marker for a model instance (or model
+        class and pk), with an action or by a user. Files and rows outside the
+        time range are not read.
+        '''
+        if obj is not None:
+            model, pk = obj.__class__, obj.pk
+        ctype = model._meta.label_lower if model is not None else None
+        user_id = getattr(user, 'pk', user)
+
+        def query_file(path):
+            with ArchiveFile(path) as archive_file:
+                for trail in archive_file.query(start, end, ctype, pk, action, user_id):
+                    yield trail
+
+        # Time ranges of files may overlap, so merge trails from each file.
+        queries = [query_file(path) for path in self.files()]
+        for trail in heapq.merge(*queries, key=lambda t: (t.created, t.id)):
+            yield trail
+
+
+def _get_text(text, text_ref_id):
+    from .models import TrailText
+    return text or TrailText.objects.get_text(text_ref_id)
+
+
+def archive_trails(queryset, path, batch_size=50000, delete=True, callback=None):
+    '''
+    Write trails from a queryset to archive files in the given directory, one
+    file for each batch, then delete them from the database. Each batch is
+    only deleted once its file has been written. Return the number archived.
+    '''
+    from .models import TrailMarker
+    os.makedirs(path, exist_ok=True)
+    total = 0
+    for chunk in iter_queryset_chunks(queryset, batch_size):
+        trails = []
+        for trail in sorted(chunk, key=lambda t: (t.created, t.pk)):
+            trails.append(dict(
+                id=trail.pk,
+                uid=trail.uid,
+                created=trail.created,
+                action=trail.action,
+                user_id=trail.user_id,
+                user_text=_get_text(trail.user_text, trail.user_text_ref_id),
+                user_is_anonymous=trail.user_is_anonymous,
+                request=_get_text(trail.request, trail.request_ref_id),
+                session=_get_text(trail.session, trail.session_ref_id),
+                data=trail.data,
+            ))
+        ids = [trail['id'] for trail in trails]
+        markers = {}
+        for n in range(0, len(ids), ID_CHUNK_SIZE):
+            trail_markers = TrailMarker.objects.using(queryset.db).filter(trail_id__in=ids[n:n + ID_CHUNK_SIZE])
+            for marker in trail_markers.select_related('ctype').order_by('trail_id', 'pk'):
+                markers.setdefault(marker.trail_id, []).append(dict(
+                    ctype='{}.{}'.format(marker.ctype.app_label, marker.ctype.model),
+                    obj_pk=marker.obj_pk,
+                    rel=marker.rel,
+                    obj_text=_get_text(marker.obj_text, marker.obj_text_ref_id),
+                    data=marker.data,
+                ))
+        file_path = os.path.join(path, 'trails-{:%Y%m%d%H%M%S}-{}.arc'.format(trails[0]['created'], trails[0]['id']))
+        write_archive_file(file_path, trails, markers)
+        if delete:
+            with transaction.atomic(using=queryset.db):
+                for n in range(0, len(ids), ID_CHUNK_SIZE):
+                    queryset.model._default_manager.using(queryset.db).filter(pk__in=ids[n:n + ID_CHUNK_SIZE]).delete()
+        total += len(trails)
+        if callback:
+            callback(total, file_path)
+    return total
@@ -0,0 +1,131 @@
+# Python
+import contextlib
+import threading
+
+try:
+    import contextvars
+except ImportError:  # Python < 3.7
+    contextvars = None
+
+# Django-CRUM
+import crum
+
+__all__ = ['trails_context', 'read_from_primary', 'get_current_request', 'get_current_user', 'get_current_request_uuid',
+           'get_read_primary']
+
+
+class LocalContextVar(object):
+    '''
+    Thread-local substitute for contextvars.ContextVar on Python < 3.7, where
+    values are not propagated to async tasks.
+    '''
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self.default)
+
+    def set(self, value):
+        token = (self.get(),)
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token[0]
+
+
+def context_var(name, default=None):
+    '''
+    Return a context variable, or a thread-local one without contextvars.
+    '''
+    if contextvars is None:
+        return LocalContextVar(name, default=default)
+    return contextvars.ContextVar(name, default=default)
+
+
+# Request, user and request UUID for the current context, propagated to async
+# tasks and sync_to_async calls, unlike the thread-locals used by CRUM.
+_request = context_var('trails_request')
+_user = context_var('trails_user')
+_request_uuid = context_var('trails_request_uuid')
+
+# Whether trail reads in the current context should use the primary database
+# instead of READ_DATABASE.
+_read_primary = context_var('trails_read_primary', default=False)
+
+
+def get_current_request():
+    '''
+    Return the request for the current context, falling back to CRUM.
+    '''
+    return _request.get() or crum.get_current_request()
+
+
+def get_current_user():
+    '''
+    Return the user for the current context, falling back to CRUM.
+    '''
+    return _user.get() or crum.get_current_user()
+
+
+def get_current_request_uuid():
+    '''
+    Return the request UUID for the current context, if any.
+    '''
+    return _request_uuid.get()
+
+
+def get_read_primary():
+    '''
+    Return True if trails should be read from the primary database in the
+    current context, either within read_from_primary() or during a request
+    that has already recorded trails (when READ_PRIMARY_AFTER_WRITE is set).
+    '''
+    if _read_primary.get():
+        return True
+    request = get_current_request()
+    return bool(request is not None and getattr(request, 'trails_read_primary', False))
+
+
+@contextlib.contextmanager
+def trails_context(request=None, user=None, request_uuid=None):
+    '''
+    Set the request, user and/or request UUID used when recording trails
+    within a block of code, e.g. from an async view or middleware:
+
+        async def view(request):
+            with trails_context(request=request, user=await get_user(request)):
+                await arecord_trail('view', instance=obj)
+
+    Without contextvars (Python < 3.7), values are only set for the current
+    thread.
+    '''
+    tokens = []
+    for var, value in ((_request, request), (_user, user), (_request_uuid, request_uuid)):
+        if value is not None:
+            tokens.append((var, var.set(value)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+@contextlib.contextmanager
+def read_from_primary():
+    '''
+    Read trails from the primary database instead of READ_DATABASE within a
+    block of code (or a function, when used as a decorator), for reads that
+    must see trails just written, e.g. in tests:
+
+        with read_from_primary():
+            trails = Trail.objects.for_models(obj)
+    '''
+    token = _read_primary.set(True)
+    try:
+        yield
+    finally:
+        _read_primary.reset(token)
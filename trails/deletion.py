@@ -0,0 +1,137 @@
+# Python
+import functools
+
+# Django
+from django.db.models import QuerySet
+from django.db.models.deletion import Collector
+
+# Django-Trails
+from .context import context_var
+from .settings import trails_settings
+
+__all__ = ['install', 'uninstall', 'get_delete_group']
+
+# Groups for the delete() calls currently running in this context, innermost
+# last.
+_delete_groups = context_var('trails_delete_groups', default=())
+
+# Original Collector methods while the wrappers are installed.
+_originals = {}
+
+
+class DeleteGroup(object):
+    '''
+    All deletions triggered by a single call to delete(), to be recorded
+    together as one trail once the last tracked instance has been deleted.
+    '''
+
+    def __init__(self, roots):
+        self.roots = roots
+        self.pending = 0
+        self.texts = {}
+        self.deleted = []
+
+    def __repr__(self):
+        return '<DeleteGroup: {} deleted, {} pending>'.format(len(self.deleted), self.pending)
+
+    def pre_delete(self, instance, instance_text):
+        self.pending += 1
+        self.texts[id(instance)] = instance_text
+
+    def post_delete(self, instance):
+        '''
+        Return the arguments for recording the trail once the last instance in
+        the group has been deleted, otherwise None.
+        '''
+        instance_text = self.texts.pop(id(instance), None)
+        if instance_text is None:
+            return
+        self.deleted.append((instance, instance_text))
+        self.pending -= 1
+        # Django sends pre_delete for every collected instance before sending
+        # any post_delete, so all have been deleted once none are pending, and
+        # primary keys have not been cleared yet.
+        if not self.pending:
+            return self.get_trail_kwargs()
+
+    def is_root(self, instance):
+        return (instance._meta.concrete_model, instance.pk) in self.roots
+
+    def get_trail_kwargs(self):
+        deleted, self.deleted = self.deleted, []
+        if not deleted:
+            return
+        primary = deleted[0]
+        for instance, instance_text in deleted:
+            if self.is_root(instance):
+                primary = (instance, instance_text)
+                break
+        kwargs = dict(instance=primary[0], instance_text=primary[1])
+        related_instances = [
+            dict(instance=instance, text=instance_text, rel='' if self.is_root(instance) else 'cascade')
+            for instance, instance_text in deleted
+            if instance is not primary[0]
+        ]
+        if related_instances:
+            kwargs['related_instances'] = related_instances
+        return kwargs
+
+
+def get_delete_group():
+    '''
+    Return the group for the delete() currently running in this context, if
+    AGGREGATE_DELETES is enabled.
+    '''
+    groups = _delete_groups.get()
+    return groups[-1] if groups else None
+
+
+def _wrap_collect(collect):
+    @functools.wraps(collect)
+    def wrapper(self, objs, *args, **kwargs):
+        result = collect(self, objs, *args, **kwargs)
+        # The objects passed to the first collect() call (without a source)
+        # are the roots of the cascade.
+        source = args[0] if args else kwargs.get('source')
+        if source is None and not hasattr(self, '_trails_roots'):
+            if isinstance(objs, QuerySet) and objs._result_cache is None:
+                roots = set()
+            else:
+                roots = set([(obj._meta.concrete_model, obj.pk) for obj in objs])
+            self._trails_roots = roots
+        return result
+    return wrapper
+
+
+def _wrap_delete(delete):
+    @functools.wraps(delete)
+    def wrapper(self, *args, **kwargs):
+        if not trails_settings.AGGREGATE_DELETES:
+            return delete(self, *args, **kwargs)
+        group = DeleteGroup(getattr(self, '_trails_roots', set()))
+        token = _delete_groups.set(_delete_groups.get() + (group,))
+        try:
+            return delete(self, *args, **kwargs)
+        finally:
+            _delete_groups.reset(token)
+    return wrapper
+
+
+def install():
+    '''
+    Wrap Django's deletion Collector to group the deletions triggered by each
+    call to delete(), while AGGREGATE_DELETES is enabled.
+    '''
+    if not _originals:
+        _originals.update(collect=Collector.collect, delete=Collector.delete)
+        Collector.collect = _wrap_collect(Collector.collect)
+        Collector.delete = _wrap_delete(Collector.delete)
+
+
+def uninstall():
+    '''
+    Restore the original Collector methods when AGGREGATE_DELETES is disabled.
+    '''
+    if _originals:
+        Collector.collect = _originals.pop('collect')
+        Collector.delete = _originals.pop('delete')
@@ -0,0 +1,190 @@
+# Python
+import collections
+import copy
+import difflib
+import json
+import os
+
+# Django-Trails
+from .settings import trails_settings
+
+__all__ = ['encode_change', 'decode_change', 'decode_data']
+
+# Key used to identify an encoded diff in place of a (before, after) tuple.
+DIFF_KEY = '__diff__'
+
+
+def _value_size(value):
+    '''
+    Return the approximate stored size of a value.
+    '''
+    if isinstance(value, str):
+        return len(value)
+    try:
+        return len(json.dumps(value, cls=trails_settings.JSON_ENCODER))
+    except (TypeError, ValueError):
+        return 0
+
+
+def diff_text(before, after):
+    '''
+    Return a compact diff that will rebuild the before text from the after text.
+    '''
+    # Trim the common prefix and suffix first, so that small edits to a very
+    # long single line are still stored compactly.
+    prefix = len(os.path.commonprefix([before, after]))
+    suffix = len(os.path.commonprefix([before[prefix:][::-1], after[prefix:][::-1]]))
+    before_lines = before[prefix:len(before) - suffix].splitlines(True)
+    after_lines = after[prefix:len(after) - suffix].splitlines(True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, after_lines, before_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(i2 - i1)
+        else:
+            ops.append([i2 - i1, ''.join(before_lines[j1:j2])])
+    return collections.OrderedDict([
+        (DIFF_KEY, 'text'),
+        ('after', after),
+        ('prefix', prefix),
+        ('suffix', suffix),
+        ('ops', ops),
+    ])
+
+
+def patch_text(diff):
+    '''
+    Rebuild the before text from a text diff.
+    '''
+    after = diff['after']
+    prefix, suffix = diff['prefix'], diff['suffix']
+    after_lines = after[prefix:len(after) - suffix].splitlines(True)
+    before_parts = []
+    pos = 0
+    for op in diff['ops']:
+        if isinstance(op, int):
+            before_parts.extend(after_lines[pos:pos + op])
+            pos += op
+        else:
+            before_parts.append(op[1])
+            pos += op[0]
+    return after[:prefix] + ''.join(before_parts) + after[len(after) - suffix:]
+
+
+def _escape_pointer(key):
+    return str(key).replace('~', '~0').replace('/', '~1')
+
+
+def _unescape_pointer(part):
+    return part.replace('~1', '/').replace('~0', '~')
+
+
+def diff_json(before, after, path=''):
+    '''
+    Return a list of JSON patch style operations that will rebuild the before
+    value from the after value.
+    '''
+    if isinstance(before, dict) and isinstance(after, dict):
+        ops = []
+        for key in after:
+            if key not in before:
+                ops.append(collections.OrderedDict([('op', 'remove'), ('path', '{}/{}'.format(path, _escape_pointer(key)))]))
+        for key, value in before.items():
+            key_path = '{}/{}'.format(path, _escape_pointer(key))
+            if key not in after:
+                ops.append(collections.OrderedDict([('op', 'add'), ('path', key_path), ('value', value)]))
+            else:
+                ops.extend(diff_json(value, after[key], key_path))
+        return ops
+    if isinstance(before, list) and isinstance(after, list) and len(before) == len(after):
+        ops = []
+        for n, (before_item, after_item) in enumerate(zip(before, after)):
+            ops.extend(diff_json(before_item, after_item, '{}/{}'.format(path, n)))
+        return ops
+    if before == after:
+        return []
+    return [collections.OrderedDict([('op', 'replace'), ('path', path), ('value', before)])]
+
+
+def patch_json(diff):
+    '''
+    Rebuild the before value from a JSON diff.
+    '''
+    result = copy.deepcopy(diff['after'])
+    for op in diff['ops']:
+        if not op['path']:
+            result = op.get('value')
+            continue
+        parts = [_unescape_pointer(part) for part in op['path'].split('/')[1:]]
+        target = result
+        for part in parts[:-1]:
+            target = target[int(part)] if isinstance(target, list) else target[part]
+        key = int(parts[-1]) if isinstance(target, list) else parts[-1]
+        if op['op'] == 'remove':
+            del target[key]
+        else:
+            target[key] = op['value']
+    return result
+
+
+def is_diff(value):
+    '''
+    Return True if the value is an encoded diff.
+    '''
+    return isinstance(value, dict) and DIFF_KEY in value
+
+
+def encode_change(before, after):
+    '''
+    Return a compact diff for a changed value when it exceeds the configured
+    DIFF_THRESHOLD, otherwise the original (before, after) tuple.
+    '''
+    threshold = trails_settings.DIFF_THRESHOLD
+    if threshold is None:
+        return (before, after)
+    if isinstance(before, str) and isinstance(after, str):
+        if len(before) + len(after) < threshold:
+            return (before, after)
+        diff = diff_text(before, after)
+    elif isinstance(before, (dict, list)) and isinstance(after, (dict, list)):
+        if _value_size(before) + _value_size(after) < threshold:
+            return (before, after)
+        diff = collections.OrderedDict([
+            (DIFF_KEY, 'json'),
+            ('after', after),
+            ('ops', diff_json(before, after)),
+        ])
+    else:
+        return (before, after)
+    # Only use the diff when it's actually smaller than the full values.
+    if _value_size(diff) >= _value_size([before, after]):
+        return (before, after)
+    return diff
+
+
+def decode_change(value):
+    '''
+    Return the (before, after) tuple for a changed value, rebuilding the full
+    before value if it was stored as a diff.
+    '''
+    if is_diff(value):
+        if value[DIFF_KEY] == 'text':
+            return (patch_text(value), value['after'])
+        elif value[DIFF_KEY] == 'json':
+            return (patch_json(value), value['after'])
+        raise ValueError('Unknown diff type: {}'.format(value[DIFF_KEY]))
+    if isinstance(value, list) and len(value) == 2:
+        return tuple(value)
+    return value
+
+
+def decode_data(data):
+    '''
+    Return a copy of trail marker data with any diffs rebuilt to full values.
+    '''
+    if not isinstance(data, dict):
+        return data
+    return collections.OrderedDict([
+        (key, list(decode_change(value)) if is_diff(value) else value)
+        for key, value in data.items()
+    ])
@@ -0,0 +1,143 @@
+# Python
+import base64
+import json
+import lzma
+import zlib
+
+# Django
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models
+
+# Zstandard (optional)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Django-Trails
+from .settings import trails_settings
+
+__all__ = ['CompressedJSONField', 'encode_payload', 'decode_payload']
+
+# Prefix used to identify a compressed payload, followed by a single character
+# identifying the codec. Stored JSON text can never start with this character.
+COMPRESSED_PREFIX = '!'
+
+
+def _zstd_compress(data):
+    if zstandard is None:
+        raise ImproperlyConfigured('The zstandard package is required to use the "zstd" codec.')
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def _zstd_decompress(data):
+    if zstandard is None:
+        raise ImproperlyConfigured('The zstandard package is required to decode "zstd" compressed trails.')
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# Mapping of codec name -> (marker character, compress, decompress).
+CODECS = {
+    'zlib': ('z', zlib.compress, zlib.decompress),
+    'lzma': ('x', lzma.compress, lzma.decompress),
+    'zstd': ('s', _zstd_compress, _zstd_decompress),
+}
+
+# Mapping of marker character -> decompress function.
+DECOMPRESSORS = dict([(marker, decompress) for marker, compress, decompress in CODECS.values()])
+
+
+class RawPayload(str):
+    '''
+    Payload text loaded from the database that has not yet been decoded.
+    '''
+
+
+def encode_payload(value):
+    '''
+    Serialize a value to JSON text, compressing it when larger than the
+    configured COMPRESS_THRESHOLD.
+    '''
+    text = json.dumps(value, cls=trails_settings.JSON_ENCODER, separators=(',', ':'))
+    threshold = trails_settings.COMPRESS_THRESHOLD
+    if threshold is None or len(text) < threshold:
+        return text
+    try:
+        marker, compress, decompress = CODECS[trails_settings.COMPRESS_CODEC]
+    except KeyError:
+        raise ImproperlyConfigured('Invalid trails COMPRESS_CODEC: "{}"'.format(trails_settings.COMPRESS_CODEC))
+    compressed = base64.b64encode(compress(text.encode('utf-8'))).decode('ascii')
+    if len(compressed) + 2 >= len(text):
+        return text
+    return COMPRESSED_PREFIX + marker + compressed
+
+
+def decode_payload(text):
+    '''
+    Decode stored payload text, decompressing it if needed, to a Python value.
+    '''
+    if text is None:
+        return None
+    if text.startswith(COMPRESSED_PREFIX):
+        try:
+            decompress = DECOMPRESSORS[text[1:2]]
+        except KeyError:
+            raise ValueError('Unknown trails payload codec: "{}"'.format(text[1:2]))
+        text = decompress(base64.b64decode(text[2:])).decode('utf-8')
+    return json.loads(text)
+
+
+class CompressedJSONDescriptor(object):
+    '''
+    Descriptor that decodes raw payloads loaded from the database on first
+    access instead of when the model instance is created.
+    '''
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        attname = self.field.attname
+        if attname not in instance.__dict__:
+            instance.refresh_from_db(fields=[attname])
+        value = instance.__dict__[attname]
+        if isinstance(value, RawPayload):
+            value = decode_payload(value)
+            instance.__dict__[attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedJSONField(models.TextField):
+    '''
+    Field storing JSON data that transparently compresses large values, using
+    a marker character to select the codec when decoding.
+    '''
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(CompressedJSONField, self).contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.attname, CompressedJSONDescriptor(self))
+
+    def from_db_value(self, value, expression, connection, *args):
+        if value is None:
+            return value
+        return RawPayload(value)
+
+    def to_python(self, value):
+        if isinstance(value, str):
+            return decode_payload(value)
+        return value
+
+    def get_prep_value(self, value):
+        if isinstance(value, RawPayload):
+            value = decode_payload(value)
+        if self.null and value is None:
+            return None
+        return encode_payload(value)
+
+    def value_to_string(self, obj):
+        return json.dumps(self.value_from_object(obj), cls=trails_settings.JSON_ENCODER)
@@ -0,0 +1,294 @@
+# Python
+import csv
+import io
+import json
+import os
+
+# Django
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import smart_text
+
+# Django-Trails
+from .diff import decode_data
+from .managers import get_rollup_day
+from .models import Trail, TrailFieldChange, TrailMarker, TrailRollup
+from .search import get_search_backend, get_search_document
+from .settings import trails_settings
+
+__all__ = ['RecordError', 'iter_records', 'RecordMapper', 'insert_batch', 'ImportState']
+
+# Fields copied from each record to the trail.
+TRAIL_FIELDS = ('action', 'user_text', 'request', 'session')
+
+# Columns for the primary marker when importing CSV.
+CSV_MARKER_FIELDS = ('model', 'pk', 'text', 'rel', 'marker_data')
+
+# Number of uids to look up in each query.
+UID_CHUNK_SIZE = 500
+
+
+class RecordError(ValueError):
+    '''
+    Raised for a record that can't be imported.
+    '''
+
+    def __init__(self, source, line, message):
+        self.source = source
+        self.line = line
+        super(RecordError, self).__init__('{}:{}: {}'.format(source, line, message))
+
+
+def iter_records(f, format='ndjson', skip=0):
+    '''
+    Yield (line number, record) for each record in an NDJSON or CSV file
+    without reading the whole file, skipping the given number of records.
+    CSV records have a single marker given by the model, pk, text, rel and
+    marker_data columns; data and marker_data columns contain JSON.
+    '''
+    if format == 'csv':
+        reader = csv.DictReader(f)
+        for n, row in enumerate(reader):
+            if n < skip:
+                continue
+            record = dict([(k, v) for k, v in row.items() if k not in CSV_MARKER_FIELDS and v != ''])
+            if record.get('data'):
+                record['data'] = json.loads(record['data'])
+            if row.get('model'):
+                marker = dict(model=row['model'], pk=row.get('pk'), text=row.get('text') or '', rel=row.get('rel') or '')
+                if row.get('marker_data'):
+                    marker['data'] = json.loads(row['marker_data'])
+                record['markers'] = [marker]
+            yield reader.line_num, record
+    else:
+        n = 0
+        for line_num, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            n += 1
+            if n <= skip:
+                continue
+            yield line_num, json.loads(line)
+
+
+class RecordMapper(object):
+    '''
+    Map imported records to plain dictionaries of trail and marker fields,
+    resolving each model's content type only once. Records without a uid are
+    given one from uid_prefix and their line, or rejected without uid_prefix.
+    '''
+
+    def __init__(self, source, uid_prefix=None):
+        self.source = source
+        self.uid_prefix = uid_prefix
+        self.ctype_ids = {}
+
+    def get_ctype_id(self, label, line):
+        key = label.lower()
+        if key not in self.ctype_ids:
+            try:
+                app_label, model = key.split('.', 1)
+                self.ctype_ids[key] = ContentType.objects.get_by_natural_key(app_label, model).pk
+            except (ValueError, ContentType.DoesNotExist):
+                raise RecordError(self.source, line, 'unknown model "{}"'.format(label))
+        return self.ctype_ids[key]
+
+    def parse_created(self, value, line):
+        created = parse_datetime(smart_text(value or ''))
+        if created is None:
+            raise RecordError(self.source, line, 'invalid created "{}"'.format(value))
+        if settings.USE_TZ and timezone.is_naive(created):
+            created = timezone.make_aware(created, timezone.utc)
+        return created
+
+    def map(self, line, record):
+        if not record.get('action'):
+            raise RecordError(self.source, line, 'action is required')
+        if not record.get('uid') and not self.uid_prefix:
+            raise RecordError(self.source, line, 'uid is required')
+        trail = dict([(f, smart_text(record.get(f) or '')) for f in TRAIL_FIELDS])
+        # Records without a uid are identified by their position in the source.
+        trail['uid'] = smart_text(record.get('uid') or '{}:{}'.format(self.uid_prefix, line))
+        trail['created'] = self.parse_created(record.get('created'), line)
+        trail['user_id'] = record.get('user') or None
+        trail['user_is_anonymous'] = record.get('user_is_anonymous')
+        trail['data'] = record.get('data')
+        markers = []
+        for marker in record.get('markers') or []:
+            if marker.get('pk') in (None, ''):
+                raise RecordError(self.source, line, 'marker pk is required')
+            markers.append(dict(
+                ctype_id=self.get_ctype_id(marker.get('model') or '', line),
+                obj_pk=smart_text(marker['pk']),
+                obj_text=smart_text(marker.get('text') or ''),
+                rel=smart_text(marker.get('rel') or ''),
+                data=marker.get('data') or {},
+            ))
+        return trail, markers
+
+
+def _copy_value(value):
+    # Escape a value for the PostgreSQL COPY text format.
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    value = smart_text(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_insert(objs, using):
+    '''
+    Insert model instances using PostgreSQL COPY.
+    '''
+    connection = connections[using]
+    model = objs[0]._meta.model
+    fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+    buf = io.StringIO()
+    for obj in objs:
+        values = [f.get_db_prep_save(getattr(obj, f.attname), connection) for f in fields]
+        buf.write('\t'.join([_copy_value(v) for v in values]) + '\n')
+    buf.seek(0)
+    qn = connection.ops.quote_name
+    sql = 'COPY {} ({}) FROM STDIN'.format(qn(model._meta.db_table), ', '.join([qn(f.column) for f in fields]))
+    with connection.cursor() as cursor:
+        cursor.cursor.copy_expert(sql, buf)
+
+
+def _get_uid_map(uids, using):
+    uid_map = {}
+    for n in range(0, len(uids), UID_CHUNK_SIZE):
+        uid_map.update(Trail.objects.using(using).filter(uid__in=uids[n:n + UID_CHUNK_SIZE]).values_list('uid', 'pk'))
+    return uid_map
+
+
+def _get_rollup_counts(batch):
+    # Count trails by day, primary marker content type, action and user.
+    counts = {}
+    for trail, markers in batch:
+        ctype_id = next((marker['ctype_id'] for marker in markers if not marker['rel']), None)
+        key = (get_rollup_day(trail['created']), ctype_id, trail['action'], trail['user_id'])
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def _get_new_records(batch, using):
+    # Skip records already inserted or repeated within the batch.
+    existing = _get_uid_map([trail['uid'] for trail, markers in batch], using)
+    new_batch = []
+    for trail, markers in batch:
+        if trail['uid'] not in existing:
+            existing[trail['uid']] = None
+            new_batch.append((trail, markers))
+    return new_batch
+
+
+def _insert_records(new_batch, using, use_copy):
+    trails = [Trail(**trail) for trail, markers in new_batch]
+    if use_copy:
+        _copy_insert(trails, using)
+    else:
+        Trail.objects.using(using).bulk_create(trails)
+    # Primary keys aren't returned by bulk_create on all databases, so look
+    # them up by uid.
+    uid_map = _get_uid_map([trail.uid for trail in trails], using)
+    trail_markers = [
+        TrailMarker(trail_id=uid_map[trail['uid']], **marker)
+        for trail, markers in new_batch
+        for marker in markers
+    ]
+    if trail_markers:
+        if use_copy:
+            _copy_insert(trail_markers, using)
+        else:
+            TrailMarker.objects.using(using).bulk_create(trail_markers)
+    # Imported trails may have ids below trails already counted, so count
+    # them now rather than leaving them to TrailRollup.objects.update_from_trails().
+    if trails_settings.ROLLUPS:
+        TrailRollup.objects.db_manager(using).add_counts(
+            _get_rollup_counts(new_batch), last_trail_id=max(uid_map.values()),
+        )
+    if trails_settings.FIELD_CHANGE_INDEX or trails_settings.SEARCH_INDEX:
+        _index_records(list(uid_map.values()), using)
+
+
+def _index_records(trail_ids, using):
+    # Add the inserted trails to the field change and search indexes, as the
+    # pipeline does for trails recorded directly in the database.
+    trails = Trail.objects.using(using).in_bulk(trail_ids)
+    trail_markers = {}
+    for trail_marker in TrailMarker.objects.using(using).filter(trail_id__in=trail_ids).order_by('pk'):
+        trail_markers.setdefault(trail_marker.trail_id, []).append(trail_marker)
+    search_backend = get_search_backend(using) if trails_settings.SEARCH_INDEX else None
+    field_changes = []
+    for trail_id in sorted(trails):
+        trail = trails[trail_id]
+        markers = trail_markers.get(trail_id, [])
+        primary_marker = next((marker for marker in markers if not marker.rel), None)
+        if trails_settings.FIELD_CHANGE_INDEX and trail.action == 'change' and primary_marker is not None:
+            changes = decode_data(primary_marker.data)
+            if isinstance(changes, dict):
+                model = ContentType.objects.get_for_id(primary_marker.ctype_id).model_class()
+                field_changes.extend(TrailFieldChange.objects.build_changes(
+                    trail, primary_marker, changes, model._meta if model else None,
+                ))
+        if search_backend is not None:
+            search_backend.index_trail(trail_id, get_search_document(trail, markers))
+    if field_changes:
+        TrailFieldChange.objects.using(using).bulk_create(field_changes)
+
+
+def insert_batch(batch, using=None, use_copy=None):
+    '''
+    Insert a batch of mapped (trail, markers) records in one transaction,
+    skipping any already imported, count them in the activity rollups when
+    ROLLUPS is enabled and add them to the field change and search indexes
+    when FIELD_CHANGE_INDEX or SEARCH_INDEX is enabled. Records inserted by another process at the same time
+    (e.g. by several workers draining the same spool) are skipped by retrying.
+    Return the number of trails inserted.
+    '''
+    using = using or 'default'
+    connection = connections[using]
+    if use_copy is None:
+        use_copy = connection.vendor == 'postgresql'
+    while True:
+        new_batch = _get_new_records(batch, using)
+        if not new_batch:
+            return 0
+        try:
+            with transaction.atomic(using=using):
+                _insert_records(new_batch, using, use_copy)
+        except IntegrityError:
+            # Only retry when some of the uids were inserted in the meantime.
+            if len(_get_new_records(new_batch, using)) == len(new_batch):
+                raise
+            continue
+        return len(new_batch)
+
+
+class ImportState(object):
+    '''
+    Number of records imported from each source, saved to a file after each
+    batch so an interrupted import can be resumed.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.records = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.records = json.load(f)
+
+    def get(self, source):
+        return self.records.get(source, 0)
+
+    def update(self, source, count):
+        self.records[source] = self.get(source) + count
+        if self.path:
+            tmp_path = '{}.tmp'.format(self.path)
+            with open(tmp_path, 'w') as f:
+                json.dump(self.records, f)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,83 @@
+# Python
+import datetime
+
+# Django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router
+from django.utils import timezone
+
+# Django-Trails
+from trails.archive import archive_trails
+from trails.models import Trail
+from trails.settings import trails_settings
+
+
+class Command(BaseCommand):
+    '''
+    Move old trails from the database to columnar archive files.
+    '''
+
+    help = 'Move trails older than the given number of days to archive files in ARCHIVE_DIR, read with Trail.archive.query().'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=90,
+            help='Archive trails created more than this many days ago.',
+        )
+        parser.add_argument(
+            '--path',
+            default=None,
+            help='Directory for archive files (default: the ARCHIVE_DIR setting).',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50000,
+            help='Number of trails to write to each archive file.',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            default=False,
+            help='Write archive files without deleting the trails from the database.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            default=False,
+            help='Only print the number of trails that would be archived.',
+        )
+        parser.add_argument(
+            '--database',
+            default=None,
+            help='Database alias to use.',
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        path = options['path'] or trails_settings.ARCHIVE_DIR
+        if not path:
+            raise CommandError('No archive directory configured; set ARCHIVE_DIR or use --path.')
+        cutoff = timezone.now() - datetime.timedelta(days=options['days'])
+        # Read from the same database trails are deleted from, not READ_DATABASE.
+        using = options['database'] or router.db_for_write(Trail)
+        queryset = Trail.objects.using(using).filter(created__lt=cutoff)
+        if options['dry_run']:
+            self.stdout.write('Would archive {} trails created before {}.'.format(queryset.count(), cutoff))
+            return
+
+        def callback(total, file_path):
+            if self.verbosity >= 2:
+                self.stdout.write('Wrote {} ({} trails archived).'.format(file_path, total))
+
+        total = archive_trails(
+            queryset,
+            path,
+            batch_size=options['batch_size'],
+            delete=not options['keep'],
+            callback=callback,
+        )
+        if self.verbosity >= 1:
+            self.stdout.write('Archived {} trails created before {}.'.format(total, cutoff))
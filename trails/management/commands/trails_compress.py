@@ -0,0 +1,57 @@
+# Django
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+# Django-Trails
+from trails.fields import decode_payload, encode_payload
+from trails.models import Trail, TrailMarker
+
+
+class Command(BaseCommand):
+    '''
+    Recompress stored trail and marker data using the current settings.
+    '''
+
+    help = 'Recompress stored trail and marker data using the current COMPRESS_THRESHOLD and COMPRESS_CODEC settings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of rows to process in each chunk.',
+        )
+        parser.add_argument(
+            '--database',
+            default=None,
+            help='Database alias to use.',
+        )
+
+    def recompress(self, model_class, batch_size, using):
+        queryset = model_class._base_manager.using(using).order_by('pk')
+        last_pk = 0
+        checked, updated = 0, 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk).values_list('pk', 'data')[:batch_size])
+            if not rows:
+                break
+            with transaction.atomic(using=using):
+                for pk, raw_data in rows:
+                    if raw_data is None:
+                        continue
+                    data = decode_payload(raw_data)
+                    if encode_payload(data) != raw_data:
+                        queryset.filter(pk=pk).update(data=data)
+                        updated += 1
+            checked += len(rows)
+            last_pk = rows[-1][0]
+            if self.verbosity >= 2:
+                self.stdout.write('{}: checked {}, updated {}'.format(model_class._meta.label, checked, updated))
+        return checked, updated
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        for model_class in (Trail, TrailMarker):
+            checked, updated = self.recompress(model_class, options['batch_size'], options['database'])
+            if self.verbosity >= 1:
+                self.stdout.write('{}: recompressed {} of {} rows.'.format(model_class._meta.label, updated, checked))
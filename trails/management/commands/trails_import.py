@@ -0,0 +1,149 @@
+# Python
+import collections
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+# Django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+# Django-Trails
+from trails.importer import ImportState, RecordError, RecordMapper, insert_batch, iter_records
+
+
+def _insert_batch(args):
+    # Run in a worker process.
+    batch, using, use_copy = args
+    return insert_batch(batch, using=using, use_copy=use_copy), len(batch)
+
+
+class Command(BaseCommand):
+    '''
+    Import historical audit data from NDJSON or CSV files as trails.
+    '''
+
+    help = 'Import audit records from NDJSON or CSV files (or - for stdin) in bulk as trails and trail markers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'files',
+            nargs='+',
+            help='NDJSON or CSV files to import, or - to read NDJSON from stdin.',
+        )
+        parser.add_argument(
+            '--format',
+            choices=('ndjson', 'csv'),
+            default=None,
+            help='Format of the files (default: from each file extension).',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Number of records to insert in each transaction.',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Number of worker processes inserting batches in parallel.',
+        )
+        parser.add_argument(
+            '--max-pending',
+            type=int,
+            default=None,
+            help='Maximum number of batches read ahead of the inserted ones (default: twice the number of workers).',
+        )
+        parser.add_argument(
+            '--state',
+            default=None,
+            help='File recording progress, used to resume an interrupted import.',
+        )
+        parser.add_argument(
+            '--no-copy',
+            action='store_false',
+            dest='use_copy',
+            default=None,
+            help='Use bulk inserts instead of COPY on PostgreSQL.',
+        )
+        parser.add_argument(
+            '--database',
+            default='default',
+            help='Database alias to use.',
+        )
+
+    def iter_batches(self, path, format, skip, batch_size):
+        # Records from stdin must have a uid, since there is no path to
+        # identify them by.
+        if path == '-':
+            mapper = RecordMapper('stdin')
+        else:
+            mapper = RecordMapper(os.path.basename(path), uid_prefix=os.path.abspath(path))
+        f = sys.stdin if path == '-' else open(path, newline='' if format == 'csv' else None)
+        try:
+            records = iter_records(f, format, skip=skip)
+            while True:
+                batch = [mapper.map(line, record) for line, record in itertools.islice(records, batch_size)]
+                if not batch:
+                    break
+                yield batch
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    def iter_results(self, pool, batches, max_pending):
+        # Insert batches in the pool with at most max_pending batches waiting,
+        # so batches aren't read faster than they can be inserted, returning
+        # results in order.
+        pending = collections.deque()
+        for args in batches:
+            pending.append(pool.apply_async(_insert_batch, (args,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        state = ImportState(options['state'])
+        workers = max(options['workers'], 1)
+        max_pending = max(options['max_pending'] or workers * 2, 1)
+        using = options['database']
+        pool = None
+        if workers > 1:
+            # Each worker opens its own database connections.
+            connections.close_all()
+            pool = multiprocessing.get_context('fork').Pool(workers)
+        start = time.time()
+        imported, processed = 0, 0
+        try:
+            for path in options['files']:
+                format = options['format'] or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+                state_key = os.path.abspath(path) if path != '-' else path
+                skip = state.get(state_key)
+                if skip and self.verbosity >= 1:
+                    self.stdout.write('{}: resuming after {} records.'.format(path, skip))
+                batches = ((batch, using, options['use_copy']) for batch in self.iter_batches(path, format, skip, options['batch_size']))
+                # Results are returned in order, so progress is only recorded
+                # once all earlier batches have been inserted.
+                results = self.iter_results(pool, batches, max_pending) if pool else map(_insert_batch, batches)
+                for inserted, count in results:
+                    state.update(state_key, count)
+                    imported += inserted
+                    processed += count
+                    if self.verbosity >= 2:
+                        elapsed = max(time.time() - start, 0.001)
+                        self.stdout.write('{}: {} records processed, {} imported ({:.0f}/s).'.format(
+                            path, state.get(state_key), imported, processed / elapsed,
+                        ))
+        except RecordError as e:
+            raise CommandError(str(e))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        if self.verbosity >= 1:
+            self.stdout.write('Imported {} of {} records in {:.1f}s.'.format(imported, processed, time.time() - start))
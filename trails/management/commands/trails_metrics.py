@@ -0,0 +1,29 @@
+# Django
+from django.core.management.base import BaseCommand
+
+# Django-Trails
+from trails.metrics import clear_metrics, export_metrics
+
+
+class Command(BaseCommand):
+    '''
+    Print trails pipeline metrics in the Prometheus text format.
+    '''
+
+    help = 'Print trails pipeline metrics, aggregated across processes, in the Prometheus text format.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--clear',
+            action='store_true',
+            default=False,
+            help='Remove all collected metrics instead of printing them.',
+        )
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            clear_metrics()
+            if options['verbosity'] >= 1:
+                self.stdout.write('Cleared trails metrics.')
+        else:
+            self.stdout.write(export_metrics(), ending='')
@@ -0,0 +1,87 @@
+# Django
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+# Django-Trails
+from trails.models import Trail
+from trails.revert import RevertConflictError, revert_trails
+
+
+class Command(BaseCommand):
+    '''
+    Revert changes recorded by the trails for a request or a user and time window.
+    '''
+
+    help = 'Revert the changes recorded during a request, or by a user within a time window.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--request',
+            default=None,
+            help='UUID of the request whose changes should be reverted.',
+        )
+        parser.add_argument(
+            '--user',
+            default=None,
+            help='Username of the user whose changes should be reverted.',
+        )
+        parser.add_argument(
+            '--start',
+            default=None,
+            help='Only revert changes recorded at or after this date/time (ISO 8601).',
+        )
+        parser.add_argument(
+            '--end',
+            default=None,
+            help='Only revert changes recorded before this date/time (ISO 8601).',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            default=False,
+            help='Only report the planned operations and conflicts.',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            default=False,
+            help='Apply operations without conflicts even if other operations conflict.',
+        )
+
+    def parse_datetime(self, value):
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise CommandError('Invalid date/time: {}'.format(value))
+        return parsed
+
+    def handle(self, *args, **options):
+        if not options['request'] and not options['user']:
+            raise CommandError('Specify a request UUID and/or a user.')
+        trails = Trail.objects.all()
+        if options['request']:
+            trails = Trail.objects.for_request(options['request'])
+        if options['user']:
+            user_model = get_user_model()
+            try:
+                user = user_model._default_manager.get_by_natural_key(options['user'])
+            except user_model.DoesNotExist:
+                raise CommandError('No such user: {}'.format(options['user']))
+            trails = trails.filter(user=user)
+        if options['start']:
+            trails = trails.filter(created__gte=self.parse_datetime(options['start']))
+        if options['end']:
+            trails = trails.filter(created__lt=self.parse_datetime(options['end']))
+        try:
+            plan = revert_trails(trails, dry_run=options['dry_run'], force=options['force'])
+        except RevertConflictError as e:
+            for line in e.plan.report():
+                self.stdout.write(line)
+            raise CommandError('{}; use --force to revert the rest.'.format(e))
+        if options['dry_run'] or options['verbosity'] >= 2:
+            for line in plan.report():
+                self.stdout.write(line)
+        if options['verbosity'] >= 1 and not options['dry_run']:
+            self.stdout.write('Reverted {} objects from {} trails.'.format(
+                len([op for op in plan.operations.values() if not op.conflicts]), len(plan.trail_ids),
+            ))
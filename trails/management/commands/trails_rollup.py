@@ -0,0 +1,48 @@
+# Django
+from django.core.management.base import BaseCommand
+
+# Django-Trails
+from trails.models import TrailRollup
+
+
+class Command(BaseCommand):
+    '''
+    Update the activity rollup tables from recorded trails.
+    '''
+
+    help = 'Count trails recorded since the last update in the activity rollup tables, or recompute them with --rebuild.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            default=False,
+            help='Remove all rollups and recompute them from every trail.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of trails to count in each chunk.',
+        )
+        parser.add_argument(
+            '--database',
+            default=None,
+            help='Database alias to use.',
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+
+        def callback(total, last_pk):
+            if self.verbosity >= 2:
+                self.stdout.write('Counted {} trails (up to id {}).'.format(total, last_pk))
+
+        manager = TrailRollup.objects.db_manager(options['database'])
+        total = manager.update_from_trails(
+            batch_size=options['batch_size'],
+            rebuild=options['rebuild'],
+            callback=callback,
+        )
+        if self.verbosity >= 1:
+            self.stdout.write('Counted {} trails in rollups.'.format(total))
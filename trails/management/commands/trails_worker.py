@@ -0,0 +1,77 @@
+# Python
+import time
+
+# Django
+from django.core.management.base import BaseCommand, CommandError
+
+# Django-Trails
+from trails.metrics import export_spool_metrics
+from trails.spool import drain_spool, get_spool
+
+
+class Command(BaseCommand):
+    '''
+    Insert trails from the local spool into the database.
+    '''
+
+    help = 'Drain trails appended to the local spool (SPOOL_PATH) into the database in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--spool',
+            default=None,
+            help='Path of the spool to drain (default: the SPOOL_PATH setting).',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Number of trails to insert in each transaction.',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1.0,
+            help='Seconds to wait for new trails when the spool is empty.',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            default=False,
+            help='Exit once the spool is empty instead of waiting for new trails.',
+        )
+        parser.add_argument(
+            '--stats',
+            action='store_true',
+            default=False,
+            help='Print spool backlog metrics in the Prometheus text format and exit.',
+        )
+        parser.add_argument(
+            '--database',
+            default=None,
+            help='Database alias to use.',
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        spool = get_spool(options['spool'])
+        if spool is None:
+            raise CommandError('No spool configured; set SPOOL_PATH or use --spool.')
+        if options['stats']:
+            self.stdout.write(export_spool_metrics(spool), ending='')
+            return
+
+        def callback(count, inserted):
+            if self.verbosity >= 2:
+                self.stdout.write('Inserted {} of {} spooled trails.'.format(inserted, count))
+
+        try:
+            while True:
+                total = drain_spool(spool, batch_size=options['batch_size'], using=options['database'], callback=callback)
+                if total and self.verbosity >= 1:
+                    self.stdout.write('Drained {} trails from the spool.'.format(total))
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
@@ -1,9 +1,29 @@
+# Python
+import datetime
+import hashlib
+import json
+
 # Django
-from django.db import models
-from django.db.models import Q
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import FieldDoesNotExist
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import F, Max, Q, Sum, Value
+from django.db.models.functions import Greatest
 from django.contrib.contenttypes.models import ContentType
+from django.test.signals import setting_changed
+from django.utils import timezone
+from django.utils.encoding import smart_text
+
+# Django-Trails
+from .diff import decode_change
+from .settings import trails_settings
+from .utils import LRUCache
 
-__all__ = ['TrailManager']
+__all__ = ['TrailManager', 'TrailTextManager', 'TrailRollupManager', 'TrailFieldChangeManager', 'get_rollup_day',
+           'get_rollup_key']
 
 
 def ensure_queryset(qs):
@@ -42,5 +62,408 @@ class TrailManager(models.Manager):
                 ct_pks.add(instance.pk)
         q = Q(pk=0)
         for ct, pks in opts.items():
-            q = q | Q(content_type=ct, object_id__in=pks)
-        return self.filter(q)
+            q = q | Q(markers__ctype=ct, markers__obj_pk__in=[smart_text(pk) for pk in pks])
+        return self.filter(q).distinct()
+
+    def for_request(self, request_uuid):
+        """Return all trails recorded while handling the request with the
+        given UUID.
+        """
+        prefix = '[{}]'.format(request_uuid)
+        return self.filter(Q(request__startswith=prefix) | Q(request_ref__text__startswith=prefix))
+
+    def field_changes(self, model, field, instance=None, start=None, end=None, before=None, after=None):
+        """Return change trails that changed a field of the given model (or
+        "app_label.ModelName"), optionally only for one instance, within a
+        range of times, or (with FIELD_CHANGE_HASH_VALUES enabled) from or to
+        a given value. Requires FIELD_CHANGE_INDEX to be enabled when the
+        changes were recorded.
+        """
+        from .models import TrailFieldChange
+        field_changes = TrailFieldChange.objects.filter_changes(model, field, instance, start, end, before, after)
+        return self.filter(pk__in=field_changes.values('trail_id'))
+
+    def search(self, query):
+        """Return trails matching a free text query against the user, object
+        text and data, using the search index if SEARCH_INDEX is enabled.
+        """
+        from .search import search_trails
+        return search_trails(self.get_queryset(), query)
+
+    # Local-memory cache used for recent trails when RECENT_CACHE is not set.
+    recent_cache = LocMemCache('trails-recent', {'OPTIONS': {'MAX_ENTRIES': 10000}})
+
+    @classmethod
+    def get_recent_cache(cls):
+        if trails_settings.RECENT_CACHE:
+            return caches[trails_settings.RECENT_CACHE]
+        return cls.recent_cache
+
+    @staticmethod
+    def get_recent_cache_key(ctype_id, obj_pk):
+        return 'trails:recent:{}:{}'.format(ctype_id, obj_pk)
+
+    def recent_for(self, instance, n=10):
+        """Return the n most recent trails for a model instance.
+
+        Trails are cached until a new trail marker is recorded for the instance,
+        so repeated reads (e.g. "recent changes" on a detail page) don't query
+        the database. Trails are read from the primary database, so a stale
+        replica isn't cached after invalidating.
+        """
+        ctype = ContentType.objects.get_for_model(instance)
+        obj_pk = smart_text(instance.pk)
+        timeout = trails_settings.RECENT_CACHE_TIMEOUT
+        if timeout:
+            cache = self.get_recent_cache()
+            key = self.get_recent_cache_key(ctype.pk, obj_pk)
+            cached = cache.get(key)
+            # Entries cached for a larger n, or with fewer trails than were
+            # requested, can answer any smaller request.
+            if cached is not None and (cached[0] >= n or len(cached[1]) < cached[0]):
+                return cached[1][:n]
+        qs = self.using(self._db or router.db_for_write(self.model))
+        qs = qs.filter(markers__ctype=ctype, markers__obj_pk=obj_pk).distinct()
+        trails = list(qs.order_by('-created', '-pk')[:n])
+        if timeout:
+            cache.set(key, (n, trails), timeout)
+        return trails
+
+    def invalidate_recent(self, objs):
+        """Remove cached recent trails for (ctype_id, obj_pk) pairs."""
+        if not trails_settings.RECENT_CACHE_TIMEOUT:
+            return
+        keys = set([self.get_recent_cache_key(ctype_id, obj_pk) for ctype_id, obj_pk in objs])
+        if not keys:
+            return
+        cache = self.get_recent_cache()
+        cache.delete_many(keys)
+        # Invalidate again once committed, in case another process cached the
+        # trails before the new marker was visible to it.
+        using = router.db_for_write(self.model)
+        if connections[using].in_atomic_block:
+            transaction.on_commit(lambda: cache.delete_many(keys), using=using)
+
+
+class TrailTextManager(models.Manager):
+    """Manager for the TrailText class."""
+
+    # In-process caches of text -> id and id -> text.
+    id_cache = LRUCache()
+    text_cache = LRUCache()
+
+    def _cache(self, text, pk):
+        # Only cache once the row is known to be committed, so a rollback can't
+        # leave an id cached for a row that doesn't exist.
+        def cache():
+            for lru_cache in (self.id_cache, self.text_cache):
+                lru_cache.maxsize = trails_settings.TEXT_CACHE_SIZE
+            self.id_cache.set(text, pk)
+            self.text_cache.set(pk, text)
+        using = router.db_for_write(self.model)
+        if connections[using].in_atomic_block:
+            transaction.on_commit(cache, using=using)
+        else:
+            cache()
+
+    @classmethod
+    def clear_cache(cls):
+        cls.id_cache.clear()
+        cls.text_cache.clear()
+
+    def get_id(self, text):
+        """Return the id of the interned text, creating it if needed."""
+        if not text:
+            return None
+        text = smart_text(text)
+        pk = self.id_cache.get(text)
+        if pk is None:
+            digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+            pk = self.get_or_create(digest=digest, defaults={'text': text})[0].pk
+            self._cache(text, pk)
+        return pk
+
+    def get_text(self, pk):
+        """Return the interned text for the given id."""
+        if not pk:
+            return ''
+        text = self.text_cache.get(pk)
+        if text is None:
+            text = self.filter(pk=pk).values_list('text', flat=True).first() or ''
+            if text:
+                self._cache(text, pk)
+        return text
+
+
+def get_rollup_day(value):
+    """Return the day (in the default time zone) a trail is counted for."""
+    if settings.USE_TZ and timezone.is_aware(value):
+        return timezone.localtime(value, timezone.get_default_timezone()).date()
+    return value.date()
+
+
+def get_rollup_key(day, ctype_id, action, user_id):
+    """Return the unique key of the rollup for a day, content type, action and
+    user, with a missing content type or user mapped to 0 (unique constraints
+    don't apply to NULL columns).
+    """
+    value = '{}:{}:{}:{}'.format(day.isoformat(), ctype_id or 0, action, 0 if user_id is None else user_id)
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+class TrailRollupManager(models.Manager):
+    """Manager for the TrailRollup class."""
+
+    @property
+    def write_db(self):
+        """Database for updating rollups, which reads the current counts (and
+        trails) from the primary instead of READ_DATABASE.
+        """
+        return self._db or router.db_for_write(self.model)
+
+    def get_watermark(self):
+        """Return the id of the last trail counted in the rollups."""
+        return self.using(self.write_db).aggregate(last=Max('last_trail_id'))['last'] or 0
+
+    def _update_count(self, key, count, last_trail_id):
+        return self.using(self.write_db).filter(key=get_rollup_key(*key)).update(
+            count=F('count') + count,
+            last_trail_id=Greatest('last_trail_id', Value(last_trail_id)),
+        )
+
+    def increment(self, day, ctype_id, action, user_id, count=1, last_trail_id=0):
+        """Add to the count for a single day, content type, action and user."""
+        key = (day, ctype_id, action, user_id)
+        if self._update_count(key, count, last_trail_id):
+            return
+        try:
+            with transaction.atomic(using=self.write_db):
+                self.using(self.write_db).create(
+                    key=get_rollup_key(*key), day=day, ctype_id=ctype_id, action=action,
+                    user_id=user_id, count=count, last_trail_id=last_trail_id,
+                )
+        except IntegrityError:
+            # Created by another process in the meantime.
+            self._update_count(key, count, last_trail_id)
+
+    def add_counts(self, counts, last_trail_id=0):
+        """Add counts keyed by (day, ctype_id, action, user_id) in bulk."""
+        counts = dict([(key, count) for key, count in counts.items() if count])
+        if not counts:
+            return
+        keys = dict([(key, get_rollup_key(*key)) for key in counts])
+        existing = set(self.using(self.write_db).filter(key__in=keys.values()).values_list('key', flat=True))
+        new_counts = []
+        for key, count in counts.items():
+            if keys[key] not in existing or not self._update_count(key, count, last_trail_id):
+                new_counts.append((key, count))
+        if not new_counts:
+            return
+        try:
+            with transaction.atomic(using=self.write_db):
+                self.using(self.write_db).bulk_create([
+                    self.model(key=keys[key], day=key[0], ctype_id=key[1], action=key[2], user_id=key[3],
+                               count=count, last_trail_id=last_trail_id)
+                    for key, count in new_counts
+                ])
+        except IntegrityError:
+            for key, count in new_counts:
+                self.increment(*key, count=count, last_trail_id=last_trail_id)
+
+    def _lock_rollups(self, using):
+        """Lock the rollups table for the current transaction on PostgreSQL, so
+        counts added as trails are recorded wait for it to be committed. Other
+        databases lock the rows (or the whole database) when they are deleted.
+        """
+        connection = connections[using]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE'.format(
+                    connection.ops.quote_name(self.model._meta.db_table),
+                ))
+
+    def update_from_trails(self, batch_size=1000, rebuild=False, callback=None):
+        """Count trails recorded since the last trail counted in the rollups.
+
+        Trails are counted in chunks of batch_size, each in its own transaction,
+        so an interrupted update can be resumed. With rebuild, all rollups are
+        removed and recomputed from every trail in a single transaction, with
+        the rollups locked so trails recorded meanwhile aren't counted twice.
+        Return the number of trails counted.
+
+        Without ROLLUPS, counting stops at a gap in the trail ids followed by a
+        trail recorded less than ROLLUP_COMMIT_LAG seconds ago, since the
+        missing trail may not have been committed yet.
+
+        Trails inserted by the trails_import and trails_worker commands are
+        counted as they are inserted when ROLLUPS is enabled; otherwise, they
+        may have ids below the last trail counted, so rebuild after importing.
+        """
+        using = self.write_db
+        if rebuild:
+            with transaction.atomic(using=using):
+                self._lock_rollups(using)
+                self.using(using).delete()
+                return self._count_trails(using, 0, batch_size, callback)
+        return self._count_trails(using, self.get_watermark(), batch_size, callback)
+
+    def _count_trails(self, using, last_pk, batch_size, callback):
+        Trail = apps.get_model('trails', 'Trail')
+        TrailMarker = apps.get_model('trails', 'TrailMarker')
+        # Trails recorded with ROLLUPS are counted as they are committed, even
+        # below the last trail counted, so there's no need to wait for them.
+        lag = 0 if trails_settings.ROLLUPS else trails_settings.ROLLUP_COMMIT_LAG
+        recent = timezone.now() - datetime.timedelta(seconds=lag)
+        total = 0
+        while True:
+            rows = list(Trail.objects.using(using).filter(pk__gt=last_pk).order_by('pk').values_list(
+                'pk', 'created', 'action', 'user_id',
+            )[:batch_size])
+            if not rows:
+                break
+            waiting = False
+            for n, row in enumerate(rows):
+                previous_pk = rows[n - 1][0] if n else last_pk
+                if lag and previous_pk and row[0] != previous_pk + 1 and row[1] > recent:
+                    rows, waiting = rows[:n], True
+                    break
+            if not rows:
+                break
+            # The primary marker is the first marker for each trail without a rel.
+            ctype_ids = {}
+            markers = TrailMarker.objects.using(using).filter(
+                trail_id__in=[row[0] for row in rows], rel='',
+            ).order_by('pk').values_list('trail_id', 'ctype_id')
+            for trail_id, ctype_id in markers:
+                ctype_ids.setdefault(trail_id, ctype_id)
+            counts = {}
+            for pk, created, action, user_id in rows:
+                key = (get_rollup_day(created), ctype_ids.get(pk), action, user_id)
+                counts[key] = counts.get(key, 0) + 1
+            last_pk = rows[-1][0]
+            with transaction.atomic(using=using):
+                self.db_manager(using).add_counts(counts, last_trail_id=last_pk)
+            total += len(rows)
+            if callback:
+                callback(total, last_pk)
+            if waiting:
+                break
+        return total
+
+    def filter_totals(self, start=None, end=None, model=None, action=None, user=None):
+        """Return rollups filtered by day range, model, action and/or user."""
+        qs = self.all()
+        if start is not None:
+            qs = qs.filter(day__gte=start)
+        if end is not None:
+            qs = qs.filter(day__lte=end)
+        if model is not None:
+            if isinstance(model, str):
+                model = apps.get_model(model)
+            qs = qs.filter(ctype=ContentType.objects.get_for_model(model))
+        if action is not None:
+            qs = qs.filter(action=action)
+        if user is not None:
+            qs = qs.filter(user=user)
+        return qs
+
+    def totals(self, *fields, **filters):
+        """Return the number of trails, optionally grouped by any of the day,
+        ctype, action and user fields, e.g. totals('day', 'action',
+        model='auth.User', start=date(2020, 1, 1)).
+        """
+        qs = self.filter_totals(**filters)
+        if not fields:
+            return qs.aggregate(count=Sum('count'))['count'] or 0
+        return qs.order_by(*fields).values(*fields).annotate(count=Sum('count'))
+
+    def counts_by_day(self, **filters):
+        """Return a list of (day, count) for the number of trails each day."""
+        return [(row['day'], row['count']) for row in self.totals('day', **filters)]
+
+    def counts_by_model(self, **filters):
+        """Return a list of (model label, count) for the number of trails
+        recorded for each model, with an empty label for trails without one.
+        """
+        counts = []
+        for row in self.totals('ctype', **filters):
+            ctype = ContentType.objects.get_for_id(row['ctype']) if row['ctype'] else None
+            model_class = ctype.model_class() if ctype else None
+            counts.append((model_class._meta.label if model_class else '', row['count']))
+        return counts
+
+    def counts_by_action(self, **filters):
+        """Return a list of (action, count) for the number of trails for each action."""
+        return [(row['action'], row['count']) for row in self.totals('action', **filters)]
+
+    def counts_by_user(self, **filters):
+        """Return a list of (user id, count) for the number of trails by each user."""
+        return [(row['user'], row['count']) for row in self.totals('user', **filters)]
+
+
+def hash_field_value(value):
+    """Return a hash of a field value, to match changes to or from a value."""
+    encoded = json.dumps(value, cls=trails_settings.JSON_ENCODER, sort_keys=True)
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+class TrailFieldChangeManager(models.Manager):
+    """Manager for the TrailFieldChange class."""
+
+    def build_changes(self, trail, trail_marker, changes, opts=None):
+        """Return unsaved field changes for the changes recorded in a change
+        trail's marker data, optionally resolving field names using opts.
+        """
+        hash_values = trails_settings.FIELD_CHANGE_HASH_VALUES
+        field_changes = []
+        for key, value in changes.items():
+            # Foreign keys are stored by attname (e.g. "user_id") in the data.
+            field = key
+            if opts is not None:
+                try:
+                    field = opts.get_field(key).name
+                except FieldDoesNotExist:
+                    pass
+            before_hash, after_hash = '', ''
+            if hash_values:
+                before, after = decode_change(value)
+                before_hash, after_hash = hash_field_value(before), hash_field_value(after)
+            field_changes.append(self.model(
+                marker=trail_marker,
+                trail=trail,
+                ctype_id=trail_marker.ctype_id,
+                obj_pk=trail_marker.obj_pk,
+                field=field,
+                created=trail.created,
+                before_hash=before_hash,
+                after_hash=after_hash,
+            ))
+        return field_changes
+
+    def filter_changes(self, model, field, instance=None, start=None, end=None, before=None, after=None):
+        """Return the field changes matching the arguments to
+        Trail.objects.field_changes().
+        """
+        if isinstance(model, str):
+            model = apps.get_model(model)
+        qs = self.filter(ctype=ContentType.objects.get_for_model(model), field=field)
+        if instance is not None:
+            qs = qs.filter(obj_pk=smart_text(instance.pk))
+        if start is not None:
+            qs = qs.filter(created__gte=start)
+        if end is not None:
+            qs = qs.filter(created__lt=end)
+        if before is not None:
+            qs = qs.filter(before_hash=hash_field_value(before))
+        if after is not None:
+            qs = qs.filter(after_hash=hash_field_value(after))
+        return qs
+
+
+def clear_text_cache(sender, **kwargs):
+    if kwargs['setting'] == 'TRAILS':
+        TrailTextManager.clear_cache()
+        TrailManager.recent_cache.clear()
+
+
+setting_changed.connect(clear_text_cache)
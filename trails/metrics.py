@@ -0,0 +1,289 @@
+# Python
+import bisect
+import collections
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+
+# Django
+from django.test.signals import setting_changed
+
+# Django-Trails
+from .settings import trails_settings
+
+__all__ = ['get_metrics', 'collect_metrics', 'export_metrics', 'export_spool_metrics', 'clear_metrics']
+
+# Header at the start of each metrics file containing the number of bytes used.
+HEADER = struct.Struct('<Q')
+
+# Length prefix for each key in a metrics file.
+KEY_LENGTH = struct.Struct('<I')
+
+# Value stored after each key in a metrics file.
+VALUE = struct.Struct('<d')
+
+# Help text and type for each metric exported.
+METRICS = collections.OrderedDict([
+    ('trails_pipeline_stage_seconds', ('histogram', 'Time spent in each trails pipeline stage.')),
+    ('trails_dropped_total', ('counter', 'Trails not recorded because a pipeline stage stopped the pipeline.')),
+    ('trails_recorded_total', ('counter', 'Trails recorded by action and model.')),
+])
+
+# Help text for each spool backlog gauge exported, by backlog key.
+SPOOL_METRICS = collections.OrderedDict([
+    ('records', ('trails_spool_backlog_records', 'Trail records waiting in the spool.')),
+    ('oldest_age', ('trails_spool_oldest_age_seconds', 'Age of the oldest trail record waiting in the spool.')),
+    ('failed', ('trails_spool_failed_records', 'Trail records in the spool that could not be inserted.')),
+    ('bytes', ('trails_spool_bytes', 'Size of the spool files.')),
+])
+
+
+class MetricValues(object):
+    '''
+    Storage for metric values within the current process.
+    '''
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, key, amount=1.0):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def close(self):
+        pass
+
+
+class MmapMetricValues(MetricValues):
+    '''
+    Storage for metric values in a memory-mapped file that is only written by
+    the current process, so that values can be aggregated across processes
+    without locking between them.
+    '''
+
+    initial_size = 64 * 1024
+
+    def __init__(self, path):
+        super(MmapMetricValues, self).__init__()
+        self.path = path
+        self._offsets = {}
+        self._file = open(path, 'a+b')
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() < self.initial_size:
+            self._file.truncate(self.initial_size)
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._used = HEADER.unpack_from(self._mmap, 0)[0] or HEADER.size
+        for key, value, offset in _read_entries(self._mmap):
+            self._offsets[key] = offset
+
+    def _add_key(self, key):
+        encoded = json.dumps(key).encode('utf-8')
+        # Pad each entry so values are aligned to 8 bytes.
+        padded = KEY_LENGTH.size + len(encoded) + (8 - (KEY_LENGTH.size + len(encoded)) % 8) % 8
+        size = padded + VALUE.size
+        while self._used + size > len(self._mmap):
+            size_on_disk = len(self._mmap)
+            self._mmap.close()
+            self._file.truncate(size_on_disk * 2)
+            self._mmap = mmap.mmap(self._file.fileno(), 0)
+        KEY_LENGTH.pack_into(self._mmap, self._used, len(encoded))
+        self._mmap[self._used + KEY_LENGTH.size:self._used + KEY_LENGTH.size + len(encoded)] = encoded
+        offset = self._used + padded
+        VALUE.pack_into(self._mmap, offset, 0.0)
+        self._used += size
+        HEADER.pack_into(self._mmap, 0, self._used)
+        self._offsets[key] = offset
+        return offset
+
+    def inc(self, key, amount=1.0):
+        with self._lock:
+            offset = self._offsets.get(key)
+            if offset is None:
+                offset = self._add_key(key)
+            VALUE.pack_into(self._mmap, offset, VALUE.unpack_from(self._mmap, offset)[0] + amount)
+
+    def items(self):
+        with self._lock:
+            return [(key, value) for key, value, offset in _read_entries(self._mmap)]
+
+    def close(self):
+        with self._lock:
+            self._mmap.close()
+            self._file.close()
+
+
+def _read_entries(data):
+    '''
+    Yield (key, value, offset) for each entry in metrics file data.
+    '''
+    used = HEADER.unpack_from(data, 0)[0]
+    pos = HEADER.size
+    while pos < used:
+        length = KEY_LENGTH.unpack_from(data, pos)[0]
+        encoded = bytes(data[pos + KEY_LENGTH.size:pos + KEY_LENGTH.size + length])
+        name, labels = json.loads(encoded.decode('utf-8'))
+        padded = KEY_LENGTH.size + length + (8 - (KEY_LENGTH.size + length) % 8) % 8
+        offset = pos + padded
+        yield (name, tuple([tuple(label) for label in labels])), VALUE.unpack_from(data, offset)[0], offset
+        pos = offset + VALUE.size
+
+
+class PipelineMetrics(object):
+    '''
+    Counters and latency histograms for the trails pipeline.
+    '''
+
+    def __init__(self, values, buckets):
+        self.values = values
+        self.buckets = sorted(buckets)
+        self.bucket_labels = ['{!r}'.format(float(b)) for b in self.buckets] + ['+Inf']
+
+    def observe_stage(self, stage, seconds):
+        le = self.bucket_labels[bisect.bisect_left(self.buckets, seconds)]
+        self.values.inc(('trails_pipeline_stage_seconds_bucket', (('stage', stage), ('le', le))))
+        self.values.inc(('trails_pipeline_stage_seconds_sum', (('stage', stage),)), seconds)
+        self.values.inc(('trails_pipeline_stage_seconds_count', (('stage', stage),)))
+
+    def inc_dropped(self, stage):
+        self.values.inc(('trails_dropped_total', (('stage', stage),)))
+
+    def inc_recorded(self, action, model):
+        self.values.inc(('trails_recorded_total', (('action', action or ''), ('model', model))))
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    '''
+    Return the pipeline metrics for the current process, or None if metrics
+    are disabled.
+    '''
+    if not trails_settings.METRICS:
+        return None
+    pid = os.getpid()
+    metrics = _metrics.get(pid)
+    if metrics is None:
+        with _metrics_lock:
+            # Discard metrics inherited from a parent process after a fork.
+            for other_pid in list(_metrics.keys()):
+                if other_pid != pid:
+                    _metrics.pop(other_pid)
+            metrics = _metrics.get(pid)
+            if metrics is None:
+                if trails_settings.METRICS_DIR:
+                    values = MmapMetricValues(os.path.join(trails_settings.METRICS_DIR, 'trails-{}.db'.format(pid)))
+                else:
+                    values = MetricValues()
+                metrics = PipelineMetrics(values, trails_settings.METRICS_BUCKETS)
+                _metrics[pid] = metrics
+    return metrics
+
+
+def reset_metrics():
+    with _metrics_lock:
+        for metrics in _metrics.values():
+            metrics.values.close()
+        _metrics.clear()
+
+
+def collect_metrics():
+    '''
+    Return metric values summed across all processes writing to METRICS_DIR,
+    or only for the current process if no METRICS_DIR is configured.
+    '''
+    totals = collections.OrderedDict()
+    if trails_settings.METRICS_DIR:
+        for path in sorted(glob.glob(os.path.join(trails_settings.METRICS_DIR, 'trails-*.db'))):
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < HEADER.size:
+                continue
+            for key, value, offset in _read_entries(data):
+                totals[key] = totals.get(key, 0.0) + value
+    else:
+        metrics = get_metrics()
+        if metrics:
+            for key, value in metrics.values.items():
+                totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+def clear_metrics():
+    '''
+    Remove metric values for all processes, e.g. when deploying.
+    '''
+    reset_metrics()
+    if trails_settings.METRICS_DIR:
+        for path in glob.glob(os.path.join(trails_settings.METRICS_DIR, 'trails-*.db')):
+            os.remove(path)
+
+
+def _format_labels(labels):
+    return ','.join(['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels])
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def export_metrics():
+    '''
+    Return all metric values in the Prometheus text exposition format.
+    '''
+    totals = collect_metrics()
+    bucket_labels = ['{!r}'.format(float(b)) for b in sorted(trails_settings.METRICS_BUCKETS)] + ['+Inf']
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        if metric_type == 'histogram':
+            stages = sorted(set([dict(labels)['stage'] for (key, labels) in totals if key == '{}_count'.format(name)]))
+            for stage in stages:
+                cumulative = 0.0
+                for le in bucket_labels:
+                    cumulative += totals.get(('{}_bucket'.format(name), (('stage', stage), ('le', le))), 0.0)
+                    lines.append('{}_bucket{{{}}} {}'.format(name, _format_labels([('stage', stage), ('le', le)]), _format_value(cumulative)))
+                for suffix in ('sum', 'count'):
+                    value = totals.get(('{}_{}'.format(name, suffix), (('stage', stage),)), 0.0)
+                    lines.append('{}_{}{{{}}} {}'.format(name, suffix, _format_labels([('stage', stage)]), _format_value(value)))
+        else:
+            for (key, labels), value in sorted(totals.items()):
+                if key == name:
+                    lines.append('{}{{{}}} {}'.format(name, _format_labels(labels), _format_value(value)))
+    if trails_settings.SPOOL_PATH:
+        lines.append(export_spool_metrics().rstrip('\n'))
+    return '\n'.join(lines) + '\n'
+
+
+def export_spool_metrics(spool=None):
+    '''
+    Return backlog gauges for the given or configured spool in the Prometheus
+    text exposition format.
+    '''
+    from .spool import get_spool
+    spool = spool or get_spool()
+    backlog = spool.backlog() if spool else {}
+    lines = []
+    for key, (name, help_text) in SPOOL_METRICS.items():
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{} {}'.format(name, _format_value(backlog.get(key, 0))))
+    return '\n'.join(lines) + '\n'
+
+
+def reset_metrics_on_setting_changed(sender, **kwargs):
+    if kwargs['setting'] == 'TRAILS':
+        reset_metrics()
+
+
+setting_changed.connect(reset_metrics_on_setting_changed)
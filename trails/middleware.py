@@ -0,0 +1,70 @@
+# Django
+from django.utils.encoding import smart_text
+
+# Django-Trails
+from .context import trails_context
+
+__all__ = ['TrailsMiddleware', 'RequestTextCache', 'get_request_text_cache']
+
+
+class RequestTextCache(object):
+    '''
+    Text representations of the request, session and user, computed once per
+    request and shared by all trails recorded while handling it. Session and
+    user text are recomputed only if the session key or user changes, e.g.
+    after logging in.
+    '''
+
+    def __init__(self, request):
+        self.request = request
+        self._texts = {}
+
+    def _get_text(self, name, key, func):
+        cached = self._texts.get(name)
+        if cached is None or cached[0] != key:
+            cached = self._texts[name] = (key, func())
+        return cached[1]
+
+    def get_request_text(self, request_uuid=None):
+        def func():
+            parts = []
+            if request_uuid:
+                parts.append('[{}]'.format(request_uuid))
+            if self.request.method:
+                parts.append(smart_text(self.request.method))
+            full_path = self.request.get_full_path()
+            if full_path:
+                parts.append(smart_text(full_path))
+            return ' '.join(parts)
+        return self._get_text('request', request_uuid, func)
+
+    def get_session_text(self, session):
+        session_key = getattr(session, 'session_key', '')
+        return self._get_text('session', (id(session), session_key), lambda: smart_text(session_key))
+
+    def get_user_text(self, user):
+        return self._get_text('user', (id(user), user.pk), lambda: smart_text(user))
+
+
+def get_request_text_cache(request):
+    '''
+    Return the text cache added to the request by TrailsMiddleware, if any.
+    '''
+    return getattr(request, 'trails_text_cache', None)
+
+
+class TrailsMiddleware(object):
+    '''
+    Optional middleware to compute the request, session and user text for
+    trails once per request instead of once per trail, and to make the
+    current request available to trails via contextvars. Add it after the
+    session and authentication middleware.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.trails_text_cache = RequestTextCache(request)
+        with trails_context(request=request):
+            return self.get_response(request)
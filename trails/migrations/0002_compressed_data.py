@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:25
+
+from django.db import migrations
+import trails.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trails', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='trail',
+            name='data',
+            field=trails.fields.CompressedJSONField(blank=True, default=None, editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='trailmarker',
+            name='data',
+            field=trails.fields.CompressedJSONField(blank=True, default=None, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trails', '0002_compressed_data'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrailText',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(editable=False, max_length=40, unique=True)),
+                ('text', models.TextField(editable=False)),
+            ],
+            options={
+                'verbose_name': 'text',
+            },
+        ),
+        migrations.AddField(
+            model_name='trail',
+            name='request_ref',
+            field=models.ForeignKey(default=None, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='trails.TrailText'),
+        ),
+        migrations.AddField(
+            model_name='trail',
+            name='session_ref',
+            field=models.ForeignKey(default=None, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='trails.TrailText'),
+        ),
+        migrations.AddField(
+            model_name='trail',
+            name='user_text_ref',
+            field=models.ForeignKey(default=None, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='trails.TrailText'),
+        ),
+        migrations.AddField(
+            model_name='trailmarker',
+            name='obj_text_ref',
+            field=models.ForeignKey(default=None, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='trails.TrailText'),
+        ),
+    ]
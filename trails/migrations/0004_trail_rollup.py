@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:49
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('trails', '0003_trail_text'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrailRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(editable=False, max_length=40, unique=True)),
+                ('day', models.DateField(editable=False)),
+                ('action', models.SlugField(editable=False)),
+                ('count', models.PositiveIntegerField(default=0, editable=False)),
+                ('last_trail_id', models.PositiveIntegerField(db_index=True, default=0, editable=False)),
+                ('ctype', models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='contenttypes.ContentType')),
+                ('user', models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'rollup',
+                'index_together': {('day', 'ctype', 'action', 'user')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('trails', '0004_trail_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrailFieldChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('obj_pk', models.CharField(editable=False, max_length=255)),
+                ('field', models.CharField(editable=False, max_length=255)),
+                ('created', models.DateTimeField(editable=False)),
+                ('before_hash', models.CharField(blank=True, default='', editable=False, max_length=40)),
+                ('after_hash', models.CharField(blank=True, default='', editable=False, max_length=40)),
+                ('ctype', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='contenttypes.ContentType')),
+                ('marker', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='field_changes', to='trails.TrailMarker')),
+                ('trail', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='trails.Trail')),
+            ],
+            options={
+                'verbose_name': 'field change',
+                'index_together': {('ctype', 'field', 'created')},
+            },
+        ),
+    ]
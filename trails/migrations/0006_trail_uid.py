@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:56
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trails', '0005_trail_field_change'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trail',
+            name='uid',
+            field=models.CharField(default=None, editable=False, max_length=255, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='trail',
+            name='created',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -3,17 +3,18 @@ from django.db import models
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.template.loader import render_to_string
+from django.utils import timezone
 from django.utils.encoding import smart_text
 from django.utils.translation import ugettext_lazy as _
 
-# Django-JSONField
-from jsonfield import JSONField
-
 # Django-Trails
-from .managers import TrailManager
+from .archive import TrailArchive
+from .diff import decode_data
+from .fields import CompressedJSONField
+from .managers import TrailFieldChangeManager, TrailManager, TrailRollupManager, TrailTextManager
 from .settings import trails_settings
 
-__all__ = ['Trail', 'TrailMarker']
+__all__ = ['Trail', 'TrailMarker', 'TrailText', 'TrailRollup', 'TrailFieldChange']
 
 
 class Trail(models.Model):
@@ -22,9 +23,19 @@ class Trail(models.Model):
     '''
 
     objects = TrailManager()
+    archive = TrailArchive()
 
     created = models.DateTimeField(
-        auto_now_add=True,
+        default=timezone.now,
+        db_index=True,
+        editable=False,
+    )
+    uid = models.CharField(
+        max_length=255,
+        unique=True,
+        null=True,
+        default=None,
+        editable=False,
     )
     user = models.ForeignKey(
         getattr(settings, 'AUTH_USER_MODEL', 'auth.User'),
@@ -55,12 +66,36 @@ class Trail(models.Model):
         db_index=True,
         editable=False,
     )
-    data = JSONField(
+    data = CompressedJSONField(
         blank=True,
         null=True,
         default=None,
         editable=False,
     )
+    user_text_ref = models.ForeignKey(
+        'TrailText',
+        related_name='+',
+        null=True,
+        default=None,
+        on_delete=models.PROTECT,
+        editable=False,
+    )
+    request_ref = models.ForeignKey(
+        'TrailText',
+        related_name='+',
+        null=True,
+        default=None,
+        on_delete=models.PROTECT,
+        editable=False,
+    )
+    session_ref = models.ForeignKey(
+        'TrailText',
+        related_name='+',
+        null=True,
+        default=None,
+        on_delete=models.PROTECT,
+        editable=False,
+    )
 
     class Meta:
         ordering = ['-created']
@@ -68,7 +103,15 @@ class Trail(models.Model):
 
     @property
     def user_display(self):
-        return smart_text(self.user or self.user_text or '')
+        return smart_text(self.user or self.user_text or TrailText.objects.get_text(self.user_text_ref_id))
+
+    @property
+    def request_display(self):
+        return self.request or TrailText.objects.get_text(self.request_ref_id)
+
+    @property
+    def session_display(self):
+        return self.session or TrailText.objects.get_text(self.session_ref_id)
 
     @property
     def action_display(self):
@@ -92,7 +135,7 @@ class Trail(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.pk:  # Never save/update after initial creation.
-            if not self.user_text and self.user:
+            if not self.user_text and not self.user_text_ref_id and self.user:
                 self.user_text = smart_text(self.user)
             super(Trail, self).save(*args, **kwargs)
 
@@ -157,12 +200,20 @@ class TrailMarker(models.Model):
         editable=False,
         default='',
     )
-    data = JSONField(
+    data = CompressedJSONField(
         blank=True,
         null=True,
         default=None,
         editable=False,
     )
+    obj_text_ref = models.ForeignKey(
+        'TrailText',
+        related_name='+',
+        null=True,
+        default=None,
+        on_delete=models.PROTECT,
+        editable=False,
+    )
 
     @property
     def ctype_display(self):
@@ -170,7 +221,11 @@ class TrailMarker(models.Model):
 
     @property
     def obj_display(self):
-        return self.obj_text
+        return self.obj_text or TrailText.objects.get_text(self.obj_text_ref_id)
+
+    @property
+    def data_display(self):
+        return decode_data(self.data)
 
     def __str__(self):
         if self.rel:
@@ -180,6 +235,138 @@ class TrailMarker(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.pk:  # Never save/update after initial creation.
-            if not self.obj_text:
+            if not self.obj_text and not self.obj_text_ref_id:
                 self.obj_text = smart_text(self.obj)
             super(TrailMarker, self).save(*args, **kwargs)
+
+
+class TrailText(models.Model):
+    '''
+    Text shared by many trails or markers, stored once and referenced by id.
+    '''
+
+    objects = TrailTextManager()
+
+    digest = models.CharField(
+        max_length=40,
+        unique=True,
+        editable=False,
+    )
+    text = models.TextField(
+        editable=False,
+    )
+
+    class Meta:
+        verbose_name = _('text')
+
+    def __str__(self):
+        return self.text
+
+
+class TrailRollup(models.Model):
+    '''
+    Number of trails recorded per day, model, action and user, maintained as
+    trails are recorded (or by the trails_rollup command) for dashboards.
+    '''
+
+    objects = TrailRollupManager()
+
+    key = models.CharField(
+        max_length=40,
+        unique=True,
+        editable=False,
+    )
+    day = models.DateField(
+        editable=False,
+    )
+    ctype = models.ForeignKey(
+        'contenttypes.ContentType',
+        related_name='+',
+        null=True,
+        on_delete=models.PROTECT,
+        editable=False,
+    )
+    action = models.SlugField(
+        editable=False,
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name='+',
+        null=True,
+        on_delete=models.SET_NULL,
+        editable=False,
+    )
+    count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+    )
+    last_trail_id = models.PositiveIntegerField(
+        db_index=True,
+        default=0,
+        editable=False,
+    )
+
+    class Meta:
+        index_together = [('day', 'ctype', 'action', 'user')]
+        verbose_name = _('rollup')
+
+    def __str__(self):
+        return '{} {} {}: {}'.format(self.day, self.ctype_id or '', self.action, self.count)
+
+
+class TrailFieldChange(models.Model):
+    '''
+    Index of the fields changed by each change trail marker, to find changes
+    to a given field without scanning marker data.
+    '''
+
+    objects = TrailFieldChangeManager()
+
+    marker = models.ForeignKey(
+        'TrailMarker',
+        related_name='field_changes',
+        on_delete=models.CASCADE,
+        editable=False,
+    )
+    trail = models.ForeignKey(
+        'Trail',
+        related_name='+',
+        on_delete=models.CASCADE,
+        editable=False,
+    )
+    ctype = models.ForeignKey(
+        'contenttypes.ContentType',
+        related_name='+',
+        on_delete=models.PROTECT,
+        editable=False,
+    )
+    obj_pk = models.CharField(
+        max_length=255,
+        editable=False,
+    )
+    field = models.CharField(
+        max_length=255,
+        editable=False,
+    )
+    created = models.DateTimeField(
+        editable=False,
+    )
+    before_hash = models.CharField(
+        max_length=40,
+        blank=True,
+        default='',
+        editable=False,
+    )
+    after_hash = models.CharField(
+        max_length=40,
+        blank=True,
+        default='',
+        editable=False,
+    )
+
+    class Meta:
+        index_together = [('ctype', 'field', 'created')]
+        verbose_name = _('field change')
+
+    def __str__(self):
+        return '{}.{} ({})'.format(self.ctype_id, self.field, self.obj_pk)
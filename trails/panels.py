@@ -0,0 +1,46 @@
+# Django
+from django.utils.translation import ugettext_lazy as _, ungettext
+
+# Django-Debug-Toolbar
+from debug_toolbar.panels import Panel
+
+# Django-Trails
+from .stats import start_stats, stop_stats
+
+__all__ = ['TrailsPanel']
+
+
+class TrailsPanel(Panel):
+    '''
+    Debug toolbar panel showing trails recorded during the request, queries
+    issued by trackers and pipeline functions, and time spent in each.
+    '''
+
+    title = _('Trails')
+    template = 'trails/panel.html'
+
+    @property
+    def nav_subtitle(self):
+        stats = self.get_stats()
+        trail_count = stats.get('trail_count', 0)
+        return ungettext(
+            '%(trail_count)d trail, %(query_count)d queries in %(total_time).2fms',
+            '%(trail_count)d trails, %(query_count)d queries in %(total_time).2fms',
+            trail_count,
+        ) % dict(trail_count=trail_count, query_count=stats.get('query_count', 0), total_time=stats.get('total_time', 0) * 1000)
+
+    def enable_instrumentation(self):
+        self._trails_stats = start_stats()
+
+    def disable_instrumentation(self):
+        stop_stats()
+
+    def generate_stats(self, request, response):
+        stats = getattr(self, '_trails_stats', None)
+        if stats is None:
+            return
+        data = stats.as_dict()
+        for timing in data['timings']:
+            timing['time_ms'] = timing['time'] * 1000
+        data['total_time_ms'] = data['total_time'] * 1000
+        self.record_stats(data)
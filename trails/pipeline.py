@@ -1,20 +1,88 @@
 # Python
 import logging
 import pprint
+import time
 import uuid
 
 # Django
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.utils import timezone
 from django.utils.encoding import smart_text
 
-# Django-CRUM
-from crum import get_current_request, get_current_user
-
 # Django-Trails
-from .models import Trail, TrailMarker
+from .context import get_current_request, get_current_request_uuid, get_current_user
+from .middleware import get_request_text_cache
+from .metrics import get_metrics
+from .managers import get_rollup_day
+from .models import Trail, TrailFieldChange, TrailMarker, TrailRollup, TrailText
+from .search import get_search_backend, get_search_document
 from .settings import trails_settings
-from .utils import log_trace
+from .spool import get_spool
+from .stats import get_stats
+from .utils import iter_queryset_chunks, log_trace
+
+
+def run_pipeline_function(pipeline_function, kwargs, stats=None, metrics=None):
+    '''
+    Run a single pipeline function, measuring it when stats or metrics are
+    being collected.
+    '''
+    try:
+        log_trace('running pipeline function: %r(**%r)', pipeline_function, kwargs)
+        start = time.perf_counter() if metrics is not None else None
+        if stats is None:
+            result = pipeline_function(**kwargs)
+        else:
+            with stats.measure('pipeline', pipeline_function.__name__):
+                result = pipeline_function(**kwargs)
+        if metrics is not None:
+            metrics.observe_stage(pipeline_function.__name__, time.perf_counter() - start)
+    except Exception as e:
+        print('err', e)
+        raise
+    return result
+
+
+def update_pipeline_kwargs(pipeline_function, result, kwargs, metrics=None):
+    '''
+    Update kwargs with the result of a pipeline function. Return False if the
+    pipeline function stopped the pipeline.
+    '''
+    if isinstance(result, dict):
+        kwargs.update(result)
+    elif result is False:
+        if metrics is not None:
+            metrics.inc_dropped(pipeline_function.__name__)
+        return False
+    return True
+
+
+def run_pipeline_functions(pipeline_functions, kwargs):
+    '''
+    Run the given pipeline functions in order, updating kwargs in place. Return
+    False if one of them stopped the pipeline.
+    '''
+    stats = get_stats()
+    metrics = get_metrics()
+    for pipeline_function in pipeline_functions:
+        result = run_pipeline_function(pipeline_function, kwargs, stats, metrics)
+        if not update_pipeline_kwargs(pipeline_function, result, kwargs, metrics):
+            return False
+    return True
+
+
+def complete_pipeline(kwargs):
+    '''
+    Count a trail that made it through the whole pipeline.
+    '''
+    stats = get_stats()
+    metrics = get_metrics()
+    instance = kwargs.get('instance')
+    if stats is not None:
+        stats.add_trail(kwargs.get('action'), instance)
+    if metrics is not None:
+        metrics.inc_recorded(kwargs.get('action'), instance._meta.label if instance is not None else '')
 
 
 def run_pipeline(**kwargs):
@@ -22,17 +90,8 @@ def run_pipeline(**kwargs):
     Run pipeline functions in order, updating kwargs for the next function with
     the results of the previous one.
     '''
-    for pipeline_function in trails_settings.PIPELINE:
-        try:
-            log_trace('running pipeline function: %r(**%r)', pipeline_function, kwargs)
-            result = pipeline_function(**kwargs)
-        except Exception as e:
-            print('err', e)
-            raise
-        if isinstance(result, dict):
-            kwargs.update(result)
-        elif result is False:
-            break
+    if run_pipeline_functions(trails_settings.PIPELINE, kwargs):
+        complete_pipeline(kwargs)
 
 
 def debug(**kwargs):
@@ -64,8 +123,11 @@ def add_request_uuid(**kwargs):
     request = kwargs.get('request')
     if request:
         if not hasattr(request, 'trails_uuid'):
-            request.trails_uuid = uuid.uuid4()
+            request.trails_uuid = get_current_request_uuid() or uuid.uuid4()
         return dict(request_uuid=request.trails_uuid)
+    request_uuid = get_current_request_uuid()
+    if request_uuid:
+        return dict(request_uuid=request_uuid)
 
 
 def add_session(**kwargs):
@@ -119,6 +181,9 @@ def add_request_text(**kwargs):
     '''
     request = kwargs.get('request')
     request_uuid = kwargs.get('request_uuid') or getattr(request, 'trails_uuid', None)
+    text_cache = get_request_text_cache(request)
+    if text_cache is not None:
+        return dict(request_text=text_cache.get_request_text(request_uuid))
     if request:
         parts = []
         if request_uuid:
@@ -135,6 +200,9 @@ def add_session_text(**kwargs):
     Add text representation of session (session key/id).
     '''
     session = kwargs.get('session')
+    text_cache = get_request_text_cache(kwargs.get('request'))
+    if text_cache is not None and session is not None:
+        return dict(session_text=text_cache.get_session_text(session))
     session_key = getattr(session, 'session_key', '')
     return dict(session_text=smart_text(session_key))
 
@@ -152,10 +220,27 @@ def add_user_text(**kwargs):
         elif user is None:
             user_text = smart_text(trails_settings.NO_USER_TEXT)
         else:
-            user_text = smart_text(user)
+            text_cache = get_request_text_cache(kwargs.get('request'))
+            if text_cache is not None:
+                user_text = text_cache.get_user_text(user)
+            else:
+                user_text = smart_text(user)
     return dict(user_text=user_text)
 
 
+def add_text_ids(**kwargs):
+    '''
+    Based on setting, add ids of the interned request, session and user text.
+    '''
+    if not trails_settings.NORMALIZE_TEXT:
+        return
+    return dict(
+        request_text_id=TrailText.objects.get_id(kwargs.get('request_text')),
+        session_text_id=TrailText.objects.get_id(kwargs.get('session_text')),
+        user_text_id=TrailText.objects.get_id(kwargs.get('user_text')),
+    )
+
+
 def log_trail(**kwargs):
     '''
     Log the trail to the configured logger.
@@ -166,26 +251,97 @@ def log_trail(**kwargs):
     # FIXME: Implement!
 
 
+def _get_spool_marker(obj, obj_text=None, data=None, rel=None):
+    '''
+    Helper to build a spooled marker record for a model instance.
+    '''
+    if obj is None or obj.pk is None:
+        return
+    return dict(
+        model=obj._meta.label_lower,
+        pk=obj.pk,
+        text=smart_text(obj) if obj_text is None else obj_text,
+        rel=rel or '',
+        data=data or {},
+    )
+
+
+def spool_trail(**kwargs):
+    '''
+    Based on setting, append the trail to the local spool instead of creating
+    it in the database; the trails_worker command inserts spooled trails.
+    Within a transaction, the trail is appended once it is committed, so
+    changes that are rolled back aren't recorded.
+    '''
+    spool = get_spool()
+    if not trails_settings.USE_DATABASE or spool is None:
+        return
+    user = kwargs.get('user')
+    markers = [_get_spool_marker(kwargs.get('instance'), kwargs.get('instance_text'), kwargs.get('instance_data'))]
+    for instance, instance_text, instance_data, instance_rel in _iter_related_instances(kwargs.get('related_instances')):
+        markers.append(_get_spool_marker(instance, instance_text, instance_data, instance_rel))
+    related_pks = kwargs.get('related_pks') or {}
+    if related_pks.get('model'):
+        batch_size = max(trails_settings.BULK_BATCH_SIZE or 1000, 1)
+        pks = related_pks.get('pks')
+        if not isinstance(pks, models.QuerySet):
+            pks = list(pks or [])
+        for pk, obj_text in _iter_display_texts(related_pks['model'], pks, batch_size):
+            markers.append(dict(model=related_pks['model']._meta.label_lower, pk=pk, text=obj_text, rel=related_pks.get('rel') or ''))
+    record = dict(
+        uid=uuid.uuid4().hex,
+        action=kwargs.get('action'),
+        created=timezone.now(),
+        request=kwargs.get('request_text') or '',
+        session=kwargs.get('session_text') or '',
+        user=getattr(user, 'pk', None),
+        user_is_anonymous=kwargs.get('user_is_anonymous'),
+        user_text=kwargs.get('user_text') or '',
+        data=kwargs.get('data'),
+        markers=[marker for marker in markers if marker],
+    )
+    instance = kwargs.get('instance')
+    using = getattr(getattr(instance, '_state', None), 'db', None) or router.db_for_write(Trail)
+    if connections[using].in_atomic_block:
+        transaction.on_commit(lambda: spool.append(record), using=using)
+    else:
+        spool.append(record)
+    return dict(spooled=True)
+
+
 def create_database_trail(**kwargs):
     '''
     Create the main trail record in the database.
     '''
-    if not trails_settings.USE_DATABASE:
+    if not trails_settings.USE_DATABASE or kwargs.get('spooled'):
         return
-    trail = Trail.objects.create(
+    trail = Trail(
         action=kwargs.get('action'),
-        request=kwargs.get('request_text'),
-        session=kwargs.get('session_text'),
+        request=kwargs.get('request_text') or '',
+        session=kwargs.get('session_text') or '',
         user=kwargs.get('user'),
-        user_text=kwargs.get('user_text'),
+        user_is_anonymous=kwargs.get('user_is_anonymous'),
+        user_text=kwargs.get('user_text') or '',
         data=kwargs.get('data'),
     )
+    # Reference interned text instead of storing it on the trail.
+    if kwargs.get('request_text_id'):
+        trail.request, trail.request_ref_id = '', kwargs['request_text_id']
+    if kwargs.get('session_text_id'):
+        trail.session, trail.session_ref_id = '', kwargs['session_text_id']
+    if kwargs.get('user_text_id'):
+        trail.user_text, trail.user_text_ref_id = '', kwargs['user_text_id']
+    trail.save(force_insert=True)
+    # Read trails from the primary for the rest of the request.
+    request = kwargs.get('request')
+    if request is not None and trails_settings.READ_DATABASE and trails_settings.READ_PRIMARY_AFTER_WRITE:
+        request.trails_read_primary = True
     return dict(trail=trail)
 
 
-def _create_database_trail_marker(trail, obj=None, obj_text=None, data=None, rel=None):
+def _build_database_trail_marker(trail, obj=None, obj_text=None, data=None, rel=None):
     '''
-    Helper to create a trail marker in the database for a model instance.
+    Helper to build an unsaved trail marker for a model instance.
     '''
     if not trail or not obj:
         return
@@ -204,16 +360,104 @@ def _create_database_trail_marker(trail, obj=None, obj_text=None, data=None, rel
     except (AttributeError, ValueError):
         obj_pk = None  # FIXME: Handle non-integer primary keys.
     if ctype and obj_pk:
-        return TrailMarker.objects.create(
+        obj_text_id = None
+        if trails_settings.NORMALIZE_TEXT:
+            obj_text, obj_text_id = '', TrailText.objects.get_id(obj_text)
+        return TrailMarker(
             trail=trail,
             rel=rel,
             ctype=ctype,
             obj_pk=obj_pk,
             obj_text=obj_text,
+            obj_text_ref_id=obj_text_id,
             data=data,
         )
 
 
+def _create_database_trail_marker(trail, obj=None, obj_text=None, data=None, rel=None):
+    '''
+    Helper to create a trail marker in the database for a model instance.
+    '''
+    trail_marker = _build_database_trail_marker(trail, obj, obj_text, data, rel)
+    if trail_marker:
+        trail_marker.save(force_insert=True)
+        Trail.objects.invalidate_recent([(trail_marker.ctype_id, trail_marker.obj_pk)])
+    return trail_marker
+
+
+def _iter_display_texts(model, pks, batch_size):
+    '''
+    Helper to yield (pk, text) for the given primary keys (or a queryset of the
+    related objects) in chunks, loading only the fields configured in
+    TEXT_FIELDS when possible.
+    '''
+    text_fields = trails_settings.TEXT_FIELDS.get(model._meta.label)
+    if isinstance(pks, models.QuerySet):
+        chunks = iter_queryset_chunks(pks, batch_size, text_fields)
+    else:
+        queryset = model._default_manager.order_by()
+        if text_fields:
+            queryset = queryset.values_list('pk', *text_fields)
+        chunks = (queryset.filter(pk__in=pks[n:n + batch_size]) for n in range(0, len(pks), batch_size))
+    for chunk in chunks:
+        for row in chunk:
+            if text_fields:
+                yield row[0], ' '.join([smart_text(value) for value in row[1:] if value is not None])
+            else:
+                yield row.pk, smart_text(row)
+
+
+def _insert_database_trail_markers(trail_markers):
+    '''
+    Helper to insert trail markers together and invalidate cached recent trails
+    for their objects.
+    '''
+    TrailMarker.objects.bulk_create(trail_markers)
+    Trail.objects.invalidate_recent([(m.ctype_id, m.obj_pk) for m in trail_markers])
+
+
+def _bulk_create_database_trail_markers(trail, trail_markers, model=None, pks=None, rel=None):
+    '''
+    Helper to insert trail markers in chunks, along with markers for any
+    related objects of the given model identified only by primary key or by a
+    queryset.
+    '''
+    if not trail:
+        return 0
+    if pks is None:
+        pks = []
+    elif not isinstance(pks, models.QuerySet):
+        pks = list(pks)
+    batch_size = max(trails_settings.BULK_BATCH_SIZE or 1000, 1)
+    ctype = ContentType.objects.get_for_model(model) if model else None
+    count = 0
+    for pk, obj_text in _iter_display_texts(model, pks, batch_size) if model else ():
+        try:
+            obj_pk = int(pk)
+        except (TypeError, ValueError):
+            continue  # FIXME: Handle non-integer primary keys.
+        obj_text_id = None
+        if trails_settings.NORMALIZE_TEXT:
+            obj_text, obj_text_id = '', TrailText.objects.get_id(obj_text)
+        trail_markers.append(TrailMarker(
+            trail=trail,
+            rel=rel or '',
+            ctype=ctype,
+            obj_pk=obj_pk,
+            obj_text=obj_text,
+            obj_text_ref_id=obj_text_id,
+            data={},
+        ))
+        if len(trail_markers) >= batch_size:
+            _insert_database_trail_markers(trail_markers)
+            count += len(trail_markers)
+            trail_markers = []
+    if trail_markers:
+        _insert_database_trail_markers(trail_markers)
+        count += len(trail_markers)
+    return count
+
+
 def create_primary_database_trail_marker(**kwargs):
     '''
     Create a trail marker for the primary model instance affected.
@@ -229,15 +473,12 @@ def create_primary_database_trail_marker(**kwargs):
     return dict(primary_trail_marker=primary_trail_marker)
 
 
-def create_related_database_trail_markers(**kwargs):
+def _iter_related_instances(related_instances):
     '''
-    Create a trail marker for any related model instances affected.
+    Helper to yield (instance, text, data, rel) for each related instance given
+    as a model instance, a tuple or a dictionary.
     '''
-    if not trails_settings.USE_DATABASE:
-        return
-    related_instances = kwargs.get('related_instances') or []
-    related_trail_markers = []
-    for related_instance in related_instances:
+    for related_instance in related_instances or []:
         instance = None
         instance_text = None
         instance_data = None
@@ -258,7 +499,18 @@ def create_related_database_trail_markers(**kwargs):
             instance_text = related_instance.get('text', None) or related_instance.get('obj_text', None)
             instance_data = related_instance.get('data', None)
             instance_rel = related_instance.get('rel', None)
-        related_trail_marker = _create_database_trail_marker(
+        yield instance, instance_text, instance_data, instance_rel
+
+
+def create_related_database_trail_markers(**kwargs):
+    '''
+    Create a trail marker for any related model instances affected.
+    '''
+    if not trails_settings.USE_DATABASE:
+        return
+    related_trail_markers = []
+    for instance, instance_text, instance_data, instance_rel in _iter_related_instances(kwargs.get('related_instances')):
+        related_trail_marker = _build_database_trail_marker(
             trail=kwargs.get('trail'),
             obj=instance,
             obj_text=instance_text,
@@ -267,4 +519,58 @@ def create_related_database_trail_markers(**kwargs):
         )
         if related_trail_marker:
             related_trail_markers.append(related_trail_marker)
-    return dict(related_trail_markers=related_trail_markers)
+    # Insert all related markers together, so the number of queries doesn't
+    # grow with the number of related instances.
+    related_trail_marker_count = _bulk_create_database_trail_markers(
+        kwargs.get('trail'),
+        list(related_trail_markers),
+        **(kwargs.get('related_pks') or {})
+    )
+    return dict(related_trail_markers=related_trail_markers, related_trail_marker_count=related_trail_marker_count)
+
+
+def create_database_field_changes(**kwargs):
+    '''
+    Record each field changed by a change trail in the field change index.
+    '''
+    if not trails_settings.USE_DATABASE or not trails_settings.FIELD_CHANGE_INDEX:
+        return
+    trail = kwargs.get('trail')
+    trail_marker = kwargs.get('primary_trail_marker')
+    instance_data = kwargs.get('instance_data')
+    if kwargs.get('action') != 'change' or not trail or not trail_marker or not isinstance(instance_data, dict):
+        return
+    field_changes = TrailFieldChange.objects.build_changes(trail, trail_marker, instance_data, kwargs['instance']._meta)
+    if field_changes:
+        TrailFieldChange.objects.bulk_create(field_changes)
+
+
+def update_database_rollups(**kwargs):
+    '''
+    Count the trail in the activity rollups.
+    '''
+    trail = kwargs.get('trail')
+    if not trails_settings.USE_DATABASE or not trails_settings.ROLLUPS or not trail:
+        return
+    instance = kwargs.get('instance')
+    ctype_id = ContentType.objects.get_for_model(instance).pk if instance is not None else None
+    TrailRollup.objects.increment(
+        get_rollup_day(trail.created), ctype_id, trail.action, trail.user_id, last_trail_id=trail.pk,
+    )
+
+
+def update_search_index(**kwargs):
+    '''
+    Add the trail to the full-text search index.
+    '''
+    trail = kwargs.get('trail')
+    if not trails_settings.USE_DATABASE or not trails_settings.SEARCH_INDEX or not trail:
+        return
+    related_trail_markers = kwargs.get('related_trail_markers') or []
+    if (kwargs.get('related_trail_marker_count') or 0) > len(related_trail_markers):
+        # Markers for objects recorded in bulk are only in the database.
+        trail_markers = trail.markers.only('obj_text', 'obj_text_ref', 'data').iterator()
+    else:
+        trail_markers = [kwargs.get('primary_trail_marker')] + list(related_trail_markers)
+    document = get_search_document(trail, [m for m in trail_markers if m])
+    get_search_backend(trail._state.db).index_trail(trail.pk, document)
@@ -1,149 +1,282 @@
 # Python
 import collections
 import fnmatch
+import re
+import types
 
 # Django
 from django.apps import apps
 from django.db import models
 
 # Django-Trails
+from .deletion import install as install_delete_groups, uninstall as uninstall_delete_groups
 from .settings import trails_settings
-from .tracker import ModelTracker, ManyToManyTracker, UserTracker
+from .tracker import ModelTracker, ManyToManyTracker, UserTracker, dispatcher
 
 __all__ = ['registry']
 
 
+class PatternSet(object):
+    '''
+    Precompiled set of shell-style patterns matched case-insensitively against
+    model or field labels.
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = [pattern.lower() for pattern in patterns]
+        self.matched = set()
+        self.labels = []
+        if self.patterns:
+            regex = '|'.join([
+                '(?P<p{}>{})'.format(n, fnmatch.translate(pattern))
+                for n, pattern in enumerate(self.patterns)
+            ])
+            self._match = re.compile(regex).match
+        else:
+            self._match = None
+
+    def match(self, label):
+        '''
+        Return True if the (lowercase) label matches any pattern.
+        '''
+        if not self._match:
+            return False
+        self.labels.append(label)
+        match = self._match(label)
+        if not match:
+            return False
+        for group_name, value in match.groupdict().items():
+            if value is not None:
+                self.matched.add(int(group_name[1:]))
+                break
+        return True
+
+    def match_any(self, labels):
+        '''
+        Return True if any of the given (lowercase) labels match any pattern.
+        '''
+        return any([self.match(label) for label in labels])
+
+    def warn_unmatched(self, message, get_other_labels=None):
+        '''
+        Print a warning for each pattern that did not match any label, nor any
+        of the labels returned by get_other_labels (only called when a pattern
+        did not match) for labels that weren't matched against the patterns.
+        '''
+        # Only the first matching pattern is noted for each label, so check
+        # any remaining patterns against all labels before warning.
+        unmatched = [
+            pattern for n, pattern in enumerate(self.patterns)
+            if n not in self.matched and not fnmatch.filter(self.labels, pattern)
+        ]
+        if unmatched and get_other_labels:
+            other_labels = get_other_labels()
+            unmatched = [pattern for pattern in unmatched if not fnmatch.filter(other_labels, pattern)]
+        for pattern in unmatched:
+            print(message, pattern)
+
+
+class RegistrySnapshot(object):
+    '''
+    Immutable set of model, many to many and user trackers in use.
+    '''
+
+    __slots__ = ('model_trackers', 'm2m_trackers', 'user_tracker')
+
+    def __init__(self, model_trackers=None, m2m_trackers=None, user_tracker=None):
+        object.__setattr__(self, 'model_trackers', types.MappingProxyType(collections.OrderedDict(model_trackers or ())))
+        object.__setattr__(self, 'm2m_trackers', types.MappingProxyType(collections.OrderedDict(m2m_trackers or ())))
+        object.__setattr__(self, 'user_tracker', user_tracker)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError('RegistrySnapshot is immutable')
+
+    def iter_trackers(self):
+        for tracker in self.model_trackers.values():
+            yield tracker
+        for tracker in self.m2m_trackers.values():
+            yield tracker
+        if self.user_tracker:
+            yield self.user_tracker
+
+
+RegistryDiff = collections.namedtuple('RegistryDiff', ['added', 'changed', 'removed'])
+
+
 class ModelRegistry(object):
     '''
     Registry of model classes and ModelTracker instances for each model.
     '''
 
     def __init__(self):
-        self.model_trackers = collections.OrderedDict()
-        self.m2m_trackers = collections.OrderedDict()
-        self.user_tracker = None
+        self.snapshot = RegistrySnapshot()
 
-    def add(self, model_class, model_fields):
-        model_tracker = self.model_trackers.get(model_class, None)
-        if not model_tracker or model_tracker.model_fields != model_fields:
-            self.model_trackers[model_class] = ModelTracker(model_class, model_fields)
+    @property
+    def model_trackers(self):
+        return self.snapshot.model_trackers
+
+    @property
+    def m2m_trackers(self):
+        return self.snapshot.m2m_trackers
+
+    @property
+    def user_tracker(self):
+        return self.snapshot.user_tracker
+
+    @property
+    def dispatcher(self):
+        '''
+        Return the shared signal dispatcher, if enabled.
+        '''
+        return dispatcher if trails_settings.SIGNAL_DISPATCHER else None
 
-    def remove(self, model_class):
-        model_tracker = self.model_trackers.pop(model_class, None)
-        if model_tracker:
-            model_tracker.disconnect()
+    def get_model_tracker(self, model_class, model_fields, diff):
+        model_tracker = self.model_trackers.get(model_class, None)
+        if model_tracker and model_tracker.model_fields == model_fields and model_tracker.dispatcher is self.dispatcher:
+            return model_tracker
+        (diff.changed if model_tracker else diff.added).append(model_class)
+        return ModelTracker(model_class, model_fields, dispatcher=self.dispatcher)
 
-    def add_m2m(self, m2m_model_class, related_model_fields):
+    def get_m2m_tracker(self, m2m_model_class, related_model_fields, diff):
         m2m_tracker = self.m2m_trackers.get(m2m_model_class, None)
-        if not m2m_tracker or m2m_tracker.related_model_fields != related_model_fields:
-            self.m2m_trackers[m2m_model_class] = ManyToManyTracker(m2m_model_class, related_model_fields)
+        if m2m_tracker and m2m_tracker.related_model_fields == related_model_fields and m2m_tracker.dispatcher is self.dispatcher:
+            return m2m_tracker
+        (diff.changed if m2m_tracker else diff.added).append(m2m_model_class)
+        return ManyToManyTracker(m2m_model_class, related_model_fields, dispatcher=self.dispatcher)
+
+    def get_user_tracker(self):
+        options = dict(
+            track_login=trails_settings.TRACK_LOGIN,
+            track_logout=trails_settings.TRACK_LOGOUT,
+            track_failed_login=trails_settings.TRACK_FAILED_LOGIN,
+        )
+        user_tracker = self.user_tracker
+        if user_tracker and all([getattr(user_tracker, k) == v for k, v in options.items()]):
+            return user_tracker
+        return UserTracker(**options)
+
+    def swap(self, snapshot):
+        '''
+        Replace the current snapshot, then disconnect any trackers no longer in
+        use. New trackers are connected before the swap, so signals for models
+        being updated are never left without a receiver.
+        '''
+        old_snapshot, self.snapshot = self.snapshot, snapshot
+        in_use = set([id(tracker) for tracker in snapshot.iter_trackers()])
+        for tracker in old_snapshot.iter_trackers():
+            if id(tracker) not in in_use:
+                tracker.disconnect()
+
+    def get_model_fields(self, model_class, m2m_only=False):
+        '''
+        Build mapping of field name -> field action for the given model class.
+        '''
+        model_fields = collections.OrderedDict()
+        for field in model_class._meta.get_fields(include_hidden=True):
+            if m2m_only and not field.many_to_many:
+                continue
+            if hasattr(field, 'get_accessor_name'):
+                field_name = field.get_accessor_name()
+            else:
+                field_name = getattr(field, 'attname', field.name)
+            if field.many_to_many and field_name:
+                m2m_model_class = getattr(model_class, field_name).through
+                model_fields[field_name] = m2m_model_class
+            elif not field.concrete:
+                continue
+            elif not field.is_relation:
+                model_fields[field_name] = True
+            else:
+                if field.one_to_one or (field.many_to_one and field.related_model):
+                    if field_name != field.name:
+                        model_fields[field.name] = True
+                        model_fields[field_name] = (field.name, field.related_model)  # fk_field_id -> (fk_field, rel_model)
+                    else:
+                        model_fields[field_name] = True
+        return model_fields
 
-    def remove_m2m(self, m2m_model_class):
-        m2m_tracker = self.m2m_trackers.pop(m2m_model_class, None)
-        if m2m_tracker:
-            m2m_tracker.disconnect()
+    def get_field_labels(self, model_class, model_label):
+        '''
+        Return labels for all field names of the given model class, without
+        building its field mapping.
+        '''
+        field_names = set()
+        for field in model_class._meta.get_fields(include_hidden=True):
+            if hasattr(field, 'get_accessor_name'):
+                field_names.add(field.get_accessor_name() or '')
+            field_names.update([field.name, getattr(field, 'attname', field.name)])
+        return ['{}.{}'.format(model_label, field_name.lower()) for field_name in field_names if field_name]
 
     def update_from_settings(self):
-        model_label_map = collections.OrderedDict()  # Model label -> model class.
+        '''
+        Update trackers from the current settings, only replacing trackers for
+        models that were added, changed or removed. Return the diff.
+        '''
+        include_models = PatternSet(trails_settings.INCLUDE_MODELS)
+        exclude_models = PatternSet(trails_settings.EXCLUDE_MODELS)
+        exclude_fields = PatternSet(trails_settings.EXCLUDE_FIELDS)
+        sensitive_fields = PatternSet(trails_settings.SENSITIVE_FIELDS)
+        ignore_only_fields = PatternSet(trails_settings.IGNORE_ONLY_FIELDS)
         model_class_map = collections.OrderedDict()  # Model class -> include/exclude boolean.
         model_field_map = collections.OrderedDict()  # Model class -> field name -> field action.
-        model_field_label_map = collections.OrderedDict()  # app.model.field -> (model class, field name).
+        excluded_model_labels = []  # (Model class, label) of models not included.
 
-        # Build mappings of models and fields.
+        # Determine which models are included, then build mappings of fields;
+        # full field maps are only needed for included models, excluded models
+        # only need their many to many fields.
         for app_config in apps.get_app_configs():
             for model_class in app_config.get_models():
                 opts = model_class._meta
+                model_labels = (
+                    '{}.{}'.format(opts.app_label, opts.model_name).lower(),
+                    '{}.{}'.format(opts.app_config.name, opts.model_name).lower(),
+                )
+                model_included = include_models.match_any(model_labels)
+                model_excluded = exclude_models.match_any(model_labels)
+                # Always exclude trails model(s).
+                model_included = bool(model_included and not model_excluded and opts.app_config.name != 'trails')
+                model_class_map[model_class] = model_included
+                if not model_included:
+                    excluded_model_labels.append((model_class, model_labels[0]))
+                model_fields = self.get_model_fields(model_class, m2m_only=not model_included)
+                model_field_map[model_class] = model_fields
 
-                # Indicate model class is neither explicitly included or excluded.
-                model_class_map[model_class] = None
+                # Explicitly exclude fields matching configured exclude
+                # patterns, then mark sensitive and ignore-only fields matching
+                # configured field patterns.
+                for field_name, field_action in model_fields.items():
+                    field_label = '{}.{}'.format(model_labels[0], field_name.lower())
+                    if exclude_fields.match(field_label):
+                        model_fields[field_name] = False
+                    elif sensitive_fields.match(field_label) and field_action is True:
+                        model_fields[field_name] = '__SENSITIVE__'
+                    elif ignore_only_fields.match(field_label) and field_action is True:
+                        model_fields[field_name] = '__IGNORE_ONLY__'
 
-                # Add mapping by app_label.modelname
-                model_label = '{}.{}'.format(opts.app_label, opts.model_name)
-                model_label_map[model_label.lower()] = model_class
+        include_models.warn_unmatched('warning: include pattern does not match any known models')
+        exclude_models.warn_unmatched('warning: exclude pattern does not match any known models')
 
-                # Add alternate mapping by app.full.path.modelname
-                model_label_alt = '{}.{}'.format(opts.app_config.name, opts.model_name)
-                model_label_map[model_label_alt.lower()] = model_class
+        # Field patterns are only matched against fields of included models,
+        # so check unmatched ones against the fields of all other models.
+        excluded_field_labels = []
 
-                # Build mapping of model fields for each model class.
-                model_field_map[model_class] = collections.OrderedDict()
-                for field in opts.get_fields(include_hidden=True):
-                    if hasattr(field, 'get_accessor_name'):
-                        field_name = field.get_accessor_name()
-                    else:
-                        field_name = getattr(field, 'attname', field.name)
-                    if field.many_to_many and field_name:
-                        m2m_model_class = getattr(model_class, field_name).through
-                        model_field_map[model_class][field_name] = m2m_model_class
-                    elif not field.concrete:
-                        continue
-                    elif not field.is_relation:
-                        model_field_map[model_class][field_name] = True
-                    else:
-                        if field.one_to_one or (field.many_to_one and field.related_model):
-                            if field_name != field.name:
-                                model_field_map[model_class][field.name] = True
-                                model_field_map[model_class][field_name] = (field.name, field.related_model)  # fk_field_id -> (fk_field, rel_model)
-                            else:
-                                model_field_map[model_class][field_name] = True
-
-                # Update mapping of app.model.field labels from model fields.
-                for field_name, field_status in model_field_map[model_class].items():
-                    field_label = '{}.{}.{}'.format(opts.app_label, opts.model_name, field_name)
-                    model_field_label_map[field_label.lower()] = (model_class, field_name)
-
-        # Explicitly include models matching configured include patterns.
-        for include_pattern in trails_settings.INCLUDE_MODELS:
-            include_labels = fnmatch.filter(model_label_map.keys(), include_pattern.lower())
-            if not include_labels:
-                print('warning: include pattern does not match any known models', include_pattern)
-            for include_label in include_labels:
-                model_class = model_label_map[include_label]
-                model_class_map[model_class] = True
-
-        # Explicitly exclude models matching configured exclude patterns.
-        for exclude_pattern in trails_settings.EXCLUDE_MODELS:
-            exclude_labels = fnmatch.filter(model_label_map.keys(), exclude_pattern.lower())
-            if not exclude_labels:
-                print('warning: exclude pattern does not match any known models', exclude_pattern)
-            for exclude_label in exclude_labels:
-                model_class = model_label_map[exclude_label]
-                model_class_map[model_class] = False
-
-        # Always exclude trails model(s).
-        if 'trails.trail' in model_label_map:
-            model_class = model_label_map['trails.trail']
-            model_class_map[model_class] = False
-        if 'trails.trailmarker' in model_label_map:
-            model_class = model_label_map['trails.trailmarker']
-            model_class_map[model_class] = False
-
-        # Explicitly exclude fields matching configured exclude patterns.
-        for field_pattern in trails_settings.EXCLUDE_FIELDS:
-            field_labels = fnmatch.filter(model_field_label_map.keys(), field_pattern.lower())
-            if not field_labels:
-                print('warning: exclude pattern does not match any known fields', field_pattern)
-            for field_label in field_labels:
-                model_class, field_name = model_field_label_map[field_label]
-                model_field_map[model_class][field_name] = False
-
-        # Mark sensitive fields matching configured field patterns.
-        for field_pattern in trails_settings.SENSITIVE_FIELDS:
-            field_labels = fnmatch.filter(model_field_label_map.keys(), field_pattern.lower())
-            if not field_labels:
-                print('warning: sensitive fields pattern does not match any known fields', field_pattern)
-            for field_label in field_labels:
-                model_class, field_name = model_field_label_map[field_label]
-                if model_field_map[model_class][field_name] is True:
-                    model_field_map[model_class][field_name] = '__SENSITIVE__'
-
-        # Update registry with models included/excluded.
+        def get_excluded_field_labels():
+            if not excluded_field_labels:
+                for model_class, model_label in excluded_model_labels:
+                    excluded_field_labels.extend(self.get_field_labels(model_class, model_label))
+            return excluded_field_labels
+
+        exclude_fields.warn_unmatched('warning: exclude pattern does not match any known fields', get_excluded_field_labels)
+        sensitive_fields.warn_unmatched('warning: sensitive fields pattern does not match any known fields', get_excluded_field_labels)
+        ignore_only_fields.warn_unmatched('warning: ignore-only fields pattern does not match any known fields', get_excluded_field_labels)
+
+        # Build new trackers only for models that were added or whose fields
+        # changed, keeping the current trackers for all others.
+        diff = RegistryDiff([], [], [])
+        model_trackers = collections.OrderedDict()
         for model_class, model_included in model_class_map.items():
             if model_included:
-                model_fields = model_field_map[model_class]
-                self.add(model_class, model_fields)
-            else:
-                self.remove(model_class)
+                model_trackers[model_class] = self.get_model_tracker(model_class, model_field_map[model_class], diff)
 
         # Build mapping of M2M model classes to the (model_class, field_name) of
         # each side of the M2M relationship.
@@ -157,19 +290,25 @@ class ModelRegistry(object):
                 m2m_related_model_fields = m2m_model_classes.setdefault(m2m_model_class, collections.OrderedDict())
                 m2m_related_model_fields[(model_class, field_name)] = model_included
 
-        # Update registry with many to many models included/excluded.
+        # Build trackers for included many to many models.
+        m2m_trackers = collections.OrderedDict()
         for m2m_model_class, related_model_fields in m2m_model_classes.items():
             if any(related_model_fields.values()):
-                self.add_m2m(m2m_model_class, set(related_model_fields.keys()))
-            else:
-                self.remove_m2m(m2m_model_class)
+                m2m_trackers[m2m_model_class] = self.get_m2m_tracker(m2m_model_class, set(related_model_fields.keys()), diff)
 
-        # Register a single tracker for user login/logout signals.
-        self.user_tracker = UserTracker(
-            track_login=trails_settings.TRACK_LOGIN,
-            track_logout=trails_settings.TRACK_LOGOUT,
-            track_failed_login=trails_settings.TRACK_FAILED_LOGIN,
-        )
+        # Group deletions triggered by each call to delete() only while enabled.
+        if trails_settings.AGGREGATE_DELETES:
+            install_delete_groups()
+        else:
+            uninstall_delete_groups()
+
+        # Swap in the new set of trackers, including a single tracker for user
+        # login/logout signals.
+        for model_class in list(self.model_trackers.keys()) + list(self.m2m_trackers.keys()):
+            if model_class not in model_trackers and model_class not in m2m_trackers:
+                diff.removed.append(model_class)
+        self.swap(RegistrySnapshot(model_trackers, m2m_trackers, self.get_user_tracker()))
+        return diff
 
 
 registry = ModelRegistry()
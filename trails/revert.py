@@ -0,0 +1,338 @@
+# Python
+import collections
+import contextlib
+import json
+
+# Django
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import router, transaction
+from django.db.models import ProtectedError
+from django.db.models.deletion import Collector
+from django.utils.encoding import smart_text
+
+# Django-Trails
+from .context import read_from_primary
+from .diff import decode_change, decode_data
+from .settings import trails_settings
+
+__all__ = ['RevertConflictError', 'RevertOperation', 'RevertPlan', 'plan_revert', 'revert_trails']
+
+
+class RevertConflictError(Exception):
+    '''
+    Raised when applying a revert plan with conflicts without forcing it.
+    '''
+
+    def __init__(self, plan):
+        self.plan = plan
+        super(RevertConflictError, self).__init__('{} operation(s) conflict with later changes'.format(len(plan.conflicts)))
+
+
+def _normalize(value):
+    # Compare values as they would be stored in trail data.
+    return json.loads(json.dumps(value, cls=trails_settings.JSON_ENCODER))
+
+
+class RevertOperation(object):
+    '''
+    Operation to revert all changes to a single object: "update" to restore
+    field values, "delete" to remove an added object or "create" to restore a
+    deleted one.
+    '''
+
+    def __init__(self, model, pk):
+        self.model = model
+        self.pk = pk
+        self.action = None
+        self.values = collections.OrderedDict()
+        self.expected = collections.OrderedDict()
+        self.trail_ids = []
+        self.last_created = None
+        self.conflicts = []
+        self.skipped_fields = []
+
+    def __repr__(self):
+        return '<RevertOperation: {} {} {}>'.format(self.action, self.model._meta.label, self.pk)
+
+    def get_field(self, key):
+        try:
+            return self.model._meta.get_field(key)
+        except FieldDoesNotExist:
+            return None
+
+    def describe(self):
+        text = '{} {} {}'.format(self.action, self.model._meta.label, self.pk)
+        if self.action == 'update':
+            changes = ['{}: {!r} -> {!r}'.format(k, self.expected.get(k), v) for k, v in self.values.items()]
+            text = '{} ({})'.format(text, ', '.join(changes))
+        return text
+
+
+def _bulk_update(manager, objs, fields):
+    # QuerySet.bulk_update() is only available on Django >= 2.2.
+    if hasattr(manager, 'bulk_update'):
+        manager.bulk_update(objs, fields)
+        return
+    attnames = [manager.model._meta.get_field(name).attname for name in fields]
+    for obj in objs:
+        manager.filter(pk=obj.pk).update(**dict([(attname, getattr(obj, attname)) for attname in attnames]))
+
+
+class RevertPlan(object):
+    '''
+    Inverse operations for a set of trails, grouped by object, along with any
+    conflicts with later changes and trails that can't be reverted.
+    '''
+
+    def __init__(self):
+        self.trail_ids = set()
+        self.operations = collections.OrderedDict()
+        self.skipped = []
+
+    def __repr__(self):
+        return '<RevertPlan: {} operations, {} conflicts, {} skipped>'.format(
+            len(self.operations), len(self.conflicts), len(self.skipped),
+        )
+
+    @property
+    def conflicts(self):
+        return [op for op in self.operations.values() if op.conflicts]
+
+    def get_operation(self, model, pk):
+        key = (model, smart_text(pk))
+        if key not in self.operations:
+            self.operations[key] = RevertOperation(model, pk)
+        return self.operations[key]
+
+    def report(self):
+        '''
+        Return a list of lines describing the plan, e.g. for a dry run.
+        '''
+        lines = []
+        for op in self.operations.values():
+            lines.append(op.describe())
+            for conflict in op.conflicts:
+                lines.append('  CONFLICT: {}'.format(conflict))
+            for key in op.skipped_fields:
+                lines.append('  skipped field {}: value not recorded'.format(key))
+        for trail_id, action, reason in self.skipped:
+            lines.append('skipped trail {} ({}): {}'.format(trail_id, action, reason))
+        return lines
+
+    def apply(self, force=False):
+        '''
+        Apply all operations in bulk, grouped by model, in a single transaction.
+        The objects are locked and conflicts checked again first, so changes
+        made since the plan was made aren't overwritten. Operations with
+        conflicts are left out when forced, otherwise nothing is applied.
+        Return counts of objects updated, deleted and created.
+        '''
+        if self.conflicts and not force:
+            raise RevertConflictError(self)
+        from .models import Trail
+        from .utils import record_trail
+        counts = collections.OrderedDict([('updated', 0), ('deleted', 0), ('created', 0)])
+        models = set([op.model for op in self.operations.values()])
+        aliases = set([router.db_for_write(Trail)] + [router.db_for_write(model) for model in models])
+        with contextlib.ExitStack() as stack:
+            for alias in sorted(aliases):
+                stack.enter_context(transaction.atomic(using=alias))
+            for op in self.operations.values():
+                op.conflicts = []
+            with read_from_primary():
+                _check_conflicts(self, lock=True)
+            if self.conflicts and not force:
+                raise RevertConflictError(self)
+            by_model = collections.OrderedDict()
+            for op in self.operations.values():
+                if not op.conflicts and op.action:
+                    by_model.setdefault(op.model, []).append(op)
+            for model, ops in by_model.items():
+                manager = model._default_manager.db_manager(router.db_for_write(model))
+                updates = [op for op in ops if op.action == 'update' and op.values]
+                current = manager.in_bulk([op.pk for op in updates])
+                by_fields = collections.OrderedDict()
+                for op in updates:
+                    obj = current.get(op.pk)
+                    if obj is None:
+                        op.conflicts.append('object no longer exists')
+                        continue
+                    fields = []
+                    for key, value in op.values.items():
+                        field = op.get_field(key)
+                        setattr(obj, field.attname, field.to_python(value))
+                        fields.append(field.name)
+                    by_fields.setdefault(tuple(fields), []).append(obj)
+                for fields, objs in by_fields.items():
+                    _bulk_update(manager, objs, list(fields))
+                    counts['updated'] += len(objs)
+                deletes = [op.pk for op in ops if op.action == 'delete']
+                if deletes:
+                    counts['deleted'] += manager.filter(pk__in=deletes).delete()[1].get(model._meta.label, 0)
+                creates = []
+                for op in ops:
+                    if op.action == 'create':
+                        obj = model(pk=op.pk)
+                        for key, value in op.values.items():
+                            field = op.get_field(key)
+                            setattr(obj, field.attname, field.to_python(value))
+                        creates.append(obj)
+                if creates:
+                    manager.bulk_create(creates)
+                    counts['created'] += len(creates)
+            record_trail('revert', data=dict(counts, trails=sorted(self.trail_ids)))
+        return counts
+
+
+def _plan_trail(plan, trail, marker):
+    model = marker.ctype.model_class()
+    if model is None:
+        plan.skipped.append((trail.pk, trail.action, 'model no longer exists'))
+        return
+    try:
+        pk = model._meta.pk.to_python(marker.obj_pk)
+    except ValidationError:
+        plan.skipped.append((trail.pk, trail.action, 'invalid primary key'))
+        return
+    data = decode_data(marker.data) or {}
+    if trail.action == 'add':
+        op = plan.get_operation(model, pk)
+        op.action = 'delete'
+    elif trail.action == 'change':
+        op = plan.get_operation(model, pk)
+        if op.action is None:
+            op.action = 'update'
+        for key, value in data.items():
+            if op.get_field(key) is None:
+                continue
+            before, after = decode_change(value)
+            if trails_settings.SENSITIVE_TEXT in (before, after):
+                if key not in op.skipped_fields:
+                    op.skipped_fields.append(key)
+                continue
+            # Restore the value from before the earliest change, and expect the
+            # value from after the latest one.
+            op.values.setdefault(key, before)
+            op.expected[key] = after
+    elif trail.action == 'delete':
+        values = [(k, v) for k, v in data.items() if not k.startswith('__')]
+        if not values:
+            plan.skipped.append((trail.pk, trail.action, 'field values were not recorded'))
+            return
+        op = plan.get_operation(model, pk)
+        if op.action == 'delete':
+            # Added and deleted within the trails being reverted.
+            del plan.operations[(model, smart_text(pk))]
+            return
+        op.action = 'create'
+        op.values = collections.OrderedDict(values)
+    else:
+        plan.skipped.append((trail.pk, trail.action, 'action can not be reverted'))
+        return
+    op.trail_ids.append(trail.pk)
+    op.last_created = trail.created
+
+
+def _check_conflicts(plan, lock=False):
+    # With lock, the objects are locked until the end of the transaction.
+    from .models import TrailMarker
+    by_model = collections.OrderedDict()
+    for op in plan.operations.values():
+        by_model.setdefault(op.model, []).append(op)
+    deleted = set([key for key, op in plan.operations.items() if op.action == 'delete'])
+    for model, ops in by_model.items():
+        ops_by_pk = dict([(smart_text(op.pk), op) for op in ops])
+        # Later trails for the same objects that aren't being reverted.
+        later = TrailMarker.objects.filter(
+            ctype=ContentType.objects.get_for_model(model),
+            obj_pk__in=list(ops_by_pk.keys()),
+            rel='',
+            trail__created__gt=min([op.last_created for op in ops]),
+        ).exclude(trail_id__in=plan.trail_ids).values_list('obj_pk', 'trail_id', 'trail__action', 'trail__created')
+        for obj_pk, trail_id, action, created in later:
+            op = ops_by_pk[obj_pk]
+            if created > op.last_created:
+                op.conflicts.append('{} by trail {} at {}'.format(action, trail_id, created))
+        queryset = model._default_manager.all()
+        if lock:
+            queryset = queryset.using(router.db_for_write(model)).select_for_update()
+        current = queryset.in_bulk([op.pk for op in ops])
+        for op in ops:
+            obj = current.get(op.pk)
+            if op.action == 'create':
+                if obj is not None:
+                    op.conflicts.append('object already exists')
+                continue
+            if obj is None:
+                op.conflicts.append('object no longer exists')
+                continue
+            if op.action == 'delete':
+                # Refuse to delete other objects that aren't being reverted.
+                try:
+                    cascades = _get_cascades(obj, deleted)
+                except ProtectedError as e:
+                    op.conflicts.append('deleting is prevented by {} protected object(s)'.format(len(e.protected_objects)))
+                    continue
+                for related_model, count in cascades:
+                    op.conflicts.append('deleting would also delete {} {} object(s)'.format(count, related_model._meta.label))
+            for key, expected in op.expected.items():
+                field = op.get_field(key)
+                value = field.value_from_object(obj)
+                if _normalize(value) != _normalize(expected):
+                    op.conflicts.append('{} is now {!r}, expected {!r}'.format(key, value, expected))
+
+
+def _get_cascades(obj, deleted):
+    '''
+    Return a list of (model, count) for other objects that would also be
+    deleted along with obj, excluding objects in deleted (a set of (model, pk)
+    pairs) and the parents of obj.
+    '''
+    model = obj._meta.model
+    parents = model._meta.get_parent_list()
+    collector = Collector(using=router.db_for_write(model))
+    collector.collect([obj])
+    counts = collections.OrderedDict()
+    related = [(m, [o.pk for o in instances]) for m, instances in collector.data.items()]
+    related.extend([(qs.model, list(qs.values_list('pk', flat=True))) for qs in collector.fast_deletes])
+    for related_model, pks in related:
+        for pk in pks:
+            if pk == obj.pk and (related_model is model or related_model in parents):
+                continue
+            if (related_model, smart_text(pk)) in deleted:
+                continue
+            counts[related_model] = counts.get(related_model, 0) + 1
+    return list(counts.items())
+
+
+def plan_revert(trails):
+    '''
+    Plan reverting the changes recorded by the given trails (a queryset),
+    checking for conflicts with later trails and the current field values.
+    Later trails are read from the primary database, not READ_DATABASE, so
+    none are missed because of replication lag.
+    '''
+    plan = RevertPlan()
+    trails = trails.order_by('created', 'pk').prefetch_related('markers', 'markers__ctype')
+    with read_from_primary():
+        for trail in trails:
+            plan.trail_ids.add(trail.pk)
+            markers = [m for m in trail.markers.all() if not m.rel]
+            if not markers:
+                plan.skipped.append((trail.pk, trail.action, 'no object recorded'))
+                continue
+            _plan_trail(plan, trail, sorted(markers, key=lambda m: m.pk)[0])
+        _check_conflicts(plan)
+    return plan
+
+
+def revert_trails(trails, dry_run=False, force=False):
+    '''
+    Revert the changes recorded by the given trails. Return the plan, which is
+    only applied when dry_run is False.
+    '''
+    plan = plan_revert(trails)
+    if not dry_run:
+        plan.apply(force=force)
+    return plan
@@ -0,0 +1,58 @@
+# Django
+from django.db import router
+
+# Django-Trails
+from .context import get_read_primary
+from .settings import trails_settings
+
+__all__ = ['TrailsRouter']
+
+
+class TrailsRouter(object):
+    '''
+    Database router sending reads of trails models to READ_DATABASE, e.g. a
+    read replica, unless reading from the primary in the current context. Add
+    to DATABASE_ROUTERS before any other routers handling trails models. The
+    primary is the database trails are written to by the other routers (or
+    the default database), and migrations aren't run on READ_DATABASE.
+    '''
+
+    def _is_trails_model(self, model):
+        return model._meta.app_label == 'trails'
+
+    def _get_primary(self, model):
+        # Without an instance hint, db_for_write() below returns None, so the
+        # other routers (or the default database) choose the primary.
+        return router.db_for_write(model)
+
+    def db_for_read(self, model, **hints):
+        if not self._is_trails_model(model) or not trails_settings.READ_DATABASE:
+            return None
+        if get_read_primary():
+            return self._get_primary(model)
+        return trails_settings.READ_DATABASE
+
+    def db_for_write(self, model, **hints):
+        # Save trails read from the replica back to the primary.
+        if not self._is_trails_model(model) or not trails_settings.READ_DATABASE:
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db == trails_settings.READ_DATABASE:
+            return self._get_primary(model)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not trails_settings.READ_DATABASE:
+            return None
+        if not self._is_trails_model(obj1._meta.model) and not self._is_trails_model(obj2._meta.model):
+            return None
+        databases = {self._get_primary(obj1._meta.model), self._get_primary(obj2._meta.model), trails_settings.READ_DATABASE}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # READ_DATABASE gets the trails tables by replication from the primary.
+        if app_label == 'trails' and db == trails_settings.READ_DATABASE:
+            return False
+        return None
@@ -0,0 +1,204 @@
+# Django
+from django.db import connections, router
+from django.db.models import Q
+from django.utils.encoding import smart_text
+
+# Django-Trails
+from .diff import decode_data
+from .settings import trails_settings
+
+__all__ = ['get_search_backend', 'get_search_document', 'search_trails', 'create_search_index']
+
+# Name of the table holding the search index, created after migrating when
+# SEARCH_INDEX is enabled.
+SEARCH_TABLE = 'trails_trailsearch'
+
+
+def _iter_values(value):
+    if isinstance(value, dict):
+        for item in value.values():
+            for v in _iter_values(item):
+                yield v
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            for v in _iter_values(item):
+                yield v
+    elif isinstance(value, (str, int, float)) and not isinstance(value, bool):
+        yield smart_text(value)
+
+
+def get_search_document(trail, trail_markers):
+    '''
+    Return the text to index for a trail: the user, the text of each marker
+    and all values inside the trail and marker data.
+    '''
+    parts = [trail.action, trail.user_display]
+    parts.extend(_iter_values(trail.data))
+    for trail_marker in trail_markers:
+        parts.append(trail_marker.obj_display)
+        parts.extend(_iter_values(decode_data(trail_marker.data)))
+    return ' '.join([part for part in parts if part])
+
+
+class SearchBackend(object):
+    '''
+    Search without an index, using case-insensitive matches on the user and
+    marker text (but not data). Used for databases without a search index
+    backend.
+    '''
+
+    vendor = None
+
+    def __init__(self, using):
+        self.using = using
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def create_index(self):
+        pass
+
+    def index_trail(self, trail_pk, document):
+        pass
+
+    def filter_ids(self, queryset, sql, params):
+        # Not pk__in=RawSQL(...), which wraps the subquery in extra parentheses
+        # that turn it into a scalar subquery.
+        qn = self.connection.ops.quote_name
+        pk_column = '{}.{}'.format(qn(queryset.model._meta.db_table), qn(queryset.model._meta.pk.column))
+        return queryset.extra(where=['{} IN ({})'.format(pk_column, sql)], params=params)
+
+    def filter(self, queryset, query):
+        q = Q()
+        for term in query.split():
+            term_q = Q(user_text__icontains=term) | Q(user_text_ref__text__icontains=term)
+            term_q |= Q(markers__obj_text__icontains=term) | Q(markers__obj_text_ref__text__icontains=term)
+            q &= term_q
+        return queryset.filter(pk__in=queryset.model._default_manager.filter(q).values('pk'))
+
+
+class SqliteSearchBackend(SearchBackend):
+    '''
+    Search index using an SQLite FTS5 virtual table, with the trail id as the
+    rowid.
+    '''
+
+    vendor = 'sqlite'
+
+    def create_index(self):
+        opts = _get_trail_model()._meta
+        qn = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(document)'.format(SEARCH_TABLE))
+            cursor.execute(
+                'CREATE TRIGGER IF NOT EXISTS {0}_delete AFTER DELETE ON {1} '
+                'BEGIN DELETE FROM {0} WHERE rowid = old.{2}; END'.format(SEARCH_TABLE, qn(opts.db_table), qn(opts.pk.column))
+            )
+
+    def index_trail(self, trail_pk, document):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT OR REPLACE INTO {} (rowid, document) VALUES (%s, %s)'.format(SEARCH_TABLE),
+                [trail_pk, document],
+            )
+
+    def filter(self, queryset, query):
+        # Quote each term so punctuation (e.g. in email addresses) is matched
+        # as a phrase instead of being parsed as query syntax.
+        match = ' '.join(['"{}"'.format(term.replace('"', '""')) for term in query.split()])
+        if not match:
+            return queryset
+        sql = 'SELECT rowid FROM {0} WHERE {0} MATCH %s'.format(SEARCH_TABLE)
+        return self.filter_ids(queryset, sql, [match])
+
+
+class PostgresSearchBackend(SearchBackend):
+    '''
+    Search index using a tsvector column with a GIN index on PostgreSQL. The
+    "simple" configuration is used so identifiers aren't stemmed.
+    '''
+
+    vendor = 'postgresql'
+
+    def create_index(self):
+        opts = _get_trail_model()._meta
+        qn = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS {} (trail_id integer PRIMARY KEY, document tsvector NOT NULL)'.format(SEARCH_TABLE)
+            )
+            cursor.execute('CREATE INDEX IF NOT EXISTS {0}_document ON {0} USING GIN (document)'.format(SEARCH_TABLE))
+            # Triggers instead of a foreign key, which would make the trails
+            # table impossible to truncate (e.g. by flush) without CASCADE.
+            cursor.execute(
+                'CREATE OR REPLACE FUNCTION {0}_delete() RETURNS trigger AS $$ BEGIN '
+                'IF TG_OP = \'TRUNCATE\' THEN TRUNCATE {0}; RETURN NULL; END IF; '
+                'DELETE FROM {0} WHERE trail_id = OLD.{1}; RETURN OLD; '
+                'END; $$ LANGUAGE plpgsql'.format(SEARCH_TABLE, qn(opts.pk.column))
+            )
+            cursor.execute('DROP TRIGGER IF EXISTS {0}_delete ON {1}'.format(SEARCH_TABLE, qn(opts.db_table)))
+            cursor.execute(
+                'CREATE TRIGGER {0}_delete AFTER DELETE ON {1} '
+                'FOR EACH ROW EXECUTE PROCEDURE {0}_delete()'.format(SEARCH_TABLE, qn(opts.db_table))
+            )
+            cursor.execute('DROP TRIGGER IF EXISTS {0}_truncate ON {1}'.format(SEARCH_TABLE, qn(opts.db_table)))
+            cursor.execute(
+                'CREATE TRIGGER {0}_truncate AFTER TRUNCATE ON {1} '
+                'FOR EACH STATEMENT EXECUTE PROCEDURE {0}_delete()'.format(SEARCH_TABLE, qn(opts.db_table))
+            )
+
+    def index_trail(self, trail_pk, document):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO {} (trail_id, document) VALUES (%s, to_tsvector(\'simple\', %s)) '
+                'ON CONFLICT (trail_id) DO UPDATE SET document = EXCLUDED.document'.format(SEARCH_TABLE),
+                [trail_pk, document],
+            )
+
+    def filter(self, queryset, query):
+        if not query.split():
+            return queryset
+        sql = 'SELECT trail_id FROM {} WHERE document @@ plainto_tsquery(\'simple\', %s)'.format(SEARCH_TABLE)
+        return self.filter_ids(queryset, sql, [query])
+
+
+SEARCH_BACKENDS = dict([(b.vendor, b) for b in (SqliteSearchBackend, PostgresSearchBackend)])
+
+
+def get_search_backend(using=None, indexed=True):
+    '''
+    Return the search backend for a database, or the backend without an index
+    if the database has none or indexed is False.
+    '''
+    using = using or router.db_for_write(_get_trail_model())
+    backend_class = SEARCH_BACKENDS.get(connections[using].vendor) if indexed else None
+    return (backend_class or SearchBackend)(using)
+
+
+def _get_trail_model():
+    from .models import Trail
+    return Trail
+
+
+def search_trails(queryset, query):
+    '''
+    Filter a queryset of trails to those matching the query, using the search
+    index when SEARCH_INDEX is enabled.
+    '''
+    backend = get_search_backend(queryset.db, indexed=trails_settings.SEARCH_INDEX)
+    return backend.filter(queryset, smart_text(query))
+
+
+def create_search_index(sender, **kwargs):
+    '''
+    Create the search index table after migrating when SEARCH_INDEX is enabled.
+    The trails migrations don't create it, so databases without FTS5 or with
+    the index disabled are left alone.
+    '''
+    if not trails_settings.SEARCH_INDEX:
+        return
+    using = kwargs.get('using') or 'default'
+    if not router.allow_migrate_model(using, _get_trail_model()):
+        return
+    get_search_backend(using).create_index()
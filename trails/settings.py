@@ -38,6 +38,12 @@ DEFAULT_SETTINGS = {
         'auth.User.password',
     ),
 
+    # List of strings specifying fields that never trigger a trail by
+    # themselves, in the format "app_label.ModelName.field_name". Shell-style
+    # wildcards are supported. Changes to these fields (e.g. auto_now
+    # timestamps) are only recorded along with changes to other fields.
+    'IGNORE_ONLY_FIELDS': (),
+
     # Replacement text to use instead of the actual value for sensitive fields.
     'SENSITIVE_TEXT': '(hidden)',
 
@@ -105,6 +111,130 @@ DEFAULT_SETTINGS = {
     # Logger name to use for the Python logging module.
     'LOGGER': 'trails',
 
+    # Store request, session, user and marker object text once in a shared
+    # lookup table and reference it by id, instead of repeating the same text
+    # on every trail and marker.
+    'NORMALIZE_TEXT': False,
+
+    # Number of interned text values to cache in each process.
+    'TEXT_CACHE_SIZE': 1000,
+
+    # Minimum combined size (in characters) of the before and after values of a
+    # changed text or JSON field before the change is stored as a compact diff
+    # instead of a full (before, after) pair. Set to None to always store full
+    # values.
+    'DIFF_THRESHOLD': None,
+
+    # Minimum size (in characters of JSON) of trail and marker data before it is
+    # compressed when stored in the database. Set to None to never compress.
+    'COMPRESS_THRESHOLD': None,
+
+    # Codec used to compress trail and marker data: "zlib", "lzma" or "zstd"
+    # (requires the zstandard package).
+    'COMPRESS_CODEC': 'zlib',
+
+    # Connect a single shared receiver for each model signal and dispatch to
+    # model trackers by sender class, instead of connecting separate receivers
+    # for every tracked model.
+    'SIGNAL_DISPATCHER': False,
+
+    # Keep counters and latency histograms for each pipeline stage, exported in
+    # the Prometheus text format by the trails_metrics command and the
+    # trails.views.metrics view.
+    'METRICS': False,
+
+    # Directory where each process writes its metrics to a memory-mapped file,
+    # so metrics can be aggregated across worker processes. When None, metrics
+    # are only kept in memory for the current process.
+    'METRICS_DIR': None,
+
+    # Upper bounds (in seconds) of the pipeline stage latency histogram buckets.
+    'METRICS_BUCKETS': (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+
+    # Mapping of "app_label.ModelName" to the field names whose values are
+    # joined to build the display text for related objects recorded in bulk
+    # (e.g. many to many changes), so only those fields need to be loaded.
+    # Other models are loaded in full and use str(instance).
+    'TEXT_FIELDS': {
+        'auth.User': ('username',),
+        'auth.Group': ('name',),
+    },
+
+    # Number of rows to load or insert at a time when recording many related
+    # objects at once.
+    'BULK_BATCH_SIZE': 1000,
+
+    # When more than this many objects are added to or removed from a many to
+    # many relation at once, record only a summary with the count and a sample
+    # of primary keys instead of a marker for every object. Set to None to
+    # always record every object.
+    'M2M_SUMMARY_THRESHOLD': None,
+
+    # Number of primary keys to sample when recording a summary.
+    'M2M_SUMMARY_SAMPLE_SIZE': 10,
+
+    # Record all deletions triggered by a single call to delete(), including
+    # cascaded deletes of related objects, as one trail with a marker for each
+    # deleted object, instead of a separate trail for every object.
+    'AGGREGATE_DELETES': False,
+
+    # Cache alias used by Trail.objects.recent_for(), or None to use a
+    # local-memory cache in each process. Invalidation only reaches other
+    # processes through a shared cache, so set an alias when running more
+    # than one process.
+    'RECENT_CACHE': None,
+
+    # Number of seconds to cache the recent trails for each object, or 0 to
+    # disable caching (the default). Cached trails are invalidated whenever a
+    # new marker is recorded for the object.
+    'RECENT_CACHE_TIMEOUT': 0,
+
+    # Update the activity rollup tables (trail counts per day, model, action
+    # and user) as each trail is recorded. When disabled, the rollups can be
+    # updated periodically with the trails_rollup command instead.
+    'ROLLUPS': False,
+
+    # Number of seconds a trail may take to be committed after it's recorded.
+    # Without ROLLUPS, the trails_rollup command waits this long before
+    # counting past a gap in the trail ids, so trails committed late aren't
+    # skipped.
+    'ROLLUP_COMMIT_LAG': 60,
+
+    # Add each trail to a full-text search index (FTS5 on SQLite, tsvector with
+    # a GIN index on PostgreSQL) as it is recorded, and use the index for
+    # Trail.objects.search() and admin searches. Other databases (or when
+    # disabled) fall back to case-insensitive matches on user and object text.
+    'SEARCH_INDEX': False,
+
+    # Record each field changed by a change trail in a separate table indexed
+    # by content type, field name and time, for Trail.objects.field_changes().
+    'FIELD_CHANGE_INDEX': False,
+
+    # Also store hashes of the before and after values of each field change,
+    # so changes from or to a given value can be found.
+    'FIELD_CHANGE_HASH_VALUES': False,
+
+    # Path of a local SQLite database used as a durable spool. When set, trails
+    # are appended to the spool instead of being created in the database, and
+    # the trails_worker command inserts them in batches. Use for processes that
+    # may exit before trails could be written, e.g. short-lived commands.
+    'SPOOL_PATH': None,
+
+    # Database alias (e.g. a read replica) used to read trails when the
+    # trails.routers.TrailsRouter router is added to DATABASE_ROUTERS. Trails
+    # are always written to the primary database (as chosen by other routers),
+    # and the trails tables aren't migrated on READ_DATABASE.
+    'READ_DATABASE': None,
+
+    # Read trails from the primary database for the rest of a request once it
+    # has recorded a trail, so the request sees its own writes. Use
+    # trails.api.read_from_primary() to read from the primary elsewhere.
+    'READ_PRIMARY_AFTER_WRITE': True,
+
+    # Directory for archive files of old trails written by the trails_archive
+    # command, read with Trail.archive.query().
+    'ARCHIVE_DIR': None,
+
     # Replace default admin history view with trails history view.
     'ADMIN_HISTORY': False,
 
@@ -121,10 +251,15 @@ DEFAULT_SETTINGS = {
         'trails.pipeline.add_request_text',
         'trails.pipeline.add_session_text',
         'trails.pipeline.add_user_text',
+        'trails.pipeline.add_text_ids',
         'trails.pipeline.log_trail',
+        'trails.pipeline.spool_trail',
         'trails.pipeline.create_database_trail',
         'trails.pipeline.create_primary_database_trail_marker',
         'trails.pipeline.create_related_database_trail_markers',
+        'trails.pipeline.create_database_field_changes',
+        'trails.pipeline.update_database_rollups',
+        'trails.pipeline.update_search_index',
     ),
 
     # JSON encoder class to use when serializing trail data (model changes).
@@ -140,8 +275,9 @@ STRING_IMPORTS = (
 
 # Set of settings that trigger a reload of the model tracker registry.
 REGISTRY_SETTINGS = {
-    'INCLUDE_MODELS', 'EXCLUDE_MODELS', 'EXCLUDE_FIELDS', 'SENSITIVE_FIELDS',
-    'TRACK_LOGIN', 'TRACK_LOGOUT', 'TRACK_FAILED_LOGIN',
+    'INCLUDE_MODELS', 'EXCLUDE_MODELS', 'EXCLUDE_FIELDS', 'SENSITIVE_FIELDS', 'IGNORE_ONLY_FIELDS',
+    'TRACK_LOGIN', 'TRACK_LOGOUT', 'TRACK_FAILED_LOGIN', 'SIGNAL_DISPATCHER',
+    'AGGREGATE_DELETES',
 }
 
 
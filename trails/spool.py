@@ -0,0 +1,184 @@
+# Python
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Django
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError
+from django.test.signals import setting_changed
+from django.utils.encoding import smart_text
+
+# Django-Trails
+from .importer import RecordError, RecordMapper, insert_batch
+from .settings import trails_settings
+
+__all__ = ['Spool', 'get_spool', 'drain_spool']
+
+
+class Spool(object):
+    '''
+    Durable local queue of trail records in an SQLite database using WAL mode,
+    so records survive a crash of the process that recorded them and can be
+    appended by several processes at once. Records are only removed once they
+    have been inserted into the audit database, or moved to the failed table
+    if they can't be inserted.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def __repr__(self):
+        return '<Spool: {}>'.format(self.path)
+
+    @property
+    def connection(self):
+        # Connections can't be shared between threads or across a fork.
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS spool ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, record TEXT NOT NULL, created REAL NOT NULL)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS failed ('
+                'id INTEGER PRIMARY KEY, record TEXT NOT NULL, error TEXT NOT NULL, created REAL NOT NULL)'
+            )
+            self._local.connection, self._local.pid = connection, pid
+        return self._local.connection
+
+    def append(self, record):
+        '''
+        Add a record, which is committed to disk before returning.
+        '''
+        data = json.dumps(record, cls=trails_settings.JSON_ENCODER)
+        self.connection.execute('INSERT INTO spool (record, created) VALUES (?, ?)', (data, time.time()))
+
+    def read(self, limit):
+        '''
+        Return up to limit of the oldest (id, record) pairs.
+        '''
+        rows = self.connection.execute('SELECT id, record FROM spool ORDER BY id LIMIT ?', (limit,))
+        return [(row_id, json.loads(data)) for row_id, data in rows]
+
+    def ack(self, last_id):
+        '''
+        Remove all records up to and including the given id.
+        '''
+        self.connection.execute('DELETE FROM spool WHERE id <= ?', (last_id,))
+
+    def reject(self, row_id, record, error):
+        '''
+        Keep a record that can't be inserted in the failed table, with the
+        error, so it can be inspected and removed from the spool.
+        '''
+        data = json.dumps(record, cls=trails_settings.JSON_ENCODER)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO failed (id, record, error, created) VALUES (?, ?, ?, ?)',
+            (row_id, data, error, time.time()),
+        )
+
+    def read_failed(self, limit):
+        '''
+        Return up to limit of the oldest (id, record, error) failed records.
+        '''
+        rows = self.connection.execute('SELECT id, record, error FROM failed ORDER BY id LIMIT ?', (limit,))
+        return [(row_id, json.loads(data), error) for row_id, data, error in rows]
+
+    def backlog(self):
+        '''
+        Return the number of records waiting, the age in seconds of the oldest
+        one, the number of failed records and the size of the spool files in
+        bytes.
+        '''
+        count, oldest = self.connection.execute('SELECT COUNT(*), MIN(created) FROM spool').fetchone()
+        failed = self.connection.execute('SELECT COUNT(*) FROM failed').fetchone()[0]
+        size = sum([os.path.getsize(p) for p in (self.path, '{}-wal'.format(self.path)) if os.path.exists(p)])
+        return dict(records=count, oldest_age=max(time.time() - oldest, 0.0) if oldest else 0.0, failed=failed, bytes=size)
+
+
+_spools = {}
+_spools_lock = threading.Lock()
+
+
+def get_spool(path=None):
+    '''
+    Return the spool for the given path or the SPOOL_PATH setting, or None if
+    no spool is configured.
+    '''
+    path = path or trails_settings.SPOOL_PATH
+    if not path:
+        return None
+    spool = _spools.get(path)
+    if spool is None:
+        with _spools_lock:
+            spool = _spools.setdefault(path, Spool(path))
+    return spool
+
+
+def _insert_record(spool, row_id, record, mapped, using):
+    '''
+    Insert a single record, without its user if the user has been deleted
+    since it was recorded, or move it to the failed records.
+    '''
+    trail, markers = mapped
+    try:
+        return insert_batch([mapped], using=using)
+    except IntegrityError as e:
+        error = e
+    User = get_user_model()
+    if trail['user_id'] is not None and not User._default_manager.using(using or 'default').filter(pk=trail['user_id']).exists():
+        trail['user_id'] = None
+        try:
+            return insert_batch([(trail, markers)], using=using)
+        except IntegrityError as e:
+            error = e
+    spool.reject(row_id, record, smart_text(error))
+    return 0
+
+
+def drain_spool(spool, batch_size=5000, using=None, callback=None):
+    '''
+    Insert records from the spool into the database in batches until it is
+    empty. Records are removed only after each batch is committed, and trails
+    already inserted (e.g. when a previous drain was interrupted) are skipped
+    by uid, so each record is delivered at least once but inserted only once.
+    When a batch can't be inserted, its records are inserted one at a time,
+    and records that still fail are moved to the failed records so they don't
+    block the spool. Return the number of records processed.
+    '''
+    mapper = RecordMapper(repr(spool))
+    total = 0
+    while True:
+        rows = spool.read(batch_size)
+        if not rows:
+            break
+        batch = []
+        for row_id, record in rows:
+            try:
+                batch.append((row_id, record, mapper.map(row_id, record)))
+            except RecordError as e:
+                spool.reject(row_id, record, smart_text(e))
+        try:
+            inserted = insert_batch([mapped for row_id, record, mapped in batch], using=using)
+        except IntegrityError:
+            inserted = sum([_insert_record(spool, row_id, record, mapped, using) for row_id, record, mapped in batch])
+        spool.ack(rows[-1][0])
+        total += len(rows)
+        if callback:
+            callback(len(rows), inserted)
+    return total
+
+
+def reset_spools_on_setting_changed(sender, **kwargs):
+    if kwargs['setting'] == 'TRAILS':
+        _spools.clear()
+
+
+setting_changed.connect(reset_spools_on_setting_changed)
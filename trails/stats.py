@@ -0,0 +1,158 @@
+# Python
+import collections
+import contextlib
+import functools
+import time
+
+# Django
+from django.db import connections
+
+# Django-Trails
+from .context import context_var
+
+__all__ = ['TrailsStats', 'collect_stats', 'get_stats', 'start_stats', 'stop_stats', 'measure']
+
+# Active stats collector, propagated to async tasks and sync_to_async calls.
+_stats = context_var('trails_stats')
+
+
+class TrailsStats(object):
+    '''
+    Collector for the trails activity within a single request (or any other
+    block of code), including trails recorded, queries issued and time spent
+    in trackers, pipeline functions and instance serialization.
+    '''
+
+    def __init__(self):
+        self.trails = []
+        self.timings = collections.OrderedDict()
+        self._stack = []
+
+    def __repr__(self):
+        return '<TrailsStats: {} trails, {} queries, {:.3f}ms>'.format(
+            len(self.trails), self.query_count, self.total_time * 1000,
+        )
+
+    @property
+    def query_count(self):
+        return sum([timing['queries'] for timing in self.timings.values()])
+
+    @property
+    def total_time(self):
+        return sum([timing['time'] for timing in self.timings.values()])
+
+    def add_trail(self, action, instance=None):
+        model = instance._meta.label if instance is not None else ''
+        self.trails.append((action, model))
+
+    def _execute_wrapper(self, execute, sql, params, many, context):
+        if self._stack:
+            self._stack[-1][2] += 1
+        return execute(sql, params, many, context)
+
+    @contextlib.contextmanager
+    def measure(self, category, name):
+        '''
+        Measure time and queries for a block of code. Nested blocks are only
+        counted against the innermost category and name.
+        '''
+        frame = [category, name, 0, 0.0]
+        self._stack.append(frame)
+        with contextlib.ExitStack() as stack:
+            if len(self._stack) == 1:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(self._execute_wrapper))
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                elapsed = time.perf_counter() - start
+                self._stack.pop()
+                if self._stack:
+                    self._stack[-1][3] += elapsed
+                timing = self.timings.setdefault((category, name), dict(calls=0, queries=0, time=0.0))
+                timing['calls'] += 1
+                timing['queries'] += frame[2]
+                timing['time'] += elapsed - frame[3]
+
+    def get_timings(self, category=None):
+        '''
+        Return a list of timings as dictionaries, optionally for one category.
+        '''
+        return [
+            dict(timing, category=key[0], name=key[1])
+            for key, timing in self.timings.items()
+            if category is None or key[0] == category
+        ]
+
+    def as_dict(self):
+        return dict(
+            trails=list(self.trails),
+            trail_count=len(self.trails),
+            query_count=self.query_count,
+            total_time=self.total_time,
+            timings=self.get_timings(),
+        )
+
+
+def get_stats():
+    '''
+    Return the active stats collector for the current context, if any.
+    '''
+    return _stats.get()
+
+
+def start_stats():
+    '''
+    Start collecting stats for the current context.
+    '''
+    stats = TrailsStats()
+    _stats.set(stats)
+    return stats
+
+
+def stop_stats():
+    '''
+    Stop collecting stats for the current context and return the collector.
+    '''
+    stats = get_stats()
+    _stats.set(None)
+    return stats
+
+
+@contextlib.contextmanager
+def collect_stats():
+    '''
+    Collect stats for trails activity within a block of code, e.g. to log
+    slow requests from a middleware:
+
+        with collect_stats() as stats:
+            response = self.get_response(request)
+        if stats.total_time > 0.1:
+            logger.warning('%s: %r', request.path, stats)
+    '''
+    stats = TrailsStats()
+    token = _stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _stats.reset(token)
+
+
+def measure(category, name=None):
+    '''
+    Decorator to measure a function against the active stats collector. Does
+    nothing more than a single lookup when stats aren't being collected.
+    '''
+    def decorator(f):
+        label = name or f.__name__
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            stats = get_stats()
+            if stats is None:
+                return f(*args, **kwargs)
+            with stats.measure(category, label):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
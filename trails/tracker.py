@@ -1,8 +1,10 @@
 # Python
 import collections
 import threading
+import weakref
 
 # Django
+from django.db import models
 from django.db.models.signals import (  # noqa
     pre_save,
     post_save,
@@ -21,22 +23,187 @@ from django.utils.encoding import force_text
 
 
 # Django-Trails
+from .deletion import get_delete_group
+from .diff import encode_change
 from .settings import trails_settings
-from .utils import log_trace, serialize_instance, record_trail
+from .stats import measure
+from .utils import get_cached_related, iter_queryset_chunks, log_trace, serialize_instance, record_trail
 
 __all__ = []
 
 
+class PendingState(object):
+    '''
+    State kept for a model instance between pre_* and post_* signals.
+    '''
+
+    __slots__ = ('ref', 'pre_save', 'pre_delete')
+
+    def __init__(self, ref):
+        self.ref = ref
+        self.pre_save = None
+        self.pre_delete = None
+
+
+class PendingStates(object):
+    '''
+    Side table of pending state for instances being saved or deleted, keyed by
+    id(instance). Entries are removed by the post_* signal handlers, or when
+    the instance is garbage collected if a save or delete was interrupted.
+    '''
+
+    def __init__(self):
+        self._states = {}
+
+    def __len__(self):
+        return len(self._states)
+
+    def _discard(self, key, ref):
+        state = self._states.get(key)
+        if state is not None and state.ref is ref:
+            del self._states[key]
+
+    def set(self, instance, attr, value):
+        key = id(instance)
+        state = self._states.get(key)
+        if state is None or state.ref() is not instance:
+            ref = weakref.ref(instance, lambda ref: self._discard(key, ref))
+            state = self._states[key] = PendingState(ref)
+        setattr(state, attr, value)
+
+    def pop(self, instance, attr):
+        key = id(instance)
+        state = self._states.get(key)
+        if state is None or state.ref() is not instance:
+            return None
+        value = getattr(state, attr)
+        setattr(state, attr, None)
+        if state.pre_save is None and state.pre_delete is None:
+            self._discard(key, state.ref)
+        return value
+
+
+class SignalDispatcher(object):
+    '''
+    Shared receiver for model signals that routes each signal to the tracker
+    registered for the sender model class.
+    '''
+
+    signal_names = ('pre_save', 'post_save', 'pre_delete', 'post_delete',
+                    'm2m_changed', 'pre_migrate', 'post_migrate')
+
+    def __init__(self):
+        self.model_trackers = {}
+        self.m2m_trackers = {}
+        self.migrating_apps = set()
+        self.connected = False
+
+    def __repr__(self):
+        return '<SignalDispatcher>'
+
+    @property
+    def migrating(self):
+        return bool(self.migrating_apps)
+
+    def get_dispatch_uid(self, signal_name):
+        return 'trails-dispatcher-{}'.format(signal_name)
+
+    def connect(self):
+        if self.connected:
+            return
+        for signal_name in self.signal_names:
+            signal = globals()[signal_name]
+            dispatch_uid = self.get_dispatch_uid(signal_name)
+            signal.connect(
+                getattr(self, 'on_{}'.format(signal_name)),
+                dispatch_uid=dispatch_uid,
+            )
+            log_trace('%r: connect %s', self, dispatch_uid)
+        self.connected = True
+
+    def disconnect(self):
+        if not self.connected:
+            return
+        for signal_name in self.signal_names:
+            signal = globals()[signal_name]
+            dispatch_uid = self.get_dispatch_uid(signal_name)
+            signal.disconnect(
+                dispatch_uid=dispatch_uid,
+            )
+            log_trace('%r: disconnect %s', self, dispatch_uid)
+        self.connected = False
+
+    def register(self, model_tracker):
+        self.model_trackers[model_tracker.model_class] = model_tracker
+        self.connect()
+
+    def unregister(self, model_tracker):
+        # Only remove the tracker if it hasn't already been replaced by a new
+        # tracker for the same model class.
+        if self.model_trackers.get(model_tracker.model_class, None) is model_tracker:
+            del self.model_trackers[model_tracker.model_class]
+        if not self.model_trackers and not self.m2m_trackers:
+            self.disconnect()
+
+    def register_m2m(self, m2m_tracker):
+        self.m2m_trackers[m2m_tracker.m2m_model_class] = m2m_tracker
+        self.connect()
+
+    def unregister_m2m(self, m2m_tracker):
+        if self.m2m_trackers.get(m2m_tracker.m2m_model_class, None) is m2m_tracker:
+            del self.m2m_trackers[m2m_tracker.m2m_model_class]
+        if not self.model_trackers and not self.m2m_trackers:
+            self.disconnect()
+
+    def on_pre_migrate(self, sender, **kwargs):
+        log_trace('%r: on_pre_migrate(%r, **%r)', self, sender, kwargs)
+        self.migrating_apps.add(getattr(sender, 'label', sender))
+
+    def on_post_migrate(self, sender, **kwargs):
+        log_trace('%r: on_post_migrate(%r, **%r)', self, sender, kwargs)
+        self.migrating_apps.discard(getattr(sender, 'label', sender))
+
+    def on_pre_save(self, sender, **kwargs):
+        model_tracker = self.model_trackers.get(sender, None)
+        if model_tracker:
+            model_tracker.on_pre_save(sender, **kwargs)
+
+    def on_post_save(self, sender, **kwargs):
+        model_tracker = self.model_trackers.get(sender, None)
+        if model_tracker:
+            model_tracker.on_post_save(sender, **kwargs)
+
+    def on_pre_delete(self, sender, **kwargs):
+        model_tracker = self.model_trackers.get(sender, None)
+        if model_tracker:
+            model_tracker.on_pre_delete(sender, **kwargs)
+
+    def on_post_delete(self, sender, **kwargs):
+        model_tracker = self.model_trackers.get(sender, None)
+        if model_tracker:
+            model_tracker.on_post_delete(sender, **kwargs)
+
+    def on_m2m_changed(self, sender, **kwargs):
+        m2m_tracker = self.m2m_trackers.get(sender, None)
+        if m2m_tracker:
+            m2m_tracker.on_m2m_changed(sender, **kwargs)
+
+
+dispatcher = SignalDispatcher()
+
+
 class ModelTracker(object):
     '''
     Tracker for signals related to model instance changes.
     '''
 
-    def __init__(self, model_class, model_fields):
+    def __init__(self, model_class, model_fields, dispatcher=None):
         log_trace('ModelTracker.__init__(%r, %r)', model_class, model_fields)
         self.model_class = model_class
         self.model_fields = model_fields
+        self.dispatcher = dispatcher
         self.trails_tls = threading.local()
+        self.pending = PendingStates()
         self.connect()
 
     def __del__(self):
@@ -56,7 +223,7 @@ class ModelTracker(object):
         if not hasattr(self, '_discrete_fields'):
             self._discrete_fields = [
                 field_name for field_name, field_action in self.model_fields.items()
-                if field_action in {True, '__SENSITIVE__'}
+                if field_action in {True, '__SENSITIVE__', '__IGNORE_ONLY__'}
             ]
         return self._discrete_fields
 
@@ -72,6 +239,18 @@ class ModelTracker(object):
             ]
         return self._sensitive_fields
 
+    @property
+    def ignore_only_fields(self):
+        '''
+        Return set of field names of tracked fields whose changes alone don't record a trail.
+        '''
+        if not hasattr(self, '_ignore_only_fields'):
+            self._ignore_only_fields = set([
+                field_name for field_name, field_action in self.model_fields.items()
+                if field_action == '__IGNORE_ONLY__'
+            ])
+        return self._ignore_only_fields
+
     @property
     def fk_field_map(self):
         '''
@@ -98,6 +277,9 @@ class ModelTracker(object):
         return 'trails-{}.{}-{}[{}]'.format(opts.app_label, opts.model_name, signal_name, id(self))
 
     def connect(self):
+        if self.dispatcher:
+            self.dispatcher.register(self)
+            return
         for signal_name in ('pre_migrate', 'post_migrate'):
             signal = globals()[signal_name]
             dispatch_uid = self.get_dispatch_uid(signal_name)
@@ -118,6 +300,9 @@ class ModelTracker(object):
             log_trace('%r: connect %s', self, dispatch_uid)
 
     def disconnect(self):
+        if self.dispatcher:
+            self.dispatcher.unregister(self)
+            return
         for signal_name in ('pre_migrate', 'post_migrate', 'pre_save', 'post_save', 'pre_delete', 'post_delete'):
             signal = globals()[signal_name]
             dispatch_uid = self.get_dispatch_uid(signal_name)
@@ -128,6 +313,8 @@ class ModelTracker(object):
 
     @property
     def migrating(self):
+        if self.dispatcher:
+            return self.dispatcher.migrating
         return getattr(self.trails_tls, 'migrating', False)
 
     def on_pre_migrate(self, sender, **kwargs):
@@ -138,6 +325,32 @@ class ModelTracker(object):
         log_trace('%r: on_post_migrate(%r, **%r)', self, sender, kwargs)
         self.trails_tls.migrating = False
 
+    def get_related_instances(self, instance, related_pks):
+        '''
+        Return related instances for a list of (rel, field, pk) tuples, using
+        instances already cached on the model instance where possible and
+        fetching the rest with a single query per related model.
+        '''
+        found = {}
+        missing = collections.defaultdict(set)
+        for rel, field, pk in related_pks:
+            fk_model = self.fk_field_map[field][1]
+            cached = get_cached_related(instance, field)
+            if cached is not None and cached.pk == pk:
+                found[(fk_model, pk)] = cached
+            elif (fk_model, pk) not in found:
+                missing[fk_model].add(pk)
+        for fk_model, pks in missing.items():
+            for pk, related_instance in fk_model.objects.in_bulk(list(pks)).items():
+                found.setdefault((fk_model, pk), related_instance)
+        related_instances = []
+        for rel, field, pk in related_pks:
+            related_instance = found.get((self.fk_field_map[field][1], pk))
+            if related_instance:
+                related_instances.append(dict(rel=rel, instance=related_instance))
+        return related_instances
+
+    @measure('tracker')
     def on_pre_save(self, sender, **kwargs):
         log_trace('%r: on_pre_save(%r, **%r)', self, sender, kwargs)
         if self.migrating and not trails_settings.TRACK_MIGRATIONS:
@@ -153,15 +366,15 @@ class ModelTracker(object):
             fields = [f for f in fields if f in update_fields]
         serialized = serialize_instance(instance, before=True, using=using, fields=fields)
         if serialized:
-            if not hasattr(instance, '_trails_tls'):
-                instance._trails_tls = threading.local()
-            instance._trails_tls.pre_save = serialized
+            self.pending.set(instance, 'pre_save', serialized)
 
+    @measure('tracker')
     def on_post_save(self, sender, **kwargs):
         log_trace('%r: on_post_save(%r, **%r)', self, sender, kwargs)
+        instance = kwargs['instance']
+        before = self.pending.pop(instance, 'pre_save') or {}
         if self.migrating and not trails_settings.TRACK_MIGRATIONS:
             return
-        instance = kwargs['instance']
         created = kwargs['created']
         raw = kwargs['raw']
         if raw and not trails_settings.TRACK_RAW:
@@ -174,7 +387,7 @@ class ModelTracker(object):
         if created:
             serialized = serialize_instance(instance, using=using, fields=fields)
             instance_data = collections.OrderedDict()
-            related_instances = []
+            related_pks = []
             for field, value in serialized.items():
                 if field in self.sensitive_fields:
                     if value or not trails_settings.SENSITIVE_SHOW_EMPTY:
@@ -183,20 +396,15 @@ class ModelTracker(object):
                     fk_id_field, fk_model = self.fk_field_map[field]
                     instance_data[fk_id_field] = value
                     if value is not None:
-                        related_instance = fk_model.objects.get(pk=value)
-                        if related_instance:
-                            related_instances.append(dict(
-                                rel=field,
-                                instance=related_instance,
-                            ))
+                        related_pks.append((field, field, value))
                 else:
                     instance_data[field] = value
+            related_instances = self.get_related_instances(instance, related_pks)
             if related_instances:
                 record_trail('add', instance=instance, instance_data=instance_data, related_instances=related_instances)
             else:
                 record_trail('add', instance=instance, instance_data=instance_data)
         else:
-            before = getattr(getattr(instance, '_trails_tls', None), 'pre_save', None) or {}
             after = serialize_instance(instance, using=using, fields=fields) or {}
             changes = collections.OrderedDict()
             for field in fields:
@@ -207,7 +415,9 @@ class ModelTracker(object):
                     changes[field] = (None, after[field])
                 elif field in before:
                     changes[field] = (before[field], None)
-            related_instances = []
+            if self.ignore_only_fields and self.ignore_only_fields.issuperset(changes):
+                return
+            related_pks = []
             instance_data = collections.OrderedDict()
             for field, values in changes.items():
                 if field in self.sensitive_fields:
@@ -219,42 +429,43 @@ class ModelTracker(object):
                     fk_id_field, fk_model = self.fk_field_map[field]
                     instance_data[fk_id_field] = values
                     if values[0] is not None:
-                        related_instance_before = fk_model.objects.get(pk=values[0])
-                        if related_instance_before:
-                            related_instances.append(dict(
-                                rel='-{}'.format(field),
-                                instance=related_instance_before,
-                            ))
+                        related_pks.append(('-{}'.format(field), field, values[0]))
                     if values[1] is not None:
-                        related_instance_after = fk_model.objects.get(pk=values[1])
-                        if related_instance_after:
-                            related_instances.append(dict(
-                                rel='+{}'.format(field),
-                                instance=related_instance_after,
-                            ))
+                        related_pks.append(('+{}'.format(field), field, values[1]))
                 else:
-                    instance_data[field] = values
+                    instance_data[field] = encode_change(*values)
             if instance_data:
+                related_instances = self.get_related_instances(instance, related_pks)
                 if related_instances:
                     record_trail('change', instance=instance, instance_data=instance_data, related_instances=related_instances)
                 else:
                     record_trail('change', instance=instance, instance_data=instance_data)
 
+    @measure('tracker')
     def on_pre_delete(self, sender, **kwargs):
         log_trace('%r: on_pre_delete(%r, **%r)', self, sender, kwargs)
         if self.migrating and not trails_settings.TRACK_MIGRATIONS:
             return
         instance = kwargs['instance']
-        if not hasattr(instance, '_trails_tls'):
-            instance._trails_tls = threading.local()
-        instance._trails_tls.pre_delete = force_text(instance)
+        delete_group = get_delete_group()
+        if delete_group is not None:
+            delete_group.pre_delete(instance, force_text(instance))
+            return
+        self.pending.set(instance, 'pre_delete', force_text(instance))
 
+    @measure('tracker')
     def on_post_delete(self, sender, **kwargs):
         log_trace('%r: on_post_delete(%r, **%r)', self, sender, kwargs)
+        instance = kwargs['instance']
+        instance_text = self.pending.pop(instance, 'pre_delete')
         if self.migrating and not trails_settings.TRACK_MIGRATIONS:
             return
-        instance = kwargs['instance']
-        instance_text = getattr(getattr(instance, '_trails_tls', None), 'pre_delete', None)
+        delete_group = get_delete_group()
+        if delete_group is not None:
+            trail_kwargs = delete_group.post_delete(instance)
+            if trail_kwargs:
+                record_trail('delete', **trail_kwargs)
+            return
         if instance_text is not None:
             record_trail('delete', instance=instance, instance_text=instance_text)
 
@@ -264,10 +475,11 @@ class ManyToManyTracker(object):
     Tracker for signals related to many to many field changes.
     '''
 
-    def __init__(self, m2m_model_class, related_model_fields):
+    def __init__(self, m2m_model_class, related_model_fields, dispatcher=None):
         log_trace('ManyToManyTracker.__init__(%r)', m2m_model_class)
         self.m2m_model_class = m2m_model_class
         self.related_model_fields = related_model_fields
+        self.dispatcher = dispatcher
         self.trails_tls = threading.local()
         self.connect()
 
@@ -286,6 +498,9 @@ class ManyToManyTracker(object):
                                             signal_name, id(self))
 
     def connect(self):
+        if self.dispatcher:
+            self.dispatcher.register_m2m(self)
+            return
         for signal_name in ('pre_migrate', 'post_migrate'):
             signal = globals()[signal_name]
             dispatch_uid = self.get_dispatch_uid(signal_name)
@@ -304,6 +519,9 @@ class ManyToManyTracker(object):
         log_trace('%r: connect %s', self, dispatch_uid)
 
     def disconnect(self):
+        if self.dispatcher:
+            self.dispatcher.unregister_m2m(self)
+            return
         for signal_name in ('pre_migrate', 'post_migrate'):
             signal = globals()[signal_name]
             dispatch_uid = self.get_dispatch_uid(signal_name)
@@ -321,6 +539,8 @@ class ManyToManyTracker(object):
 
     @property
     def migrating(self):
+        if self.dispatcher:
+            return self.dispatcher.migrating
         return getattr(self.trails_tls, 'migrating', False)
 
     def on_pre_migrate(self, sender, **kwargs):
@@ -343,14 +563,51 @@ class ManyToManyTracker(object):
     def on_m2m_pre_add(self, sender, instance, model, pk_set):
         pass
 
+    def record_m2m_trail(self, action, instance, model, pks):
+        '''
+        Record a trail for related objects added or removed, passing only their
+        primary keys (or a queryset of them) so markers can be created in bulk,
+        or a summary when more than M2M_SUMMARY_THRESHOLD objects were affected.
+        '''
+        primary_rel, related_rel = self._get_rel_names(instance, model)
+        threshold = trails_settings.M2M_SUMMARY_THRESHOLD
+        if isinstance(pks, models.QuerySet):
+            count = pks.count() if threshold is not None else None
+        else:
+            pks = sorted(pks)
+            count = len(pks)
+        data = None
+        if threshold is not None and count > threshold:
+            sample_size = max(trails_settings.M2M_SUMMARY_SAMPLE_SIZE, 1)
+            step = -(-count // sample_size)
+            if isinstance(pks, models.QuerySet):
+                sample_pks = []
+                n = 0
+                for rows in iter_queryset_chunks(pks, trails_settings.BULK_BATCH_SIZE or 1000, fields=()):
+                    for row in rows:
+                        if n % step == 0:
+                            sample_pks.append(row[0])
+                        n += 1
+            else:
+                sample_pks = pks[::step]
+            data = collections.OrderedDict([
+                ('rel', related_rel),
+                ('model', model._meta.label),
+                ('count', count),
+                ('sample_pks', sample_pks),
+            ])
+            pks = sample_pks
+        record_trail(
+            action,
+            data=data,
+            related_instances=[dict(rel=primary_rel, instance=instance)],
+            related_pks=dict(rel=related_rel, model=model, pks=pks),
+        )
+
     def on_m2m_post_add(self, sender, instance, model, pk_set):
         if not pk_set:
             return
-        primary_rel, related_rel = self._get_rel_names(instance, model)
-        related_list = [dict(rel=primary_rel, instance=instance)]
-        for related_instance in model.objects.filter(pk__in=pk_set):
-            related_list.append(dict(rel=related_rel, instance=related_instance))
-        record_trail('associate', related_instances=related_list)
+        self.record_m2m_trail('associate', instance, model, pk_set)
 
     def on_m2m_pre_remove(self, sender, instance, model, pk_set):
         pass
@@ -358,27 +615,19 @@ class ManyToManyTracker(object):
     def on_m2m_post_remove(self, sender, instance, model, pk_set):
         if not pk_set:
             return
-        primary_rel, related_rel = self._get_rel_names(instance, model)
-        related_list = [dict(rel=primary_rel, instance=instance)]
-        for related_instance in model.objects.filter(pk__in=pk_set):
-            related_list.append(dict(rel=related_rel, instance=related_instance))
-        record_trail('disassociate', related_instances=related_list)
+        self.record_m2m_trail('disassociate', instance, model, pk_set)
 
     def on_m2m_pre_clear(self, sender, instance, model, pk_set=None):
+        # Record the trail before the relation is cleared, while the related
+        # objects can still be queried. Django sends this signal inside the same
+        # transaction as the clear, so the trail is rolled back if it fails.
         primary_rel, related_rel = self._get_rel_names(instance, model)
-        related_pks = list(getattr(instance, primary_rel).values_list('pk', flat=True))
-        if not hasattr(instance, '_trails_tls'):
-            instance._trails_tls = threading.local()
-        setattr(instance._trails_tls, 'pre_clear_{}'.format(primary_rel), related_pks)
+        self.record_m2m_trail('disassociate', instance, model, getattr(instance, primary_rel).all())
 
     def on_m2m_post_clear(self, sender, instance, model, pk_set=None):
-        primary_rel, related_rel = self._get_rel_names(instance, model)
-        related_pks = getattr(getattr(instance, '_trails_tls', None), 'pre_clear_{}'.format(primary_rel), None) or []
-        related_list = [dict(rel=primary_rel, instance=instance)]
-        for related_instance in model.objects.filter(pk__in=related_pks):
-            related_list.append(dict(rel=related_rel, instance=related_instance))
-        record_trail('disassociate', related_instances=related_list)
+        pass
 
+    @measure('tracker')
     def on_m2m_changed(self, sender, **kwargs):
         log_trace('%r: on_m2m_changed(%r, **%r)', self, sender, kwargs)
         if self.migrating and not trails_settings.TRACK_MIGRATIONS:
@@ -432,6 +681,7 @@ class UserTracker(object):
             signal.disconnect(dispatch_uid=dispatch_uid)
             log_trace('%r: disconnect %s', self, dispatch_uid)
 
+    @measure('tracker')
     def on_user_logged_in(self, sender, **kwargs):
         log_trace('%r: on_user_logged_in(%r, **%r)', self, sender, kwargs)
         record_trail(
@@ -440,6 +690,7 @@ class UserTracker(object):
             user=kwargs.get('user', None),
         )
 
+    @measure('tracker')
     def on_user_logged_out(self, sender, **kwargs):
         log_trace('%r: on_user_logged_out(%r, **%r)', self, sender, kwargs)
         record_trail(
@@ -448,6 +699,7 @@ class UserTracker(object):
             user=kwargs.get('user', None),
         )
 
+    @measure('tracker')
     def on_user_login_failed(self, sender, **kwargs):
         log_trace('%r: on_user_login_failed(%r, **%r)', self, sender, kwargs)
         record_trail(
@@ -1,11 +1,15 @@
 # Python
 import collections
 import logging
+import threading
 
 # Django
 from django.core import serializers
 
-__all__ = ['record_trail', 'serialize_instance']
+# Django-Trails
+from .stats import measure
+
+__all__ = ['record_trail', 'serialize_instance', 'get_cached_related', 'iter_queryset_chunks', 'LRUCache']
 
 logger = logging.getLogger('trails')
 
@@ -17,6 +21,41 @@ def log_trace(msg, *args, **kwargs):
     logger.log(5, msg, *args, **kwargs)
 
 
+class LRUCache(object):
+    '''
+    Simple thread-safe cache that discards the least recently used items.
+    '''
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > max(self.maxsize, 0):
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+@measure('serialize')
 def serialize_instance(instance, before=False, fields=None, using=None):
     '''
     Serialize a model instance to a Python dictionary.
@@ -41,9 +80,41 @@ def serialize_instance(instance, before=False, fields=None, using=None):
     return result
 
 
+def get_cached_related(instance, field_name):
+    '''
+    Return the related instance already cached on a model instance for a
+    foreign key field, or None if it hasn't been loaded.
+    '''
+    field = instance._meta.get_field(field_name)
+    if hasattr(field, 'is_cached'):
+        return field.get_cached_value(instance, None) if field.is_cached(instance) else None
+    return getattr(instance, field.get_cache_name(), None)
+
+
+def iter_queryset_chunks(queryset, batch_size, fields=None):
+    '''
+    Yield lists of rows from a queryset in chunks ordered by primary key, using
+    keyset pagination so memory use doesn't grow with the number of rows. Rows
+    are model instances, or tuples of (pk, *fields) when fields are given.
+    '''
+    queryset = queryset.order_by('pk')
+    if fields is not None:
+        queryset = queryset.values_list('pk', *fields)
+    last_pk = None
+    while True:
+        chunk_queryset = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(chunk_queryset[:batch_size])
+        if not rows:
+            break
+        yield rows
+        if len(rows) < batch_size:
+            break
+        last_pk = rows[-1][0] if fields is not None else rows[-1].pk
+
+
 def record_trail(action, request=None, session=None, user=None, user_text=None,
                  data=None, instance=None, instance_text=None,
-                 instance_data=None, related_instances=None):
+                 instance_data=None, related_instances=None, related_pks=None):
     '''
     Record an action taken against a model instance.
     '''
@@ -59,4 +130,5 @@ def record_trail(action, request=None, session=None, user=None, user_text=None,
         instance_text=instance_text,
         instance_data=instance_data,
         related_instances=related_instances,
+        related_pks=related_pks,
     )
@@ -0,0 +1,14 @@
+# Django
+from django.http import HttpResponse
+
+# Django-Trails
+from .metrics import export_metrics
+
+__all__ = ['metrics']
+
+
+def metrics(request):
+    '''
+    Export trails pipeline metrics in the Prometheus text format.
+    '''
+    return HttpResponse(export_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')